@@ -1,10 +1,22 @@
 import base64
-import functools
+import collections
+import contextlib
+import hashlib
+import heapq
+import hmac
 import io
 import json
+import math
+import multiprocessing
 import os
+import re
+import sqlite3
+import threading
 import time
+import unicodedata
 import uuid
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
 import fitz  # PyMuPDF
@@ -13,7 +25,7 @@ import fitz  # PyMuPDF
 import nltk
 import pytesseract
 from dotenv import dotenv_values
-from flask import Flask, jsonify, make_response, request
+from flask import Flask, Response, jsonify, make_response, request, stream_with_context
 from flask_cors import CORS
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
@@ -73,7 +85,9 @@ else:
 # Initialize Supabase client
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
 
-from groq import Groq
+import llm_gateway
+import ocr_worker
+from llm_gateway import LLMOverloadedError, LLMUnavailableError
 
 app = Flask(__name__)
 
@@ -90,23 +104,180 @@ CORS(app,
 UPLOAD_FOLDER = os.path.join("uploads")
 EXTRACTED_TEXT_FOLDER = os.path.join("extracted_texts")
 COMPRESSED_DATA_FOLDER = os.path.join("compressed_data")
+INGEST_CACHE_FOLDER = os.path.join("ingest_cache")
+CHUNK_CACHE_FOLDER = os.path.join("chunk_cache")
+INGEST_JOBS_DB_PATH = os.path.join("ingest_jobs.db")
+STUDY_CONTEXT_DB_PATH = os.path.join("study_context.db")
 
 # JWT Configuration
 JWT_SECRET_KEY = sb_config.get("FLASK_SECRET_KEY")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24 * 7  # 7 days
 
+# Ops endpoints (/api/llm-usage) require this token in an X-Ops-Token header; unset disables them
+OPS_API_TOKEN = os.environ.get("OPS_API_TOKEN") or sb_config.get("OPS_API_TOKEN")
+
 # Create directories if they don't exist
-for folder in [UPLOAD_FOLDER, EXTRACTED_TEXT_FOLDER, COMPRESSED_DATA_FOLDER]:
+for folder in [UPLOAD_FOLDER, EXTRACTED_TEXT_FOLDER, COMPRESSED_DATA_FOLDER, INGEST_CACHE_FOLDER, CHUNK_CACHE_FOLDER]:
     if not os.path.exists(folder):
         os.makedirs(folder)
 
 # Create directories if they don't exist
-for folder in [UPLOAD_FOLDER, EXTRACTED_TEXT_FOLDER, COMPRESSED_DATA_FOLDER]:
+for folder in [UPLOAD_FOLDER, EXTRACTED_TEXT_FOLDER, COMPRESSED_DATA_FOLDER, INGEST_CACHE_FOLDER, CHUNK_CACHE_FOLDER]:
     if not os.path.exists(folder):
         os.makedirs(folder)
 
-groq_client = Groq(api_key=GROQ_API_KEY)
+# All Groq traffic goes through the gateway (pooled client, shared rate limits, admission control)
+llm_gateway.configure(GROQ_API_KEY)
+
+def _llm_overloaded_response(error):
+    """503 with Retry-After for calls shed by the LLM gateway (overload or open circuit), so clients back off instead of hammering."""
+    retry_after = max(1, int(round(error.retry_after)))
+    if isinstance(error, LLMUnavailableError):
+        message = "AI service is temporarily unavailable, please retry shortly"
+    else:
+        message = "AI service is busy, please retry shortly"
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+def _wants_streaming(data):
+    """Streaming is opt-in: {"stream": true} in the JSON body or Accept: text/event-stream."""
+    flag = (data or {}).get("stream")
+    if isinstance(flag, str):
+        flag = flag.lower() in ("1", "true", "yes")
+    return bool(flag) or "text/event-stream" in request.headers.get("Accept", "")
+
+def _sse_event(payload, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+def _stream_llm_response(completion_stream, result_key, on_complete, cache_status=None):
+    """
+    Forwards a gateway CompletionStream as Server-Sent Events:
+      data: {"delta": "..."}            for each piece of text as Groq produces it
+      event: done  data: {result_key: full_text}  once the completion has finished
+      event: error data: {"error": "..."}          if the upstream stream breaks
+    on_complete(full_text) runs before the done event, so results are logged exactly as in the non-streaming path.
+    cache_status, if given, is reported in the done event and the X-Cache header.
+    """
+    def generate():
+        parts = []
+        try:
+            for delta in completion_stream:
+                parts.append(delta)
+                yield _sse_event({"delta": delta})
+        except Exception as e:
+            print(f"Error while streaming from Groq: {e}")
+            yield _sse_event({"error": "AI response was interrupted"}, "error")
+            return
+        full_text = "".join(parts)
+        try:
+            on_complete(full_text)
+        except Exception as e:
+            print(f"Error recording streamed result: {e}")
+        done_payload = {result_key: full_text}
+        if cache_status:
+            done_payload["cache"] = cache_status
+        yield _sse_event(done_payload, "done")
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Keep nginx from buffering the stream
+    if cache_status:
+        response.headers["X-Cache"] = cache_status
+    # Frees the upstream connection and in-flight slot even if the client disconnects before the first byte
+    response.call_on_close(completion_stream.close)
+    return response
+
+# --- Ingestion Configuration ---
+# Max number of chunks sent to the extraction LLM at the same time. The pool is shared
+# by every request in this worker, so this also bounds the total Groq fan-out per worker.
+INGEST_CHUNK_CONCURRENCY = max(1, int(os.environ.get("INGEST_CHUNK_CONCURRENCY", 4)))
+_chunk_extraction_pool = ThreadPoolExecutor(max_workers=INGEST_CHUNK_CONCURRENCY, thread_name_prefix="chunk-extract")
+
+# Scanned PDF pages are OCR'd on a process pool (tesseract is CPU bound); pages with a text layer stay inline.
+# Set PDF_PARALLEL_OCR=0 to OCR every page in the request thread as before.
+# Every gunicorn worker has its own pool, so by default the host's cores are split between the
+# WEB_CONCURRENCY workers (capped at 4 per worker). Pool processes are started with forkserver (spawn
+# where that is unavailable) rather than forked from a process that already runs ingest and gateway threads.
+PDF_PARALLEL_OCR = os.environ.get("PDF_PARALLEL_OCR", "1") != "0"
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+PDF_OCR_WORKERS = max(1, int(os.environ.get("PDF_OCR_WORKERS", min(4, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+_ocr_process_pool = None
+_ocr_process_pool_lock = threading.Lock()
+
+# OCR tiers. Each page/image without a text layer is first classified from a low-resolution grayscale
+# thumbnail: near-blank pages are skipped unless a cheap low-DPI OCR pass (run on the OCR pool with the
+# other pages) still finds text on them (faint pencil, light scans), sparse pages (slides) use tesseract's
+# sparse-text mode (--psm 11) and dense pages use automatic layout (--psm 3). "fast" renders at 150 DPI,
+# the lowest that reads small print reliably, and caps image size; "accurate" renders everything at 300 DPI. Clients pick per request with ocr_mode=fast|accurate.
+OCR_MODES = ("fast", "accurate")
+OCR_DEFAULT_MODE = os.environ.get("OCR_DEFAULT_MODE", "fast").lower()
+if OCR_DEFAULT_MODE not in OCR_MODES:
+    print(f"Warning: unknown OCR_DEFAULT_MODE {OCR_DEFAULT_MODE!r}; using 'fast'")
+    OCR_DEFAULT_MODE = "fast"
+OCR_CLASSIFY_DPI = 36
+OCR_BLANK_CHECK_DPI = 100
+OCR_BLANK_CHECK_MAX_IMAGE_SIDE = 1000
+OCR_INK_LEVEL = 160  # grayscale values below this count as ink
+OCR_BLANK_INK_RATIO = 0.002
+OCR_SPARSE_INK_RATIO = 0.03
+OCR_TIER_DPI = {"fast": {"sparse": 150, "dense": 150}, "accurate": {"sparse": 300, "dense": 300}}
+OCR_FAST_MAX_IMAGE_SIDE = 1800
+
+# Uploads are processed from memory. Set PERSIST_INGEST_ARTIFACTS=1 to also keep the original upload,
+# extracted text and compressed JSON on disk (useful when debugging extraction quality).
+PERSIST_INGEST_ARTIFACTS = os.environ.get("PERSIST_INGEST_ARTIFACTS", "0") == "1"
+
+# Model and prompt used for study element extraction. Bump EXTRACTION_PROMPT_VERSION whenever the
+# extraction prompt or chunking changes so cached results from the old pipeline are not reused.
+EXTRACTION_MODEL = "gemma2-9b-it"
+EXTRACTION_PROMPT_VERSION = 4
+
+# Extraction chunks are packed from whole sentences up to this token budget. gemma2-9b-it has an 8192
+# token context; the extraction prompt takes ~300 tokens and the JSON answer is capped at 4000.
+# Consecutive chunks share the last EXTRACTION_CHUNK_OVERLAP_SENTENCES sentences for context.
+# Once a chunk is EXTRACTION_CHUNK_MIN_FILL full it is closed at the next "anchor" sentence (chosen by a
+# hash of the sentence text), so boundaries depend on content rather than position and an edit early in
+# a document does not shift every later chunk (which would defeat the per-chunk cache).
+EXTRACTION_CHUNK_MIN_FILL = 0.6
+EXTRACTION_CHUNK_ANCHOR_MODULUS = 16
+EXTRACTION_CHUNK_TOKENS = int(os.environ.get("EXTRACTION_CHUNK_TOKENS", 3400))
+EXTRACTION_CHUNK_OVERLAP_SENTENCES = int(os.environ.get("EXTRACTION_CHUNK_OVERLAP_SENTENCES", 1))
+
+# Chunks up to EXTRACTION_BATCH_SMALL_CHUNK_TOKENS are batched: the small chunks of one ingestion
+# (every file of a bulk /import-files request) share extraction requests of up to EXTRACTION_BATCH_MAX_DOCS
+# documents / EXTRACTION_BATCH_MAX_TOKENS of material, so a bulk import of small files makes a few calls
+# instead of one per file. A single small chunk waits up to EXTRACTION_BATCH_WINDOW_SECONDS for small
+# chunks of concurrent ingestions only when some are already queued.
+EXTRACTION_BATCHING = os.environ.get("EXTRACTION_BATCHING", "1") == "1"
+EXTRACTION_BATCH_SMALL_CHUNK_TOKENS = int(os.environ.get("EXTRACTION_BATCH_SMALL_CHUNK_TOKENS", 1200))
+EXTRACTION_BATCH_MAX_TOKENS = int(os.environ.get("EXTRACTION_BATCH_MAX_TOKENS", EXTRACTION_CHUNK_TOKENS))
+EXTRACTION_BATCH_MAX_DOCS = max(1, int(os.environ.get("EXTRACTION_BATCH_MAX_DOCS", 8)))
+EXTRACTION_BATCH_WINDOW_SECONDS = float(os.environ.get("EXTRACTION_BATCH_WINDOW_SECONDS", 0.05))
+
+# Ingestion results are cached on disk by SHA-256 of the uploaded bytes, so re-uploads of the same
+# syllabus or slide deck skip OCR and LLM extraction. Entries expire by age and the oldest are evicted
+# once the cache grows past its size limit.
+INGEST_CACHE_MAX_BYTES = int(os.environ.get("INGEST_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+INGEST_CACHE_MAX_AGE_SECONDS = int(os.environ.get("INGEST_CACHE_MAX_AGE_SECONDS", 30 * 24 * 3600))
+
+# Extraction results are also cached per chunk (normalized chunk text + prompt version + model), so a
+# lightly edited re-upload only sends the changed chunks to the LLM.
+CHUNK_CACHE_MAX_BYTES = int(os.environ.get("CHUNK_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+CHUNK_CACHE_MAX_AGE_SECONDS = int(os.environ.get("CHUNK_CACHE_MAX_AGE_SECONDS", 30 * 24 * 3600))
+# Disk caches are swept for expired/oversized entries at most this often per worker
+DISK_CACHE_EVICT_INTERVAL_SECONDS = 60
+
+# Background ingestion jobs run on a local worker pool; job state lives in SQLite so any worker can
+# answer /api/jobs/<id>. Jobs with no progress for INGEST_JOB_STALE_SECONDS are reported as failed
+# (their worker most likely restarted), and finished jobs are purged after INGEST_JOB_RETENTION_SECONDS.
+INGEST_JOB_WORKERS = max(1, int(os.environ.get("INGEST_JOB_WORKERS", 2)))
+INGEST_JOB_STALE_SECONDS = int(os.environ.get("INGEST_JOB_STALE_SECONDS", 15 * 60))
+INGEST_JOB_RETENTION_SECONDS = int(os.environ.get("INGEST_JOB_RETENTION_SECONDS", 7 * 24 * 3600))
+_ingest_job_pool = ThreadPoolExecutor(max_workers=INGEST_JOB_WORKERS, thread_name_prefix="ingest-job")
 
 def create_jwt_token(user_email):
     """Create a JWT token for the user"""
@@ -171,72 +342,199 @@ CLASSES = ["Math", "Science", "History", "Art", "Computer Science", "English"]
 # Define available access levels for projects
 ACCESS_LEVELS = ['private', 'view_only', 'edit']
 
-# Decorator for exponential backoff
-def retry_with_backoff(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        max_retries = 5
-        base_delay = 1 # seconds
-        for i in range(max_retries):
-            try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                # Check for specific Groq API errors
-                error_message = str(e)
-                if "rate_limit_exceeded" in error_message or "Request Entity Too Large" in error_message or "json_validate_failed" in error_message:
-                    delay = base_delay * (2 ** i)
-                    print(f"Groq API error: {e}. Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                else:
-                    raise # Re-raise other exceptions immediately
-        raise Exception(f"Failed after {max_retries} retries due to persistent errors.")
-    return wrapper
-
-# Helper function to extract text from PDF or image files
-def _extract_text_from_file(file_path):
+# AI tools whose output can be streamed to the client as it is generated
+STREAMABLE_AI_TOOLS = ('summarize', 'analyze', 'translate')
+
+# Model parameters per AI tool; also part of the result cache key
+AI_TOOL_SETTINGS = {
+    'summarize': {'model': 'gemma2-9b-it', 'temperature': 0.3, 'max_tokens': 500, 'failure_message': 'Failed to generate summary.'},
+    'analyze': {'model': 'gemma2-9b-it', 'temperature': 0.3, 'max_tokens': 600, 'failure_message': 'Failed to generate analysis.'},
+    'translate': {'model': 'gemma2-9b-it', 'temperature': 0.2, 'max_tokens': 800, 'failure_message': 'Failed to generate translation.'},
+    'extract_key_points': {'model': 'gemma2-9b-it', 'temperature': 0.3, 'max_tokens': 600, 'failure_message': 'Failed to extract key points.'},
+    'generate_test': {'model': 'gemma2-9b-it', 'temperature': 0.4, 'max_tokens': 800, 'failure_message': 'Failed to generate test.'},
+}
+
+# Tokens of fixed instructions an AI tool prompt wraps around its input (incl. the "Additional Context:" header)
+AI_TOOL_PROMPT_OVERHEAD_TOKENS = 48
+
+# Output reserved for the long-form generate endpoints when trimming their inputs; max_tokens is then
+# sized by the gateway to whatever context the prompt leaves (at least this much)
+MIN_GENERATION_OUTPUT_TOKENS = 2048
+# Tokens of fixed instructions in the generate endpoints' prompts (the study guide's are the longest)
+GENERATION_PROMPT_OVERHEAD_TOKENS = 320
+
+# --- AI Tool Result Cache ---
+# Low-temperature tool runs are close to deterministic, so identical requests reuse the earlier output.
+AI_RESULT_CACHE_MAX_ENTRIES = max(0, int(os.environ.get("AI_RESULT_CACHE_MAX_ENTRIES", 512)))
+AI_RESULT_CACHE_TTL_SECONDS = int(os.environ.get("AI_RESULT_CACHE_TTL_SECONDS", 6 * 3600))
+AI_RESULT_CACHE_MAX_TEMPERATURE = float(os.environ.get("AI_RESULT_CACHE_MAX_TEMPERATURE", 0.5))
+
+def _get_ocr_process_pool():
+    """Lazily create the OCR process pool; its workers only import ocr_worker."""
+    global _ocr_process_pool
+    with _ocr_process_pool_lock:
+        if _ocr_process_pool is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["ocr_worker"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _ocr_process_pool = ProcessPoolExecutor(max_workers=PDF_OCR_WORKERS, mp_context=context)
+        return _ocr_process_pool
+
+def _ink_ratio(gray_img):
+    """Fraction of pixels in a grayscale image dark enough to be text."""
+    histogram = gray_img.histogram()
+    total = sum(histogram) or 1
+    return sum(histogram[:OCR_INK_LEVEL]) / total
+
+def _classify_ocr_density(ink_ratio):
+    """Returns 'blank', 'sparse' or 'dense' for a page or image."""
+    if ink_ratio < OCR_BLANK_INK_RATIO:
+        return "blank"
+    return "sparse" if ink_ratio < OCR_SPARSE_INK_RATIO else "dense"
+
+def _ocr_psm_for_density(density):
+    return ocr_worker.SPARSE_TEXT_PSM if density == "sparse" else 3
+
+def _normalize_ocr_mode(ocr_mode):
+    return ocr_mode if ocr_mode in OCR_MODES else OCR_DEFAULT_MODE
+
+def _plan_page_ocr(page, ocr_mode):
+    """
+    Classify a page without a text layer from its thumbnail. Returns (dpi, psm, blank_check_scale) for
+    ocr_worker.ocr_page_image. Pages that look blank are planned as sparse with a blank_check_scale, so
+    the worker only OCRs them if the cheap pass at OCR_BLANK_CHECK_DPI finds text; otherwise it is None.
+    """
+    thumb = page.get_pixmap(dpi=OCR_CLASSIFY_DPI, colorspace=fitz.csGRAY)
+    density = _classify_ocr_density(_ink_ratio(Image.frombytes("L", [thumb.width, thumb.height], thumb.samples)))
+    if density == "blank":
+        dpi = OCR_TIER_DPI[ocr_mode]["sparse"]
+        return dpi, _ocr_psm_for_density("sparse"), min(1.0, OCR_BLANK_CHECK_DPI / dpi)
+    return OCR_TIER_DPI[ocr_mode][density], _ocr_psm_for_density(density), None
+
+def _render_page_for_ocr(page, dpi):
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    return pix.width, pix.height, pix.samples
+
+def _ocr_image(img, ocr_mode=None):
+    """OCR a standalone image using the same blank/sparse/dense classification as PDF pages."""
+    ocr_mode = _normalize_ocr_mode(ocr_mode)
+    gray = img.convert("L")
+    thumb = gray.copy()
+    thumb.thumbnail((256, 256))
+    density = _classify_ocr_density(_ink_ratio(thumb))
+    if density == "blank":
+        if not ocr_worker.image_has_text(gray, min(1.0, OCR_BLANK_CHECK_MAX_IMAGE_SIDE / max(gray.size))):
+            print(f"OCR ({ocr_mode}): image skipped as blank")
+            return ""
+        density = "sparse"
+    if ocr_mode == "fast" and max(gray.size) > OCR_FAST_MAX_IMAGE_SIDE:
+        gray.thumbnail((OCR_FAST_MAX_IMAGE_SIDE, OCR_FAST_MAX_IMAGE_SIDE))
+    return pytesseract.image_to_string(gray, config=f"--psm {_ocr_psm_for_density(density)}")
+
+def _extract_pdf_pages_text(doc, parallel_ocr=True, ocr_mode=None):
+    """
+    Returns the text of every page of an open PDF, in page order.
+    Pages with a text layer are read inline; pages without one are classified, rendered and OCR'd at the
+    DPI/page segmentation mode for their density and ocr_mode, on the process pool when parallel_ocr is
+    enabled. Pages that look blank are only OCR'd if a cheap pass finds text; skipped pages are logged.
+    """
+    ocr_mode = _normalize_ocr_mode(ocr_mode)
+    page_texts = [""] * doc.page_count
+    use_pool = parallel_ocr and PDF_PARALLEL_OCR and PDF_OCR_WORKERS > 1
+    ocr_futures = {}
+    ocr_plans = {}
+    # Bound the rendered pages waiting for a worker so large scans don't hold every pixmap in memory
+    max_in_flight = PDF_OCR_WORKERS * 2
+
+    for page_num in range(doc.page_count):
+        page = doc.load_page(page_num)
+        # Try to get text directly
+        page_text = page.get_text()
+        if page_text.strip():
+            page_texts[page_num] = page_text
+            continue
+
+        # If no text, try OCR (e.g., for scanned PDFs)
+        plan = _plan_page_ocr(page, ocr_mode)
+        dpi, psm, blank_check_scale = plan
+        ocr_plans[page_num] = plan
+        width, height, samples = _render_page_for_ocr(page, dpi)
+        if not use_pool:
+            page_texts[page_num] = ocr_worker.ocr_page_image(width, height, samples, psm, blank_check_scale)
+            continue
+
+        in_flight = [f for f in ocr_futures.values() if not f.done()]
+        if len(in_flight) >= max_in_flight:
+            wait(in_flight, return_when=FIRST_COMPLETED)
+        ocr_futures[page_num] = _get_ocr_process_pool().submit(
+            ocr_worker.ocr_page_image, width, height, samples, psm, blank_check_scale
+        )
+
+    for page_num, future in ocr_futures.items():
+        try:
+            page_texts[page_num] = future.result()
+        except Exception as e:
+            print(f"OCR worker failed on page {page_num + 1}, retrying inline: {e}")
+            dpi, psm, blank_check_scale = ocr_plans[page_num]
+            width, height, samples = _render_page_for_ocr(doc.load_page(page_num), dpi)
+            page_texts[page_num] = ocr_worker.ocr_page_image(width, height, samples, psm, blank_check_scale)
+
+    skipped_blank = [page_num + 1 for page_num, plan in ocr_plans.items() if plan[2] is not None and not page_texts[page_num]]
+    if ocr_plans:
+        print(f"OCR ({ocr_mode}): {len(ocr_plans) - len(skipped_blank)} pages OCR'd, {len(skipped_blank)} blank pages skipped"
+              + (f" (pages {', '.join(map(str, skipped_blank))})" if skipped_blank else ""))
+    return page_texts
+
+# Helper function to extract text from PDF or image files held in memory
+def _extract_text_from_bytes(file_bytes, filename, parallel_ocr=True, ocr_mode=None):
     text_content = ""
-    file_extension = os.path.splitext(file_path)[1].lower()
+    file_extension = os.path.splitext(filename)[1].lower()
 
     if file_extension == '.pdf':
         try:
-            doc = fitz.open(file_path)
-            for page_num in range(doc.page_count):
-                page = doc.load_page(page_num)
-                # Try to get text directly
-                page_text = page.get_text()
-                if page_text.strip():
-                    text_content += page_text + "\n"
-                else:
-                    # If no text, try OCR (e.g., for scanned PDFs)
-                    pix = page.get_pixmap()
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    ocr_text = pytesseract.image_to_string(img)
-                    text_content += ocr_text + "\n"
-            doc.close()
+            doc = fitz.open(stream=file_bytes, filetype="pdf")
+            try:
+                page_texts = _extract_pdf_pages_text(doc, parallel_ocr=parallel_ocr, ocr_mode=ocr_mode)
+            finally:
+                doc.close()
+            text_content = "".join(page_text + "\n" for page_text in page_texts)
         except Exception as e:
-            print(f"Error processing PDF {file_path}: {e}")
+            print(f"Error processing PDF {filename}: {e}")
             # Fallback to OCR if PDF processing fails
             try:
-                img = Image.open(file_path) # Might be a PDF that Pillow can open as image
-                text_content = pytesseract.image_to_string(img)
+                img = Image.open(io.BytesIO(file_bytes)) # Might be a PDF that Pillow can open as image
+                text_content = _ocr_image(img, ocr_mode)
             except Exception as img_e:
-                print(f"Error trying OCR on PDF as image {file_path}: {img_e}")
+                print(f"Error trying OCR on PDF as image {filename}: {img_e}")
     elif file_extension in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff']:
         try:
-            img = Image.open(file_path)
-            text_content = pytesseract.image_to_string(img)
+            img = Image.open(io.BytesIO(file_bytes))
+            text_content = _ocr_image(img, ocr_mode)
         except Exception as e:
-            print(f"Error processing image {file_path} with OCR: {e}")
+            print(f"Error processing image {filename} with OCR: {e}")
     else:
-        # For other text-based files, just read directly
+        # For other text-based files, just decode directly
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text_content = f.read()
+            text_content = file_bytes.decode('utf-8')
         except Exception as e:
-            print(f"Error reading plain text file {file_path}: {e}")
+            print(f"Error reading plain text file {filename}: {e}")
 
     return text_content.strip()
 
+# Helper function to extract text from PDF or image files on disk
+def _extract_text_from_file(file_path, parallel_ocr=True, ocr_mode=None):
+    try:
+        with open(file_path, 'rb') as f:
+            file_bytes = f.read()
+    except Exception as e:
+        print(f"Error reading file {file_path}: {e}")
+        return ""
+    return _extract_text_from_bytes(file_bytes, os.path.basename(file_path), parallel_ocr=parallel_ocr, ocr_mode=ocr_mode)
+
+# ==================== INGESTION PIPELINE ====================
+
 # Helper function to read extracted text content from disk
 def read_extracted_text_content(file_path):
     try:
@@ -330,6 +628,72 @@ def _nltk_compress_and_filter(structured_data):
 
     return final_concise_text
 
+
+# Extraction prompt pieces shared by single-chunk and batched extraction
+EXTRACTION_CATEGORY_SPEC = (
+    "'terms': A list of important terms found (e.g., ['Term1', 'Term2']).\n"
+    "'definitions': A list of definitions, explicitly linking to a term if possible (e.g., ['Term1: Definition of Term1', 'Definition of concept']).\n"
+    "'examples': A list of specific examples related to concepts (e.g., ['Example 1 description', 'Example 2 description']).\n"
+    "'questions': A list of questions (from quizzes, practice problems, etc.) as plain strings (e.g., ['What is X?', 'How does Y work?']).\n"
+    "'answers': A list of answers corresponding to the questions, as plain strings. If an answer is not explicitly given, state 'Not provided' (e.g., ['Answer to Q1', 'Not provided']).\n\n"
+)
+EXTRACTION_OUTPUT_RULES = (
+    "If a category is not found, its list should be empty. Output ONLY the JSON object. "
+    "Be extremely concise and extract only the most critical information to minimize output size. "
+    "Ensure ALL list items are plain strings, not nested objects or complex structures. Prioritize conciseness."
+)
+
+STUDY_ELEMENT_CATEGORIES = ("terms", "definitions", "examples", "questions", "answers")
+
+# Study elements from many chunks or files are merged into an "aggregate": per category, a dict from
+# item to the number of contributions containing it. Dicts keep insertion order and hash lookups, so
+# merging is linear in the number of items (membership tests against the growing lists were quadratic),
+# and a contribution can be subtracted again when its file is deleted.
+
+def _new_study_aggregate(counts=None):
+    return {category: dict((counts or {}).get(category, {})) for category in STUDY_ELEMENT_CATEGORIES}
+
+def _merge_study_elements(aggregate, elements, delta=1):
+    """Adds (delta=1) or subtracts (delta=-1) one contribution's items; empty values are skipped."""
+    if not isinstance(elements, dict):
+        return aggregate
+    for category in STUDY_ELEMENT_CATEGORIES:
+        values = elements.get(category)
+        if not isinstance(values, list):
+            continue
+        counts = aggregate[category]
+        for value in values:
+            if not value:
+                continue
+            item = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+            remaining = counts.get(item, 0) + delta
+            if remaining > 0:
+                counts[item] = remaining
+            else:
+                counts.pop(item, None)
+    return aggregate
+
+def _study_aggregate_lists(aggregate):
+    """The aggregate as the usual five lists of unique items, in first-seen order."""
+    return {category: list(aggregate[category]) for category in STUDY_ELEMENT_CATEGORIES}
+
+def _normalize_study_elements(extracted_data):
+    """Coerces an extraction answer into the five string lists, handling potential AI errors."""
+    def ensure_strings_in_list(lst):
+        if not isinstance(lst, list):
+            return []
+        return [str(item) if not isinstance(item, (dict, list)) else json.dumps(item) for item in lst]
+
+    if not isinstance(extracted_data, dict):
+        extracted_data = {}
+    return {
+        "terms": ensure_strings_in_list(extracted_data.get("terms", [])),
+        "definitions": ensure_strings_in_list(extracted_data.get("definitions", [])),
+        "examples": ensure_strings_in_list(extracted_data.get("examples", [])),
+        "questions": ensure_strings_in_list(extracted_data.get("questions", [])),
+        "answers": ensure_strings_in_list(extracted_data.get("answers", []))
+    }
+
 def _extract_key_study_elements_from_chunk(text_chunk):
     if not text_chunk.strip():
         return {
@@ -339,22 +703,20 @@ def _extract_key_study_elements_from_chunk(text_chunk):
     prompt = (
         "From the following study material, extract and categorize the key information. "
         "Provide the output as a JSON object with the following keys:\n"
-        "'terms': A list of important terms found (e.g., ['Term1', 'Term2']).\n"
-        "'definitions': A list of definitions, explicitly linking to a term if possible (e.g., ['Term1: Definition of Term1', 'Definition of concept']).\n"
-        "'examples': A list of specific examples related to concepts (e.g., ['Example 1 description', 'Example 2 description']).\n"
-        "'questions': A list of questions (from quizzes, practice problems, etc.) as plain strings (e.g., ['What is X?', 'How does Y work?']).\n"
-        "'answers': A list of answers corresponding to the questions, as plain strings. If an answer is not explicitly given, state 'Not provided' (e.g., ['Answer to Q1', 'Not provided']).\n\n"
-        "If a category is not found, its list should be empty. Output ONLY the JSON object. "
-        "Be extremely concise and extract only the most critical information to minimize output size. "
-        "Ensure ALL list items are plain strings, not nested objects or complex structures. Prioritize conciseness."
+        + EXTRACTION_CATEGORY_SPEC + EXTRACTION_OUTPUT_RULES
     )
 
     try:
-        chat_completion = groq_client.chat.completions.create(
+        chat_completion = llm_gateway.chat_completion(
             messages=[
                 {"role": "user", "content": prompt + "\n\nMaterial:\n" + text_chunk}
             ],
-            model="gemma2-9b-it",
+            model=EXTRACTION_MODEL,
+            endpoint="extract_study_elements",
+            hedge=True,
+            max_wait=llm_gateway.LLM_BACKGROUND_MAX_WAIT_SECONDS,
+            deadline=llm_gateway.LLM_BACKGROUND_DEADLINE_SECONDS,
+            retry_window=llm_gateway.LLM_BACKGROUND_DEADLINE_SECONDS,
             response_format={"type": "json_object"},
             temperature=0.2, # Lower temperature for more factual extraction
             max_tokens=4000, # Reduced max tokens for the extracted JSON output to enforce conciseness
@@ -362,108 +724,1293 @@ def _extract_key_study_elements_from_chunk(text_chunk):
         response_content = chat_completion.choices[0].message.content
         extracted_data = json.loads(response_content)
 
-        # Post-process to ensure all list items are strings, handling potential AI errors
-        def ensure_strings_in_list(lst):
-            if not isinstance(lst, list):
-                return []
-            return [str(item) if not isinstance(item, (dict, list)) else json.dumps(item) for item in lst]
-
-        return {
-            "terms": ensure_strings_in_list(extracted_data.get("terms", [])),
-            "definitions": ensure_strings_in_list(extracted_data.get("definitions", [])),
-            "examples": ensure_strings_in_list(extracted_data.get("examples", [])),
-            "questions": ensure_strings_in_list(extracted_data.get("questions", [])),
-            "answers": ensure_strings_in_list(extracted_data.get("answers", []))
-        }
+        # Post-process to ensure all list items are strings
+        return _normalize_study_elements(extracted_data)
 
     except json.JSONDecodeError as e:
         print(f"JSONDecodeError in _extract_key_study_elements_from_chunk: {e}. Raw response: {response_content[:500]}...")
         return { "terms": [], "definitions": [], "examples": [], "questions": [], "answers": [] }
+    except LLMOverloadedError:
+        raise # Fail the ingestion rather than store a file with chunks silently missing
     except Exception as e:
         print(f"Error extracting key study elements from chunk with Groq API: {e}")
         return { "terms": [], "definitions": [], "examples": [], "questions": [], "answers": [] }
 
-# IMPROVED: Main text processing and compression pipeline
-def _process_and_compress_text(raw_text_content, file_id):
-    # This function will handle token limits and return a path to compressed JSON
+# --- Batched extraction for small chunks ---
+# Small chunks (one-page worksheets, whiteboard photos) are packed into one JSON-mode request with a key
+# per document. _extract_chunks_concurrently packs the small chunks of one ingestion (all files of a bulk
+# import) itself; a lone small chunk goes through the queue below, which combines it with small chunks
+# submitted by concurrent ingestions within EXTRACTION_BATCH_WINDOW_SECONDS.
+_extraction_batch_queue = []
+_extraction_batch_cond = threading.Condition()
+_extraction_batch_flusher_pid = None
+_extraction_batch_pool = ThreadPoolExecutor(max_workers=INGEST_CHUNK_CONCURRENCY, thread_name_prefix="extract-batch")
+
+def _extract_study_elements_batched(text_chunk):
+    """Extraction for a small chunk via the batcher; blocks until its batch has been answered."""
+    item = {
+        "text": text_chunk,
+        "tokens": llm_gateway.estimate_tokens(text_chunk),
+        "future": Future(),
+        "enqueued_at": time.monotonic()
+    }
+    with _extraction_batch_cond:
+        _ensure_extraction_batch_flusher()
+        _extraction_batch_queue.append(item)
+        _extraction_batch_cond.notify()
+    return item["future"].result()
+
+def _ensure_extraction_batch_flusher():
+    """Starts the flusher thread once per process (threads do not survive fork). Caller holds the condition."""
+    global _extraction_batch_flusher_pid
+    if _extraction_batch_flusher_pid != os.getpid():
+        _extraction_batch_flusher_pid = os.getpid()
+        threading.Thread(target=_extraction_batch_flusher, name="extract-batch-flusher", daemon=True).start()
+
+def _pack_extraction_batches(items, tokens_of):
+    """
+    Greedily packs items, in order, into batches of at most EXTRACTION_BATCH_MAX_DOCS items and
+    EXTRACTION_BATCH_MAX_TOKENS tokens (an item over the token limit gets a batch of its own).
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for item in items:
+        tokens = tokens_of(item)
+        if batch and (len(batch) >= EXTRACTION_BATCH_MAX_DOCS or batch_tokens + tokens > EXTRACTION_BATCH_MAX_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def _take_extraction_batch():
+    """Pops the oldest queued items that fit the batch limits (always at least one). Caller holds the condition."""
+    batch = _pack_extraction_batches(_extraction_batch_queue, lambda item: item["tokens"])[0]
+    del _extraction_batch_queue[:len(batch)]
+    return batch
+
+def _extraction_batch_flusher():
+    while True:
+        with _extraction_batch_cond:
+            while not _extraction_batch_queue:
+                _extraction_batch_cond.wait()
+            # A lone item is sent at once; once others are waiting, hold the oldest for the rest of the
+            # batching window unless a full batch is already queued
+            if len(_extraction_batch_queue) > 1:
+                deadline = _extraction_batch_queue[0]["enqueued_at"] + EXTRACTION_BATCH_WINDOW_SECONDS
+                while len(_extraction_batch_queue) < EXTRACTION_BATCH_MAX_DOCS:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    _extraction_batch_cond.wait(remaining)
+            batch = _take_extraction_batch()
+        _extraction_batch_pool.submit(_run_extraction_batch, batch)
+
+def _run_extraction_batch(batch):
+    """Answers a queued batch and resolves each item's future."""
+    try:
+        results = _extract_study_elements_batch([item["text"] for item in batch])
+    except Exception as e:
+        for item in batch:
+            item["future"].set_exception(e)
+        return
+    for item, result in zip(batch, results):
+        item["future"].set_result(result)
 
-    # Define a safe chunk size for the LLM input
-    # gemma2-9b-it has 8192 context window. Let's aim for 4000-6000 tokens per chunk
-    # Assuming ~4 chars per token for English, 4000 tokens is ~16000 characters.
-    # We'll use a character-based chunking for simplicity.
-    CHUNK_SIZE_CHARS = 13000 # Roughly 3000 tokens input to extraction LLM
-    OVERLAP_CHARS = 500 # To maintain context across chunks
+def _extract_study_elements_batch(texts):
+    """
+    Extracts study elements for several small documents with one LLM call; returns one result per text,
+    in order. Documents missing from the answer (or all of them, if it cannot be parsed) fall back to
+    _extract_key_study_elements_from_chunk. LLMOverloadedError is raised as for single extraction.
+    """
+    results = {}
+    if len(texts) > 1:
+        documents = "".join(f"\n\n<doc_{i}>\n{text}\n</doc_{i}>" for i, text in enumerate(texts))
+        prompt = (
+            f"Below are {len(texts)} independent pieces of study material, each wrapped in <doc_N> tags. "
+            "For EACH document separately, extract and categorize its key information. "
+            f"Provide the output as a JSON object with one key per document ({', '.join(f'doc_{i}' for i in range(len(texts)))}); "
+            "each value is a JSON object with the following keys:\n"
+            + EXTRACTION_CATEGORY_SPEC + EXTRACTION_OUTPUT_RULES +
+            " Never mix information between documents."
+            "\n\nMaterial:" + documents
+        )
+        try:
+            chat_completion = llm_gateway.chat_completion(
+                messages=[{"role": "user", "content": prompt}],
+                model=EXTRACTION_MODEL,
+                endpoint="extract_study_elements_batch",
+                hedge=True,
+                max_wait=llm_gateway.LLM_BACKGROUND_MAX_WAIT_SECONDS,
+                deadline=llm_gateway.LLM_BACKGROUND_DEADLINE_SECONDS,
+                retry_window=llm_gateway.LLM_BACKGROUND_DEADLINE_SECONDS,
+                response_format={"type": "json_object"},
+                temperature=0.2,
+                max_tokens=4000,
+            )
+            answer = json.loads(chat_completion.choices[0].message.content)
+            if isinstance(answer, dict):
+                for i in range(len(texts)):
+                    if isinstance(answer.get(f"doc_{i}"), dict):
+                        results[i] = _normalize_study_elements(answer[f"doc_{i}"])
+            print(f"Batched extraction: {len(results)}/{len(texts)} documents answered in one call")
+        except LLMOverloadedError:
+            raise
+        except Exception as e:
+            print(f"Batched extraction failed, falling back to single extraction: {e}")
 
-    full_extracted_data = {
-        "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-    }
+    return [results[i] if i in results else _extract_key_study_elements_from_chunk(text) for i, text in enumerate(texts)]
 
-    if not raw_text_content.strip():
-        return None # Return None if no content to process
+def _extract_chunks_concurrently(chunks, progress_callback=None):
+    """
+    Runs _extract_key_study_elements_from_chunk over all chunks on the shared extraction pool.
+    Chunks already in the per-chunk cache are not sent to the LLM.
+    Results are returned in chunk order, so merging them gives the same output as a sequential run.
+    progress_callback(done, total) is called as each chunk finishes, in completion order.
+    """
+    total = len(chunks)
+    results = [None] * total
+    done_count = [0]
+    done_lock = threading.Lock()
+
+    def _on_chunks_done(count=1):
+        with done_lock:
+            done_count[0] += count
+            done = done_count[0]
+        print(f"Processed chunk {done}/{total}")
+        if progress_callback:
+            try:
+                progress_callback(done, total)
+            except Exception as e:
+                print(f"Error reporting chunk progress: {e}")
+
+    misses = []
+    for i, chunk in enumerate(chunks):
+        cache_key = _chunk_cache_key(chunk)
+        cached = _disk_cache_get(CHUNK_CACHE_FOLDER, cache_key, CHUNK_CACHE_MAX_AGE_SECONDS)
+        if cached is not None:
+            results[i] = cached
+            _on_chunks_done()
+        else:
+            misses.append((i, chunk, cache_key))
+    if total:
+        print(f"Chunk cache: {total - len(misses)}/{total} chunks reused, {len(misses)} sent to the LLM")
+
+    # Small chunks are packed into batches here, so a bulk import makes one call per batch rather
+    # than per file; a batch of one goes through the cross-request batcher in _extract_and_cache_chunk
+    tasks = []
+    small = []
+    for miss in misses:
+        if EXTRACTION_BATCHING and llm_gateway.estimate_tokens(miss[1]) <= EXTRACTION_BATCH_SMALL_CHUNK_TOKENS:
+            small.append(miss)
+        else:
+            tasks.append([miss])
+    tasks.extend(_pack_extraction_batches(small, lambda miss: llm_gateway.estimate_tokens(miss[1])))
+
+    if len(tasks) <= 1 or INGEST_CHUNK_CONCURRENCY <= 1:
+        for task in tasks:
+            for i, chunk_data in zip((miss[0] for miss in task), _extract_and_cache_chunks(task)):
+                results[i] = chunk_data
+                _on_chunks_done()
+        return results
+
+    futures = []
+    for task in tasks:
+        future = _chunk_extraction_pool.submit(_extract_and_cache_chunks, task)
+        future.add_done_callback(lambda _future, count=len(task): _on_chunks_done(count))
+        futures.append((task, future))
+    for task, future in futures:
+        for i, chunk_data in zip((miss[0] for miss in task), future.result()):
+            results[i] = chunk_data
+    return results
+
+def _split_into_sentence_units(text, max_tokens):
+    """
+    Splits text into (sentence, starts_paragraph) units. Sentences longer than max_tokens
+    (tables, OCR noise without punctuation) are cut on word boundaries so every unit fits in a chunk.
+    """
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        starts_paragraph = True
+        for sentence in sent_tokenize(paragraph):
+            if llm_gateway.estimate_tokens(sentence) <= max_tokens:
+                pieces = [sentence]
+            else:
+                pieces, current = [], []
+                for word in sentence.split():
+                    if current and llm_gateway.estimate_tokens(" ".join(current + [word])) > max_tokens:
+                        pieces.append(" ".join(current))
+                        current = []
+                    current.append(word)
+                if current:
+                    pieces.append(" ".join(current))
+            for piece in pieces:
+                units.append((piece, starts_paragraph))
+                starts_paragraph = False
+    return units
+
+def _chunk_text_by_sentences(text, max_tokens=None, overlap_sentences=None):
+    """
+    Packs whole sentences (keeping paragraph breaks) into chunks of at most max_tokens estimated tokens.
+    Each chunk after the first starts with the last overlap_sentences sentences of the previous one.
+    Returns a list of (chunk_text, estimated_tokens).
+    """
+    max_tokens = max_tokens or EXTRACTION_CHUNK_TOKENS
+    overlap_sentences = EXTRACTION_CHUNK_OVERLAP_SENTENCES if overlap_sentences is None else overlap_sentences
+
+    def join_units(chunk_units):
+        parts = []
+        for i, (sentence, starts_paragraph) in enumerate(chunk_units):
+            if i > 0:
+                parts.append("\n\n" if starts_paragraph else " ")
+            parts.append(sentence)
+        return "".join(parts)
+
+    min_fill_tokens = int(max_tokens * EXTRACTION_CHUNK_MIN_FILL)
+
+    def start_next_chunk(previous, next_unit_tokens):
+        # Carry the overlap forward only if it leaves room for new material
+        overlap = previous[-overlap_sentences:] if overlap_sentences > 0 else []
+        overlap_tokens = sum(llm_gateway.estimate_tokens(sentence) + 1 for sentence, _ in overlap)
+        if overlap_tokens + next_unit_tokens > max_tokens or overlap_tokens > max_tokens // 4:
+            return [], 0
+        return list(overlap), overlap_tokens
 
-    # Chunk the text
     chunks = []
-    start = 0
-    while start < len(raw_text_content):
-        end = min(start + CHUNK_SIZE_CHARS, len(raw_text_content))
-        chunks.append(raw_text_content[start:end])
-        start = end - OVERLAP_CHARS # Move back by overlap amount
-        if start >= len(raw_text_content):
-            break
+    current, current_tokens = [], 0
+    new_material = False
+    for unit in _split_into_sentence_units(text, max_tokens):
+        unit_tokens = llm_gateway.estimate_tokens(unit[0]) + 1
+        if new_material and current_tokens + unit_tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = start_next_chunk(current, unit_tokens)
+        current.append(unit)
+        current_tokens += unit_tokens
+        new_material = True
+        is_anchor = zlib.crc32(unit[0].encode('utf-8')) % EXTRACTION_CHUNK_ANCHOR_MODULUS == 0
+        if is_anchor and current_tokens >= min_fill_tokens:
+            chunks.append(current)
+            current, current_tokens = start_next_chunk(current, 0)
+            new_material = False
+    if new_material:
+        chunks.append(current)
+
+    result = []
+    for chunk_units in chunks:
+        chunk_text = join_units(chunk_units)
+        result.append((chunk_text, llm_gateway.estimate_tokens(chunk_text)))
+    return result
+
+_CONTROL_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+
+def _normalize_extracted_text(text):
+    """
+    Cleans extracted/OCR text before chunking: NFKC unicode, no control characters (form feeds from PDFs),
+    single spaces, and at most one blank line between paragraphs.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    text = _CONTROL_CHARS_RE.sub("", text)
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+# Main text processing and compression stages of the ingestion pipeline
+def _process_and_compress_text(raw_text_content, file_id, progress_callback=None, metrics=None):
+    """
+    Runs the text stages of ingestion: normalize -> chunk -> LLM extract -> merge -> compress.
+    Stage timings and byte counts are recorded into metrics (see _ingest_stage).
+    Returns {"extracted_text", "structured_data", "compressed_text", "chunk_token_estimates", "failed_chunks"},
+    or None if there is no text to process. failed_chunks counts chunks whose extraction came back empty.
+    """
+    if metrics is None:
+        metrics = _new_ingest_metrics()
 
-    print(f"Processing {len(chunks)} chunks for file {file_id}")
+    prepared = _prepare_ingest_chunks(raw_text_content, file_id, metrics)
+    if not prepared:
+        return None # Return None if no content to process
+    text, chunks, chunk_token_estimates = prepared
 
-    # Process each chunk
-    for i, chunk in enumerate(chunks):
-        print(f"Processing chunk {i+1}/{len(chunks)}")
-        chunk_data = _extract_key_study_elements_from_chunk(chunk)
-        
-        # Merge chunk data into full data
-        for key in full_extracted_data:
-            full_extracted_data[key].extend(chunk_data.get(key, []))
-
-    # Remove duplicates while preserving order
-    for key in full_extracted_data:
-        seen = set()
-        unique_items = []
-        for item in full_extracted_data[key]:
-            if item not in seen:
-                seen.add(item)
-                unique_items.append(item)
-        full_extracted_data[key] = unique_items
-
-    # Apply NLTK compression
-    compressed_text = _nltk_compress_and_filter(full_extracted_data)
-    
-    # Save compressed data to file
-    compressed_filename = f"{file_id}_compressed.json"
-    compressed_file_path = os.path.join(COMPRESSED_DATA_FOLDER, compressed_filename)
-    
-    # Save both the structured data and the compressed text
-    save_data = {
+    print(f"Processing {len(chunks)} chunks for compression...")
+    with _ingest_stage(metrics, "llm_extract", sum(_byte_len(chunk) for chunk in chunks)) as stage:
+        chunk_results = _extract_chunks_concurrently(chunks, progress_callback)
+        stage["bytes_out"] = _byte_len(json.dumps(chunk_results))
+    return _finish_ingest_chunks(text, file_id, chunk_token_estimates, chunk_results, metrics)
+
+def _prepare_ingest_chunks(raw_text_content, file_id, metrics):
+    """normalize -> chunk. Returns (text, chunks, chunk_token_estimates), or None if there is no text."""
+    with _ingest_stage(metrics, "normalize", _byte_len(raw_text_content)) as stage:
+        text = _normalize_extracted_text(raw_text_content or "")
+        stage["bytes_out"] = _byte_len(text)
+
+    if not text:
+        return None
+
+    # Chunk the text on sentence boundaries, filling each chunk up to the token budget
+    with _ingest_stage(metrics, "chunk", _byte_len(text)) as stage:
+        token_chunks = _chunk_text_by_sentences(text)
+        chunks = [chunk for chunk, _ in token_chunks]
+        chunk_token_estimates = [tokens for _, tokens in token_chunks]
+        stage["bytes_out"] = sum(_byte_len(chunk) for chunk in chunks)
+    print(f"Chunk token estimates for file {file_id}: {chunk_token_estimates}")
+    return text, chunks, chunk_token_estimates
+
+def _finish_ingest_chunks(text, file_id, chunk_token_estimates, chunk_results, metrics):
+    """merge -> compress over the extraction results of one file; returns the _process_and_compress_text dict."""
+    # Failed extractions come back empty (see _extract_key_study_elements_from_chunk)
+    failed_chunks = sum(1 for chunk_data in chunk_results if not any(chunk_data.values()))
+    if failed_chunks:
+        print(f"{failed_chunks}/{len(chunk_results)} chunks of file {file_id} came back empty from extraction")
+
+    with _ingest_stage(metrics, "merge", metrics["stages"]["llm_extract"]["bytes_out"]) as stage:
+        aggregate = _new_study_aggregate()
+        for extracted_chunk_data in chunk_results:
+            _merge_study_elements(aggregate, extracted_chunk_data)
+        full_extracted_data = _study_aggregate_lists(aggregate)
+        stage["bytes_out"] = _byte_len(json.dumps(full_extracted_data))
+
+    with _ingest_stage(metrics, "compress", metrics["stages"]["merge"]["bytes_out"]) as stage:
+        compressed_string = _nltk_compress_and_filter(full_extracted_data)
+        stage["bytes_out"] = _byte_len(compressed_string)
+
+    return {
+        "extracted_text": text,
         "structured_data": full_extracted_data,
-        "compressed_text": compressed_text,
-        "original_length": len(raw_text_content),
-        "compressed_length": len(compressed_text)
+        "compressed_text": compressed_string,
+        "chunk_token_estimates": chunk_token_estimates,
+        "failed_chunks": failed_chunks
     }
-    
-    if write_compressed_data(save_data, compressed_file_path):
-        print(f"Compressed data saved to {compressed_file_path}")
-        return compressed_file_path
+
+# ==================== INGESTION CACHE ====================
+
+def _ingest_cache_key(content_hash, ocr_mode):
+    """Cache key for an uploaded document: content hash + OCR mode + extraction prompt version + model."""
+    return hashlib.sha256(f"{content_hash}:{ocr_mode}:{EXTRACTION_PROMPT_VERSION}:{EXTRACTION_MODEL}".encode('utf-8')).hexdigest()
+
+_disk_cache_last_evicted = {}
+
+def _disk_cache_get(folder, cache_key, max_age_seconds):
+    """Return the JSON entry stored under cache_key in folder, or None on a miss or expired entry."""
+    path = os.path.join(folder, f"{cache_key}.json")
+    try:
+        if time.time() - os.path.getmtime(path) > max_age_seconds:
+            os.remove(path)
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading cache entry {folder}/{cache_key}: {e}")
+        return None
+
+def _disk_cache_put(folder, cache_key, data, max_bytes, max_age_seconds):
+    """Store a JSON entry. Written to a temp file and renamed so other workers never see partial JSON."""
+    path = os.path.join(folder, f"{cache_key}.json")
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Error writing cache entry {folder}/{cache_key}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+
+    now = time.time()
+    if now - _disk_cache_last_evicted.get(folder, 0) >= DISK_CACHE_EVICT_INTERVAL_SECONDS:
+        _disk_cache_last_evicted[folder] = now
+        _disk_cache_evict(folder, max_bytes, max_age_seconds)
+
+def _disk_cache_evict(folder, max_bytes, max_age_seconds):
+    """Drop expired entries, then the oldest entries until the folder fits in max_bytes."""
+    now = time.time()
+    entries = []
+    try:
+        for entry in os.scandir(folder):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > max_age_seconds:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except Exception as e:
+        print(f"Error scanning cache folder {folder}: {e}")
+        return
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except FileNotFoundError:
+            pass
+
+def _ingest_cache_get(cache_key):
+    return _disk_cache_get(INGEST_CACHE_FOLDER, cache_key, INGEST_CACHE_MAX_AGE_SECONDS)
+
+def _ingest_cache_put(cache_key, data):
+    _disk_cache_put(INGEST_CACHE_FOLDER, cache_key, data, INGEST_CACHE_MAX_BYTES, INGEST_CACHE_MAX_AGE_SECONDS)
+
+def _chunk_cache_key(chunk_text):
+    """Cache key for one extraction chunk: whitespace-normalized text + extraction prompt version + model."""
+    normalized = " ".join(chunk_text.split())
+    return hashlib.sha256(f"{EXTRACTION_PROMPT_VERSION}:{EXTRACTION_MODEL}:{normalized}".encode('utf-8')).hexdigest()
+
+def _extract_and_cache_chunk(chunk_text, cache_key):
+    """Run LLM extraction for a chunk that missed the chunk cache and store the result."""
+    if EXTRACTION_BATCHING and llm_gateway.estimate_tokens(chunk_text) <= EXTRACTION_BATCH_SMALL_CHUNK_TOKENS:
+        chunk_data = _extract_study_elements_batched(chunk_text)
     else:
-        print(f"Failed to save compressed data")
+        chunk_data = _extract_key_study_elements_from_chunk(chunk_text)
+    _chunk_cache_put(cache_key, chunk_data)
+    return chunk_data
+
+def _extract_and_cache_chunks(misses):
+    """
+    Extraction for a list of (index, chunk_text, cache_key) chunk-cache misses: one chunk is handled by
+    _extract_and_cache_chunk, several (small ones, packed by _extract_chunks_concurrently) share one call.
+    Returns the results in order.
+    """
+    if len(misses) == 1:
+        _, chunk_text, cache_key = misses[0]
+        return [_extract_and_cache_chunk(chunk_text, cache_key)]
+    results = _extract_study_elements_batch([chunk_text for _, chunk_text, _ in misses])
+    for (_, _, cache_key), chunk_data in zip(misses, results):
+        _chunk_cache_put(cache_key, chunk_data)
+    return results
+
+def _chunk_cache_put(cache_key, chunk_data):
+    # Failed extractions come back empty; don't pin those in the cache
+    if any(chunk_data.get(key) for key in chunk_data):
+        _disk_cache_put(CHUNK_CACHE_FOLDER, cache_key, chunk_data, CHUNK_CACHE_MAX_BYTES, CHUNK_CACHE_MAX_AGE_SECONDS)
+
+def _byte_len(text):
+    return len(text.encode('utf-8')) if text else 0
+
+def _new_ingest_metrics():
+    return {"stages": {}, "total_ms": 0.0}
+
+@contextlib.contextmanager
+def _ingest_stage(metrics, name, bytes_in=0):
+    """
+    Times one ingestion stage and records {duration_ms, bytes_in, bytes_out} under metrics["stages"][name].
+    The block sets bytes_out on the yielded dict. Repeated stages accumulate into one record.
+    """
+    record = {"duration_ms": 0.0, "bytes_in": bytes_in, "bytes_out": 0}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["duration_ms"] = (time.perf_counter() - start) * 1000
+        existing = metrics["stages"].get(name)
+        if existing:
+            for key in record:
+                existing[key] += record[key]
+            existing["duration_ms"] = round(existing["duration_ms"], 2)
+        else:
+            record["duration_ms"] = round(record["duration_ms"], 2)
+            metrics["stages"][name] = record
+        metrics["total_ms"] = round(sum(stage["duration_ms"] for stage in metrics["stages"].values()), 2)
+
+def _log_ingest_metrics(filename, metrics):
+    summary = ", ".join(
+        f"{name} {stage['duration_ms']:.0f}ms {stage['bytes_in']}B->{stage['bytes_out']}B"
+        for name, stage in metrics["stages"].items()
+    )
+    print(f"Ingestion of {filename} took {metrics['total_ms']:.0f}ms: {summary}")
+
+def _run_ingestion_pipeline(file_bytes, filename, file_id, ocr_mode=None, progress_callback=None):
+    """
+    The single ingestion entry point for uploads:
+    cache lookup -> extract -> normalize -> chunk -> LLM extract -> merge -> compress -> persist (ingestion cache).
+    Callers that write to the database should do so inside _ingest_stage(result["metrics"], "persist")
+    so that cost lands in the same record.
+    progress_callback(stage, chunks_done, chunks_total) is called as work advances.
+
+    Always returns a dict with:
+      extracted_text, structured_data, compressed_text, chunk_token_estimates, failed_chunks, cache_hit, metrics,
+      error (None on success, otherwise a message; structured_data is then empty).
+    Results with failed chunks or no study elements are not stored in the ingestion cache, so a
+    transient extraction failure is retried on the next upload instead of being pinned to the file.
+    """
+    return _run_ingestion_pipelines([(file_bytes, filename, file_id)], ocr_mode, progress_callback)[0]
+
+def _run_ingestion_pipelines(files, ocr_mode=None, progress_callback=None):
+    """
+    _run_ingestion_pipeline for several (file_bytes, filename, file_id) uploads at once; returns one result
+    per file, in order. The chunks of every file that missed the ingestion cache go through a single
+    _extract_chunks_concurrently call, so small files share batched extraction requests; each file's
+    llm_extract stage records the duration of that shared call.
+    """
+    ocr_mode = _normalize_ocr_mode(ocr_mode)
+    results = []
+    pending = [] # (result, filename, file_id, cache_key, text, chunks, chunk_token_estimates)
+    for file_bytes, filename, file_id in files:
+        metrics = _new_ingest_metrics()
+        result = {
+            "extracted_text": "",
+            "structured_data": {"terms": [], "definitions": [], "examples": [], "questions": [], "answers": []},
+            "compressed_text": "",
+            "chunk_token_estimates": [],
+            "failed_chunks": 0,
+            "cache_hit": False,
+            "metrics": metrics,
+            "error": None
+        }
+        results.append(result)
+
+        with _ingest_stage(metrics, "cache_lookup", len(file_bytes)) as stage:
+            cache_key = _ingest_cache_key(hashlib.sha256(file_bytes).hexdigest(), ocr_mode)
+            cached = _ingest_cache_get(cache_key)
+            stage["bytes_out"] = _byte_len(json.dumps(cached)) if cached else 0
+        if cached:
+            print(f"Ingestion cache hit for {filename}")
+            result.update({
+                "extracted_text": cached.get("extracted_text", ""),
+                "structured_data": cached.get("structured_data", {}),
+                "compressed_text": cached.get("compressed_text", ""),
+                "chunk_token_estimates": cached.get("chunk_token_estimates", []),
+                "cache_hit": True
+            })
+            continue
+
+        if progress_callback:
+            progress_callback("extracting_text", 0, 0)
+        with _ingest_stage(metrics, "extract", len(file_bytes)) as stage:
+            raw_text = _extract_text_from_bytes(file_bytes, filename, ocr_mode=ocr_mode)
+            stage["bytes_out"] = _byte_len(raw_text)
+
+        prepared = _prepare_ingest_chunks(raw_text, file_id, metrics)
+        if not prepared:
+            result["extracted_text"] = raw_text
+            result["error"] = "No text could be extracted from the file"
+            continue
+        pending.append((result, filename, file_id, cache_key) + prepared)
+
+    if not pending:
+        return results
+
+    all_chunks = [chunk for entry in pending for chunk in entry[5]]
+    print(f"Processing {len(all_chunks)} chunks of {len(pending)} files for compression...")
+    chunk_progress = None
+    if progress_callback:
+        chunk_progress = lambda done, total: progress_callback("extracting_elements", done, total)
+    shared_metrics = _new_ingest_metrics()
+    with _ingest_stage(shared_metrics, "llm_extract"):
+        all_chunk_results = _extract_chunks_concurrently(all_chunks, chunk_progress)
+    extract_ms = shared_metrics["stages"]["llm_extract"]["duration_ms"]
+
+    offset = 0
+    for result, filename, file_id, cache_key, text, chunks, chunk_token_estimates in pending:
+        metrics = result["metrics"]
+        chunk_results = all_chunk_results[offset:offset + len(chunks)]
+        offset += len(chunks)
+        metrics["stages"]["llm_extract"] = {
+            "duration_ms": extract_ms,
+            "bytes_in": sum(_byte_len(chunk) for chunk in chunks),
+            "bytes_out": _byte_len(json.dumps(chunk_results))
+        }
+        result.update(_finish_ingest_chunks(text, file_id, chunk_token_estimates, chunk_results, metrics))
+
+        if result["failed_chunks"] or not any(result["structured_data"].values()):
+            print(f"Not caching ingestion of {filename}: {result['failed_chunks']} chunks failed extraction")
+            continue
+        cache_entry = {
+            "extracted_text": result["extracted_text"],
+            "structured_data": result["structured_data"],
+            "compressed_text": result["compressed_text"],
+            "chunk_token_estimates": result["chunk_token_estimates"]
+        }
+        with _ingest_stage(metrics, "persist") as stage:
+            _ingest_cache_put(cache_key, cache_entry)
+            stage["bytes_out"] = _byte_len(json.dumps(cache_entry))
+    return results
+
+# ==================== BACKGROUND INGESTION JOBS ====================
+
+def _ingest_jobs_db():
+    conn = sqlite3.connect(INGEST_JOBS_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _init_ingest_jobs_db():
+    try:
+        with _ingest_jobs_db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ingest_jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    filename TEXT,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    chunks_done INTEGER NOT NULL DEFAULT 0,
+                    chunks_total INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+    except Exception as e:
+        print(f"Error initializing ingestion jobs database: {e}")
+
+_init_ingest_jobs_db()
+
+def _create_ingest_job(user_email, kind, filename):
+    """Record a new queued job and return its id."""
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    with _ingest_jobs_db() as conn:
+        conn.execute(
+            "DELETE FROM ingest_jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?",
+            (now - INGEST_JOB_RETENTION_SECONDS,)
+        )
+        conn.execute(
+            "INSERT INTO ingest_jobs (id, user_id, kind, filename, status, stage, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'queued', 'queued', ?, ?)",
+            (job_id, user_email, kind, filename, now, now)
+        )
+    return job_id
+
+def _update_ingest_job(job_id, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    try:
+        with _ingest_jobs_db() as conn:
+            conn.execute(f"UPDATE ingest_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+    except Exception as e:
+        print(f"Error updating ingestion job {job_id}: {e}")
+
+def _get_ingest_job(job_id, user_email):
+    with _ingest_jobs_db() as conn:
+        row = conn.execute("SELECT * FROM ingest_jobs WHERE id = ? AND user_id = ?", (job_id, user_email)).fetchone()
+    return dict(row) if row else None
+
+def _run_ingest_job(job_id, ingest_func, *args):
+    """Worker-side wrapper: runs ingest_func with a progress callback and stores its (payload, status_code)."""
+    def report_progress(stage, chunks_done, chunks_total):
+        _update_ingest_job(job_id, stage=stage, chunks_done=chunks_done, chunks_total=chunks_total)
+
+    _update_ingest_job(job_id, status="running", stage="starting")
+    try:
+        payload, status_code = ingest_func(*args, progress_callback=report_progress)
+        if status_code < 400:
+            _update_ingest_job(job_id, status="succeeded", stage="done", result=json.dumps(payload))
+        else:
+            error = payload.get("error") or payload.get("message") or "Ingestion failed"
+            _update_ingest_job(job_id, status="failed", stage="done", result=json.dumps(payload), error=error)
+    except Exception as e:
+        print(f"Ingestion job {job_id} failed: {e}")
+        _update_ingest_job(job_id, status="failed", stage="done", error=str(e))
+
+def _wants_async_ingestion():
+    """Clients opt into background ingestion with async=true (form or query) or 'Prefer: respond-async'."""
+    flag = request.form.get("async") or request.args.get("async") or ""
+    return flag.lower() in ("1", "true", "yes") or "respond-async" in request.headers.get("Prefer", "")
+
+def _requested_ocr_mode():
+    """ocr_mode from the form or query string; None if the value is not a known mode."""
+    ocr_mode = (request.form.get("ocr_mode") or request.args.get("ocr_mode") or OCR_DEFAULT_MODE).lower()
+    return ocr_mode if ocr_mode in OCR_MODES else None
+
+def _enqueue_ingest_job(user_email, kind, filename, ingest_func, *args):
+    """Queue ingest_func on the job pool and return the 202 Accepted response for it."""
+    job_id = _create_ingest_job(user_email, kind, filename)
+    _ingest_job_pool.submit(_run_ingest_job, job_id, ingest_func, *args)
+    status_url = f"/api/jobs/{job_id}"
+    response = jsonify({"success": True, "job_id": job_id, "status": "queued", "status_url": status_url})
+    response.headers["Location"] = status_url
+    return response, 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_jobs_get(job_id):
+    """Report status and per-chunk progress of a background ingestion job owned by the user."""
+    user_email = get_authenticated_user()
+    if not user_email:
+        return jsonify({"success": False, "message": "Unauthorized"}), 401
+    try:
+        job = _get_ingest_job(job_id, user_email)
+    except Exception as e:
+        print(f"Error fetching ingestion job: {e}")
+        return jsonify({"success": False, "message": str(e)}), 500
+    if not job:
+        return jsonify({"success": False, "message": "Not found"}), 404
+
+    status = job["status"]
+    error = job["error"]
+    if status in ("queued", "running") and time.time() - job["updated_at"] > INGEST_JOB_STALE_SECONDS:
+        status = "failed"
+        error = "Job stalled; the worker processing it may have restarted. Please upload the file again."
+
+    chunks_done, chunks_total = job["chunks_done"], job["chunks_total"]
+    return jsonify({
+        "success": True,
+        "job": {
+            "id": job["id"],
+            "kind": job["kind"],
+            "filename": job["filename"],
+            "status": status,
+            "stage": job["stage"],
+            "progress": {
+                "chunks_done": chunks_done,
+                "chunks_total": chunks_total,
+                "percent": round(100 * chunks_done / chunks_total, 1) if chunks_total else (100.0 if status == "succeeded" else 0.0)
+            },
+            "result": json.loads(job["result"]) if job["result"] else None,
+            "error": error,
+            "created_at": datetime.fromtimestamp(job["created_at"]).isoformat(),
+            "updated_at": datetime.fromtimestamp(job["updated_at"]).isoformat()
+        }
+    }), 200
+
+# ==================== STUDY CONTEXT ====================
+# The generate endpoints work from the merge of the user's files' structured study elements plus its
+# NLTK compressed form. Both are materialized in local SQLite: each file's contribution is stored once,
+# and an aggregate per scope (all of the user's files, and each project) keeps a per-item count of
+# contributing files, so deleting a file only decrements its items and the compressed context is
+# rebuilt only when an aggregate changes. Requests scoped to explicit file ids merge just those files'
+# stored contributions. Imports and deletes through this host update the store directly; reads
+# reconcile a scope against file_imports ids at most every STUDY_CONTEXT_RECONCILE_SECONDS, so rows
+# written or deleted by other hosts are picked up within that interval without listing ids on every call.
+
+STUDY_SCOPE_ALL = ""
+STUDY_CONTEXT_RECONCILE_SECONDS = int(os.environ.get("STUDY_CONTEXT_RECONCILE_SECONDS", 60))
+
+def _study_context_db():
+    conn = sqlite3.connect(STUDY_CONTEXT_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _init_study_context_db():
+    try:
+        with _study_context_db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS study_context_files (
+                    user_id TEXT NOT NULL,
+                    file_id INTEGER NOT NULL,
+                    project_id TEXT,
+                    structured_data TEXT NOT NULL,
+                    PRIMARY KEY (user_id, file_id)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS study_context_aggregates (
+                    user_id TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    item_counts TEXT NOT NULL,
+                    compressed_context TEXT NOT NULL,
+                    file_count INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    reconciled_at REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, scope)
+                )
+                """
+            )
+    except Exception as e:
+        print(f"Error initializing study context database: {e}")
+
+_init_study_context_db()
+
+def _study_project_scope(project_id):
+    return f"project:{project_id or ''}"
+
+def _structured_data_from_blob(compressed_text):
+    """Study elements of one file_imports.compressed_text blob (current or legacy JSON format), deduplicated."""
+    try:
+        parsed = json.loads(compressed_text) if compressed_text else None
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(parsed, dict):
+        return None
+    structured = parsed.get("structured_data", parsed)
+    if not isinstance(structured, dict):
         return None
+    return _study_aggregate_lists(_merge_study_elements(_new_study_aggregate(), structured))
+
+def _file_import_structured_data(row):
+    """Study elements of a file_imports row: its structured_data column, or the legacy compressed_text blob."""
+    structured = row.get("structured_data")
+    if isinstance(structured, str):
+        return _structured_data_from_blob(structured)
+    if isinstance(structured, dict):
+        return _study_aggregate_lists(_merge_study_elements(_new_study_aggregate(), structured))
+    return _structured_data_from_blob(row.get("compressed_text"))
+
+def _scope_file_filter(scope):
+    if scope == STUDY_SCOPE_ALL:
+        return "", ()
+    return " AND project_id = ?", (scope[len("project:"):],)
+
+def _load_study_aggregate(conn, user_email, scope):
+    """The stored aggregate for scope, or one rebuilt from the stored file contributions in that scope."""
+    row = conn.execute(
+        "SELECT item_counts FROM study_context_aggregates WHERE user_id = ? AND scope = ?", (user_email, scope)
+    ).fetchone()
+    if row:
+        return _new_study_aggregate(json.loads(row["item_counts"]))
+    clause, params = _scope_file_filter(scope)
+    aggregate = _new_study_aggregate()
+    for file_row in conn.execute(
+        f"SELECT structured_data FROM study_context_files WHERE user_id = ?{clause}", (user_email, *params)
+    ):
+        _merge_study_elements(aggregate, json.loads(file_row["structured_data"]))
+    return aggregate
+
+def _save_study_aggregate(conn, user_email, scope, aggregate):
+    compressed_context = _nltk_compress_and_filter(_study_aggregate_lists(aggregate))
+    clause, params = _scope_file_filter(scope)
+    file_count = conn.execute(
+        f"SELECT COUNT(*) FROM study_context_files WHERE user_id = ?{clause}", (user_email, *params)
+    ).fetchone()[0]
+    # Upsert rather than replace so reconciled_at survives local updates
+    conn.execute(
+        "INSERT INTO study_context_aggregates (user_id, scope, item_counts, compressed_context, file_count, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, scope) DO UPDATE SET item_counts = excluded.item_counts, "
+        "compressed_context = excluded.compressed_context, file_count = excluded.file_count, updated_at = excluded.updated_at",
+        (user_email, scope, json.dumps(aggregate), compressed_context, file_count, time.time())
+    )
+
+def _update_study_context(user_email, added=(), removed_ids=(), scopes=()):
+    """
+    added: (file_id, project_id, elements) tuples; removed_ids: file ids; scopes: aggregates to
+    (re)build even if untouched. Every affected aggregate (all files + each touched project) is updated
+    in one write transaction, so concurrent uploads do not lose each other's items.
+    """
+    with _study_context_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        added_files = []
+        for file_id, project_id, elements in added:
+            if not conn.execute(
+                "SELECT 1 FROM study_context_files WHERE user_id = ? AND file_id = ?", (user_email, file_id)
+            ).fetchone():
+                # Files without usable study elements are still recorded so they are not refetched
+                added_files.append((file_id, project_id or "", elements or _study_aggregate_lists(_new_study_aggregate())))
+        removed_files = []
+        for file_id in removed_ids:
+            row = conn.execute(
+                "SELECT project_id, structured_data FROM study_context_files WHERE user_id = ? AND file_id = ?",
+                (user_email, file_id)
+            ).fetchone()
+            if row:
+                removed_files.append((file_id, row["project_id"] or "", json.loads(row["structured_data"])))
+
+        # Aggregates are loaded before the file rows change so a rebuilt one is not counted twice
+        touched = {STUDY_SCOPE_ALL, *scopes}
+        touched.update(_study_project_scope(project_id) for _, project_id, _ in added_files + removed_files)
+        aggregates = {scope: _load_study_aggregate(conn, user_email, scope) for scope in touched}
+
+        for file_id, project_id, elements in removed_files:
+            conn.execute("DELETE FROM study_context_files WHERE user_id = ? AND file_id = ?", (user_email, file_id))
+            _unindex_study_file(conn, user_email, file_id)
+            for scope in (STUDY_SCOPE_ALL, _study_project_scope(project_id)):
+                _merge_study_elements(aggregates[scope], elements, -1)
+        for file_id, project_id, elements in added_files:
+            conn.execute(
+                "INSERT INTO study_context_files (user_id, file_id, project_id, structured_data) VALUES (?, ?, ?, ?)",
+                (user_email, file_id, project_id, json.dumps(elements))
+            )
+            _index_study_file(conn, user_email, file_id, project_id, elements)
+            for scope in (STUDY_SCOPE_ALL, _study_project_scope(project_id)):
+                _merge_study_elements(aggregates[scope], elements)
+        for scope, aggregate in aggregates.items():
+            _save_study_aggregate(conn, user_email, scope, aggregate)
+
+def _study_context_file_added(user_email, row):
+    """Called with the inserted file_imports row; failures only mean the next read reconciles instead."""
+    if not row or row.get("id") is None:
+        return
+    try:
+        _update_study_context(user_email, added=[(row["id"], row.get("project_id"), _file_import_structured_data(row))])
+    except Exception as e:
+        print(f"Error updating study context for {user_email}: {e}")
+
+def _study_context_file_removed(user_email, file_id):
+    try:
+        _update_study_context(user_email, removed_ids=[file_id])
+    except Exception as e:
+        print(f"Error updating study context for {user_email}: {e}")
+
+def _study_scope_from_request(data):
+    """
+    Optional scope of a generate request: "project_id" and/or "file_ids" (a list of file_imports ids).
+    Returns (project_id, file_ids) with None for unset parts; raises ValueError for malformed file_ids.
+    """
+    project_id = data.get("project_id") or None
+    file_ids = data.get("file_ids")
+    if file_ids is None:
+        return project_id, None
+    if not isinstance(file_ids, list):
+        raise ValueError("file_ids must be a list of file ids")
+    try:
+        return project_id, [int(file_id) for file_id in file_ids]
+    except (TypeError, ValueError):
+        raise ValueError("file_ids must be a list of file ids")
+
+def _get_study_context(user_email, project_id=None, file_ids=None, include_lists=False):
+    """
+    Returns {"compressed_context", "file_count"} for the user's files, optionally limited to one project
+    and/or explicit file ids, plus the merged "structured_data" lists when include_lists is set.
+    A project or all-files scope reconciled within STUDY_CONTEXT_RECONCILE_SECONDS is answered from the
+    local store alone. Otherwise the scope is pushed into the file_imports id query; structured_data is
+    fetched only for in-scope files not yet materialized, and in-scope files that no longer exist are
+    dropped. Raises if Supabase cannot be reached.
+    """
+    scope = STUDY_SCOPE_ALL if project_id is None else _study_project_scope(project_id)
+    if file_ids is None:
+        context = _read_study_aggregate(user_email, scope, include_lists, STUDY_CONTEXT_RECONCILE_SECONDS)
+        if context is not None:
+            return context
+
+    query = supabase.table('file_imports').select('id,project_id').eq('user_id', user_email)
+    if project_id is not None:
+        query = query.eq('project_id', project_id)
+    if file_ids is not None:
+        if not file_ids:
+            context = {"compressed_context": "", "file_count": 0}
+            if include_lists:
+                context["structured_data"] = _study_aggregate_lists(_new_study_aggregate())
+            return context
+        query = query.in_('id', file_ids)
+    current_ids = {row["id"]: row.get("project_id") for row in query.execute().data or []}
+
+    clause, params = _scope_file_filter(scope)
+    with _study_context_db() as conn:
+        known_ids = {row["file_id"] for row in conn.execute(
+            f"SELECT file_id FROM study_context_files WHERE user_id = ?{clause}", (user_email, *params)
+        )}
+        has_aggregate = conn.execute(
+            "SELECT 1 FROM study_context_aggregates WHERE user_id = ? AND scope = ?", (user_email, scope)
+        ).fetchone() is not None
+
+    if file_ids is not None:
+        # Only the requested ids were listed, so only they can be judged missing or deleted
+        known_ids &= set(file_ids)
+        has_aggregate = True
+    missing_ids = [file_id for file_id in current_ids if file_id not in known_ids]
+    removed_ids = [file_id for file_id in known_ids if file_id not in current_ids]
+    if missing_ids or removed_ids or not has_aggregate:
+        added = []
+        if missing_ids:
+            fetched = supabase.table('file_imports').select('id,structured_data').eq('user_id', user_email).in_('id', missing_ids).execute()
+            rows = fetched.data or []
+            # Rows written before the payload was split only have the compressed_text blob
+            legacy_ids = [row["id"] for row in rows if row.get("structured_data") is None]
+            if legacy_ids:
+                legacy = supabase.table('file_imports').select('id,compressed_text').eq('user_id', user_email).in_('id', legacy_ids).execute()
+                rows = [row for row in rows if row.get("structured_data") is not None] + (legacy.data or [])
+            added = [(row["id"], current_ids.get(row["id"]), _file_import_structured_data(row)) for row in rows]
+        _update_study_context(user_email, added=added, removed_ids=removed_ids, scopes=[scope])
+        print(f"Study context for {user_email} ({scope or 'all files'}) reconciled: +{len(added)} -{len(removed_ids)} files")
+    if file_ids is None:
+        with _study_context_db() as conn:
+            conn.execute(
+                "UPDATE study_context_aggregates SET reconciled_at = ? WHERE user_id = ? AND scope = ?",
+                (time.time(), user_email, scope)
+            )
+
+    if file_ids is not None:
+        # Ad-hoc file selections are merged from the stored contributions rather than materialized
+        aggregate = _new_study_aggregate()
+        selected = list(current_ids)
+        with _study_context_db() as conn:
+            rows = conn.execute(
+                f"SELECT structured_data FROM study_context_files WHERE user_id = ? AND file_id IN ({','.join('?' * len(selected))})",
+                (user_email, *selected)
+            ).fetchall() if selected else []
+        for row in rows:
+            _merge_study_elements(aggregate, json.loads(row["structured_data"]))
+        structured_data = _study_aggregate_lists(aggregate)
+        context = {
+            "compressed_context": _nltk_compress_and_filter(structured_data) if rows else "",
+            "file_count": len(rows)
+        }
+        if include_lists:
+            context["structured_data"] = structured_data
+        return context
+
+    return _read_study_aggregate(user_email, scope, include_lists)
+
+def _read_study_aggregate(user_email, scope, include_lists, max_age_seconds=None):
+    """
+    The stored context of scope, reading item_counts only when include_lists is set. With max_age_seconds,
+    returns None if the scope has no aggregate or was last reconciled longer ago than that.
+    """
+    columns = "compressed_context, file_count, reconciled_at" + (", item_counts" if include_lists else "")
+    with _study_context_db() as conn:
+        row = conn.execute(
+            f"SELECT {columns} FROM study_context_aggregates WHERE user_id = ? AND scope = ?", (user_email, scope)
+        ).fetchone()
+    if max_age_seconds is not None and (row is None or time.time() - row["reconciled_at"] >= max_age_seconds):
+        return None
+    context = {
+        "compressed_context": row["compressed_context"] if row else "",
+        "file_count": row["file_count"] if row else 0
+    }
+    if include_lists:
+        context["structured_data"] = _study_aggregate_lists(_new_study_aggregate(json.loads(row["item_counts"]) if row else None))
+    return context
+
+# ==================== STUDY ELEMENT SEARCH ====================
+# A BM25 index over each user's study elements (terms, definitions, examples, questions and answers), stored in
+# the study context database next to the per-file contributions it is built from and updated in the
+# same transactions. Topic-driven endpoints put the top-ranked elements in the prompt instead of
+# whatever _nltk_compress_and_filter kept first. Files materialized before the index existed are
+# indexed on first search.
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+STUDY_SEARCH_NOTES_TOP_K = int(os.environ.get("STUDY_SEARCH_NOTES_TOP_K", 40))
+STUDY_SEARCH_AUTOFILL_TOP_K = int(os.environ.get("STUDY_SEARCH_AUTOFILL_TOP_K", 12))
+STUDY_ELEMENT_LABELS = {"term": "Term: ", "definition": "Definition: ", "example": "Example: ", "question": "Q: ", "answer": "A: "}
+
+_search_stop_words = None
+
+def _init_study_index_db():
+    try:
+        with _study_context_db() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS study_index_elements (
+                    element_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    file_id INTEGER NOT NULL,
+                    project_id TEXT,
+                    kind TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    length INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS study_index_elements_file ON study_index_elements (user_id, file_id)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS study_index_postings (
+                    user_id TEXT NOT NULL,
+                    token TEXT NOT NULL,
+                    element_id INTEGER NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, token, element_id)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS study_index_postings_element ON study_index_postings (element_id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS study_index_files (user_id TEXT NOT NULL, file_id INTEGER NOT NULL, PRIMARY KEY (user_id, file_id))"
+            )
+    except Exception as e:
+        print(f"Error initializing study index database: {e}")
+
+_init_study_index_db()
+
+def _search_tokens(text):
+    """Lowercased alphanumeric tokens without stop words; a trailing plural 's' is dropped."""
+    global _search_stop_words
+    if _search_stop_words is None:
+        try:
+            _search_stop_words = frozenset(stopwords.words('english'))
+        except LookupError:
+            _search_stop_words = frozenset()
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", text.lower()):
+        if token in _search_stop_words:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+def _study_file_elements(elements):
+    """
+    (kind, text) pairs indexed for one file's study elements. Questions and answers are indexed separately:
+    each category is deduplicated on its own, so their positions no longer line up.
+    """
+    pairs = [("term", text) for text in elements.get("terms", [])]
+    pairs += [("definition", text) for text in elements.get("definitions", [])]
+    pairs += [("example", text) for text in elements.get("examples", [])]
+    pairs += [("question", text) for text in elements.get("questions", [])]
+    pairs += [("answer", text) for text in elements.get("answers", [])]
+    return pairs
+
+def _index_study_file(conn, user_email, file_id, project_id, elements):
+    for kind, text in _study_file_elements(elements):
+        tokens = _search_tokens(text)
+        if not tokens:
+            continue
+        cursor = conn.execute(
+            "INSERT INTO study_index_elements (user_id, file_id, project_id, kind, text, length) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_email, file_id, project_id or "", kind, text, len(tokens))
+        )
+        conn.executemany(
+            "INSERT INTO study_index_postings (user_id, token, element_id, tf) VALUES (?, ?, ?, ?)",
+            [(user_email, token, cursor.lastrowid, tf) for token, tf in collections.Counter(tokens).items()]
+        )
+    conn.execute("INSERT OR IGNORE INTO study_index_files (user_id, file_id) VALUES (?, ?)", (user_email, file_id))
+
+def _unindex_study_file(conn, user_email, file_id):
+    conn.execute(
+        "DELETE FROM study_index_postings WHERE element_id IN "
+        "(SELECT element_id FROM study_index_elements WHERE user_id = ? AND file_id = ?)", (user_email, file_id)
+    )
+    conn.execute("DELETE FROM study_index_elements WHERE user_id = ? AND file_id = ?", (user_email, file_id))
+    conn.execute("DELETE FROM study_index_files WHERE user_id = ? AND file_id = ?", (user_email, file_id))
+
+def _backfill_study_index(user_email):
+    unindexed = (
+        "SELECT f.file_id, f.project_id, f.structured_data FROM study_context_files f WHERE f.user_id = ? "
+        "AND NOT EXISTS (SELECT 1 FROM study_index_files i WHERE i.user_id = f.user_id AND i.file_id = f.file_id)"
+    )
+    with _study_context_db() as conn:
+        if not conn.execute(unindexed + " LIMIT 1", (user_email,)).fetchone():
+            return
+        # Re-read under the write lock so concurrent searches do not index the same file twice
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(unindexed, (user_email,)).fetchall()
+        for row in rows:
+            _index_study_file(conn, user_email, row["file_id"], row["project_id"], json.loads(row["structured_data"]))
+    if rows:
+        print(f"Indexed {len(rows)} previously materialized files for {user_email}")
+
+def _search_study_elements(user_email, query, top_k, project_id=None, file_ids=None):
+    """
+    Top-k study elements for query by BM25 over the user's indexed files (optionally one project and/or
+    selected file ids), as (kind, text) pairs, best first, without repeats. Call after _get_study_context
+    so the index covers the current files.
+    """
+    tokens = list(dict.fromkeys(_search_tokens(query or "")))
+    if not tokens or top_k <= 0:
+        return []
+    _backfill_study_index(user_email)
+
+    scope_clause, scope_params = "", []
+    if project_id is not None:
+        scope_clause += " AND e.project_id = ?"
+        scope_params.append(project_id)
+    if file_ids is not None:
+        if not file_ids:
+            return []
+        scope_clause += f" AND e.file_id IN ({','.join('?' * len(file_ids))})"
+        scope_params.extend(file_ids)
+
+    with _study_context_db() as conn:
+        element_count, average_length = conn.execute(
+            f"SELECT COUNT(*), AVG(e.length) FROM study_index_elements e WHERE e.user_id = ?{scope_clause}",
+            (user_email, *scope_params)
+        ).fetchone()
+        if not element_count:
+            return []
+        postings = conn.execute(
+            "SELECT p.token, p.element_id, p.tf, e.length FROM study_index_postings p "
+            "JOIN study_index_elements e ON e.element_id = p.element_id "
+            f"WHERE p.user_id = ? AND p.token IN ({','.join('?' * len(tokens))}){scope_clause}",
+            (user_email, *tokens, *scope_params)
+        ).fetchall()
+
+        document_frequency = collections.Counter(row["token"] for row in postings)
+        scores = collections.defaultdict(float)
+        for row in postings:
+            df = document_frequency[row["token"]]
+            idf = math.log(1 + (element_count - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * row["length"] / average_length)
+            scores[row["element_id"]] += idf * row["tf"] * (BM25_K1 + 1) / (row["tf"] + norm)
+
+        # Over-fetch: the same element text may be indexed once per file that contains it
+        best = heapq.nlargest(top_k * 2, scores.items(), key=lambda item: item[1])
+        if not best:
+            return []
+        texts = {row["element_id"]: (row["kind"], row["text"]) for row in conn.execute(
+            f"SELECT element_id, kind, text FROM study_index_elements WHERE element_id IN ({','.join('?' * len(best))})",
+            [element_id for element_id, _ in best]
+        )}
+    results = list(dict.fromkeys(texts[element_id] for element_id, _ in best if element_id in texts))
+    return results[:top_k]
+
+def _format_study_elements(elements):
+    return "\n".join(STUDY_ELEMENT_LABELS.get(kind, "") + text for kind, text in elements)
+
+def _topic_study_context(user_email, topic, top_k, study_context, project_id=None, file_ids=None):
+    """The top_k elements most relevant to topic, or the compressed overview when none match."""
+    try:
+        relevant = _search_study_elements(user_email, topic, top_k, project_id, file_ids)
+    except Exception as e:
+        print(f"Error searching study elements for {user_email}: {e}")
+        relevant = []
+    if relevant:
+        return _format_study_elements(relevant)
+    return study_context["compressed_context"]
 
 # ==================== FILE IMPORTS (DB) API ====================
+# A file's processed payload lives in separately selectable file_imports columns (see
+# migrations/001_split_file_imports_payload.sql): extracted_text (raw text, large), structured_data
+# (study elements), summary_text (compressed text) and metadata. Rows written before the split keep
+# everything in the compressed_text JSON blob, which readers fall back to when the columns are empty.
+
+# Listing a user's files never needs the payload columns
+FILE_IMPORT_LIST_COLUMNS = "id,user_id,project_id,filename,text_length,created_at"
 
-def _insert_file_import_record(user_email: str, project_id: str, filename: str, compressed_text: str, text_length: int):
+def _file_import_columns(result, extracted_text=None, metadata=None):
+    """Payload columns of a file_imports insert for an ingestion pipeline result."""
+    return {
+        "extracted_text": extracted_text,
+        "structured_data": result["structured_data"],
+        "summary_text": result["compressed_text"],
+        "metadata": metadata,
+    }
+
+def _legacy_summary_text(compressed_text):
+    """Compressed text held in a legacy compressed_text blob (a raw, non-JSON blob is the text itself)."""
+    try:
+        parsed = json.loads(compressed_text)
+    except (TypeError, ValueError):
+        return compressed_text or ""
+    if isinstance(parsed, dict) and isinstance(parsed.get("compressed_text"), str):
+        return parsed["compressed_text"]
+    return ""
+
+def _file_import_summaries(user_email, file_ids):
+    """{str(file_id): summary_text} for the user's files among file_ids; only legacy rows fetch their blob."""
+    if not file_ids:
+        return {}
+    res = supabase.table('file_imports').select('id,summary_text').eq('user_id', user_email).in_('id', list(file_ids)).execute()
+    rows = res.data or []
+    summaries = {str(row["id"]): row.get("summary_text") for row in rows}
+    legacy_ids = [row["id"] for row in rows if row.get("summary_text") is None]
+    if legacy_ids:
+        legacy = supabase.table('file_imports').select('id,compressed_text').eq('user_id', user_email).in_('id', legacy_ids).execute()
+        for row in legacy.data or []:
+            summaries[str(row["id"])] = _legacy_summary_text(row.get("compressed_text"))
+    return summaries
+
+def _insert_file_import_record(user_email: str, project_id: str, filename: str, columns: dict, text_length: int):
     """Helper to insert a record into file_imports and return inserted row or None."""
     try:
         payload = {
             "user_id": user_email,            # References users.email
             "project_id": project_id or "",   # Text column, default empty
             "filename": filename,
-            "compressed_text": compressed_text,
+            **columns,
             "text_length": int(text_length),
             "created_at": datetime.now().isoformat()
         }
@@ -485,15 +2032,18 @@ def _serialize_file_import_row(row: dict):
         "filename": row.get("filename"),
         "text_length": row.get("text_length"),
         "created_at": row.get("created_at"),
-        # Do not include compressed_text by default to avoid large payloads
+        # Payload columns are never included to avoid large responses
     }
 
 @app.route('/api/files', methods=['POST'])
 def api_files_upload():
     """
-    Upload a file, extract and compress, and persist compressed_text into file_imports.
-    Request: multipart/form-data with fields: file (required), project_id (optional)
+    Upload a file, extract and compress, and persist the processed payload into file_imports.
+    Request: multipart/form-data with fields: file (required), project_id (optional), async (optional),
+             ocr_mode (optional, fast|accurate)
     Response: { success, file: {id, name, text_length, created_at}, extracted_text_path, compressed_file_path }
+    With async=true the file is processed in the background and the response is
+    202 { success, job_id, status, status_url }; poll /api/jobs/<job_id> for progress and the result.
     """
     user_email = get_authenticated_user()
     if not user_email:
@@ -507,57 +2057,96 @@ def api_files_upload():
         return jsonify({"success": False, "message": "No selected file"}), 400
 
     project_id = request.form.get('project_id', '')
+    ocr_mode = _requested_ocr_mode()
+    if not ocr_mode:
+        return jsonify({"success": False, "message": f"ocr_mode must be one of: {', '.join(OCR_MODES)}"}), 400
 
-    # Save original file
-    original_save_path = os.path.join(UPLOAD_FOLDER, f.filename)
+    # Read the upload once; everything downstream works on these bytes
     try:
-        f.save(original_save_path)
+        file_bytes = f.read()
     except Exception as e:
-        return jsonify({"success": False, "message": f"Failed saving file: {e}"}), 500
+        return jsonify({"success": False, "message": f"Failed reading file: {e}"}), 500
 
-    # Extract and compress using existing pipeline
-    extracted_text = _extract_text_from_file(original_save_path)
-    file_uuid = str(uuid.uuid4())
-
-    extracted_filename = f"{file_uuid}_extracted.txt"
-    extracted_file_path = os.path.join(EXTRACTED_TEXT_FOLDER, extracted_filename)
-    try:
-        with open(extracted_file_path, 'w', encoding='utf-8') as ef:
-            ef.write(extracted_text)
-    except Exception as e:
-        print(f"Error writing extracted text: {e}")
+    if _wants_async_ingestion():
+        return _enqueue_ingest_job(user_email, "api_files", f.filename, _ingest_api_file, user_email, project_id, f.filename, file_bytes, ocr_mode)
 
-    compressed_file_path = _process_and_compress_text(extracted_text, file_uuid)
+    payload, status_code = _ingest_api_file(user_email, project_id, f.filename, file_bytes, ocr_mode)
+    return jsonify(payload), status_code
 
-    # Read compressed JSON and serialize as text for DB storage
-    compressed_text_str = ""
+def _ingest_api_file(user_email, project_id, filename, file_bytes, ocr_mode=None, progress_callback=None):
+    """Extract, compress and record a file uploaded to api_files_upload. Returns (payload, status_code)."""
+    # Extract and compress using the ingestion pipeline (cached by file content)
+    file_uuid = str(uuid.uuid4())
     try:
-        if compressed_file_path and os.path.exists(compressed_file_path):
-            with open(compressed_file_path, 'r', encoding='utf-8') as cf:
-                # Store the JSON string representation in DB
-                compressed_text_str = cf.read()
-    except Exception as e:
-        print(f"Error reading compressed file for DB storage: {e}")
-
-    # Insert into file_imports
-    inserted = _insert_file_import_record(
-        user_email=user_email,
-        project_id=project_id,
-        filename=f.filename,
-        compressed_text=compressed_text_str,
-        text_length=len(compressed_text_str) if compressed_text_str else len(extracted_text or "")
-    )
+        result = _run_ingestion_pipeline(file_bytes, filename, file_uuid, ocr_mode, progress_callback)
+    except LLMOverloadedError as e:
+        return {"success": False, "message": "AI service is busy, please retry shortly", "retry_after": round(e.retry_after, 1)}, 503
+    extracted_text = result["extracted_text"]
+
+    columns = {}
+    save_data = None
+    if not result["error"]:
+        metadata = {
+            "original_length": len(extracted_text),
+            "compressed_length": len(result["compressed_text"])
+        }
+        save_data = {"structured_data": result["structured_data"], "compressed_text": result["compressed_text"], **metadata}
+        columns = _file_import_columns(result, metadata=metadata)
+    persisted_bytes = _byte_len(json.dumps(columns)) if columns else 0
+
+    with _ingest_stage(result["metrics"], "persist", persisted_bytes) as stage:
+        # Artifacts on disk are only written when explicitly enabled
+        extracted_file_path = None
+        compressed_file_path = None
+        if PERSIST_INGEST_ARTIFACTS:
+            extracted_file_path, compressed_file_path = _persist_ingest_artifacts(file_uuid, filename, file_bytes, extracted_text, save_data)
+
+        # Insert into file_imports
+        inserted = _insert_file_import_record(
+            user_email=user_email,
+            project_id=project_id,
+            filename=filename,
+            columns=columns,
+            text_length=len(extracted_text or "")
+        )
+        stage["bytes_out"] = persisted_bytes if inserted else 0
+    _log_ingest_metrics(filename, result["metrics"])
+    _study_context_file_added(user_email, inserted)
 
     if not inserted:
-        return jsonify({"success": False, "message": "Failed to save record to database"}), 500
+        return {"success": False, "message": "Failed to save record to database"}, 500
 
-    return jsonify({
+    return {
         "success": True,
         "file": _serialize_file_import_row(inserted),
-        # Return paths for compatibility with existing flows
+        # Paths are null unless PERSIST_INGEST_ARTIFACTS is enabled
         "extracted_text_path": extracted_file_path,
-        "compressed_file_path": compressed_file_path
-    }), 200
+        "compressed_file_path": compressed_file_path,
+        "metrics": result["metrics"]
+    }, 200
+
+def _persist_ingest_artifacts(file_uuid, filename, file_bytes, extracted_text, save_data):
+    """Write the original upload, extracted text and compressed JSON to disk. Returns (extracted_path, compressed_path)."""
+    try:
+        with open(os.path.join(UPLOAD_FOLDER, f"{file_uuid}_{os.path.basename(filename)}"), 'wb') as of:
+            of.write(file_bytes)
+    except Exception as e:
+        print(f"Error writing original upload: {e}")
+
+    extracted_file_path = os.path.join(EXTRACTED_TEXT_FOLDER, f"{file_uuid}_extracted.txt")
+    try:
+        with open(extracted_file_path, 'w', encoding='utf-8') as ef:
+            ef.write(extracted_text)
+    except Exception as e:
+        print(f"Error writing extracted text: {e}")
+        extracted_file_path = None
+
+    compressed_file_path = None
+    if save_data is not None:
+        compressed_file_path = os.path.join(COMPRESSED_DATA_FOLDER, f"{file_uuid}_compressed.json")
+        if not write_compressed_data(save_data, compressed_file_path):
+            compressed_file_path = None
+    return extracted_file_path, compressed_file_path
 
 @app.route('/api/files', methods=['GET'])
 def api_files_list():
@@ -571,7 +2160,7 @@ def api_files_list():
 
     project_id = request.args.get('project_id')
     try:
-        query = supabase.table('file_imports').select('*').eq('user_id', user_email)
+        query = supabase.table('file_imports').select(FILE_IMPORT_LIST_COLUMNS).eq('user_id', user_email)
         if project_id is not None:
             query = query.eq('project_id', project_id)
         # Order by created_at desc (matches index)
@@ -584,12 +2173,12 @@ def api_files_list():
 
 @app.route('/api/files/<int:file_id>', methods=['GET'])
 def api_files_get(file_id: int):
-    """Fetch a single file_imports row (without compressed_text by default)."""
+    """Fetch a single file_imports row (without its payload columns)."""
     user_email = get_authenticated_user()
     if not user_email:
         return jsonify({"success": False, "message": "Unauthorized"}), 401
     try:
-        res = supabase.table('file_imports').select('*').eq('id', file_id).eq('user_id', user_email).single().execute()
+        res = supabase.table('file_imports').select(FILE_IMPORT_LIST_COLUMNS).eq('id', file_id).eq('user_id', user_email).single().execute()
         if not res.data:
             return jsonify({"success": False, "message": "Not found"}), 404
         return jsonify({"success": True, "file": _serialize_file_import_row(res.data)}), 200
@@ -600,16 +2189,29 @@ def api_files_get(file_id: int):
 @app.route('/api/files/<int:file_id>/content', methods=['GET'])
 def api_files_get_content(file_id: int):
     """
-    Fetch the compressed_text content for a file_imports row. This can be large.
+    Fetch the processed content of a file_imports row: structured_data, summary_text and, for
+    compatibility, the same as one compressed_text JSON string. The raw extracted text can be large
+    and is only included with ?include_extracted_text=true.
     """
     user_email = get_authenticated_user()
     if not user_email:
         return jsonify({"success": False, "message": "Unauthorized"}), 401
+    include_extracted_text = request.args.get('include_extracted_text', 'false').lower() == 'true'
+    columns = 'id,user_id,filename,structured_data,summary_text,metadata,text_length,created_at'
+    if include_extracted_text:
+        columns += ',extracted_text'
     try:
-        res = supabase.table('file_imports').select('id,user_id,filename,compressed_text,text_length,created_at').eq('id', file_id).eq('user_id', user_email).single().execute()
+        res = supabase.table('file_imports').select(columns).eq('id', file_id).eq('user_id', user_email).single().execute()
         if not res.data:
             return jsonify({"success": False, "message": "Not found"}), 404
-        return jsonify({"success": True, "file": res.data}), 200
+        row = res.data
+        if row.get("structured_data") is None and row.get("summary_text") is None:
+            # Written before the payload was split: serve the blob as before
+            legacy = supabase.table('file_imports').select('compressed_text').eq('id', file_id).eq('user_id', user_email).single().execute()
+            row["compressed_text"] = (legacy.data or {}).get("compressed_text")
+        else:
+            row["compressed_text"] = json.dumps({"structured_data": row.get("structured_data"), "compressed_text": row.get("summary_text") or ""})
+        return jsonify({"success": True, "file": row}), 200
     except Exception as e:
         print(f"Error fetching file_imports content: {e}")
         return jsonify({"success": False, "message": str(e)}), 500
@@ -626,6 +2228,7 @@ def api_files_delete(file_id: int):
         if not existing.data:
             return jsonify({"success": False, "message": "Not found"}), 404
         supabase.table('file_imports').delete().eq('id', file_id).execute()
+        _study_context_file_removed(user_email, file_id)
         return jsonify({"success": True}), 200
     except Exception as e:
         print(f"Error deleting file_imports row: {e}")
@@ -1016,371 +2619,317 @@ def execute_ai_tool():
 
         if not tool_type:
             return jsonify({"error": "Tool type is required"}), 400
+        if tool_type not in AI_TOOL_SETTINGS:
+            return jsonify({"error": "Invalid tool type"}), 400
 
         # Get additional context from selected files if available
-        file_context = ""
+        file_context_parts = []
+        file_versions = []  # (file_id, content hash) of every selected file; part of the result cache key
         if selected_files:
             try:
-                # Get file content from Supabase for the selected files
+                # Only the compressed summaries of the selected files are fetched, in one query
+                summaries = _file_import_summaries(user_email, selected_files)
                 for file_id in selected_files:
-                    file_response = supabase.table('file_imports').select('compressed_text').eq('id', file_id).eq('user_id', user_email).execute()
-                    if file_response.data:
-                        for file_record in file_response.data:
-                            compressed_text = file_record.get('compressed_text', '')
-                            if compressed_text:
-                                try:
-                                    parsed_data = json.loads(compressed_text)
-                                    if isinstance(parsed_data, dict) and "compressed_text" in parsed_data:
-                                        file_context += parsed_data["compressed_text"] + "\n\n"
-                                except json.JSONDecodeError:
-                                    file_context += compressed_text + "\n\n"
+                    summary = summaries.get(str(file_id))
+                    if summary:
+                        file_versions.append((str(file_id), hashlib.sha256(summary.encode('utf-8')).hexdigest()))
+                        file_context_parts.append(summary)
             except Exception as e:
                 print(f"Error fetching file context: {e}")
 
+        # Trim to the model's context before building the prompt: the user's own input comes first,
+        # then the selected files share what is left (each keeps at least its fair share)
+        settings = AI_TOOL_SETTINGS[tool_type]
+        target_language = data.get("target_language", "Spanish")
+        fixed_text = target_language if tool_type == "translate" else ""
+        budget = llm_gateway.input_budget(settings["model"], settings["max_tokens"], fixed_text) - AI_TOOL_PROMPT_OVERHEAD_TOKENS
+        prompt_input = llm_gateway.fit_text(input_text, budget)
+        file_context_parts = llm_gateway.fit_texts(file_context_parts, budget - llm_gateway.estimate_tokens(prompt_input))
+        file_context = "".join(part + "\n\n" for part in file_context_parts if part)
+
         # Combine input text with file context
-        combined_input = input_text
+        combined_input = prompt_input
         if file_context:
-            combined_input = f"{input_text}\n\nAdditional Context:\n{file_context}"
-
-        if tool_type == "summarize":
-            result = _ai_summarize(combined_input)
-        elif tool_type == "analyze":
-            result = _ai_analyze(combined_input)
-        elif tool_type == "translate":
-            target_language = data.get("target_language", "Spanish")
-            result = _ai_translate(combined_input, target_language)
-        elif tool_type == "extract_key_points":
-            result = _ai_extract_key_points(combined_input)
-        elif tool_type == "generate_test":
-            result = _ai_generate_test(combined_input)
-        else:
-            return jsonify({"error": "Invalid tool type"}), 400
-
-        # Log AI tool usage
-        try:
-            supabase.table('ai_usage_logs').insert({
-                "user_id": user_email,
-                "tool_type": tool_type,
-                "input_length": len(input_text),
-                "created_at": datetime.now().isoformat()
-            }).execute()
-        except Exception as log_err:
-            print(f"Error logging AI tool usage: {log_err}")
-
-        return jsonify({
-            "success": True,
-            "tool_type": tool_type,
-            "output": result  # Changed from "result" to "output" to match frontend expectations
-        }), 200
-
-    except Exception as e:
-        print(f"Error executing AI tool: {e}")
-        return jsonify({"error": str(e), "message": "Failed to execute AI tool"}), 500
-
-# AI Helper Functions
-@retry_with_backoff
-def _ai_summarize(text):
-    if not text.strip():
-        return "No text provided to summarize."
-    
-    prompt = f"Summarize the following text in a concise manner:\n\n{text}"
-    
-    try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="gemma2-9b-it",
-            temperature=0.3,
-            max_tokens=500
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error in AI summarize: {e}")
-        return "Failed to generate summary."
-
-@retry_with_backoff
-def _ai_analyze(text):
-    if not text.strip():
-        return "No text provided to analyze."
-    
-    prompt = f"Analyze the following text and provide key insights:\n\n{text}"
-    
-    try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="gemma2-9b-it",
-            temperature=0.3,
-            max_tokens=600
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error in AI analyze: {e}")
-        return "Failed to generate analysis."
-
-@retry_with_backoff
-def _ai_translate(text, target_language):
-    if not text.strip():
-        return "No text provided to translate."
-    
-    prompt = f"Translate the following text to {target_language}:\n\n{text}"
-    
-    try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="gemma2-9b-it",
-            temperature=0.2,
-            max_tokens=800
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error in AI translate: {e}")
-        return "Failed to generate translation."
-
-@retry_with_backoff
-def _ai_extract_key_points(text):
-    if not text.strip():
-        return "No text provided to extract key points from."
-    
-    prompt = f"Extract the key points from the following text as a bulleted list:\n\n{text}"
-    
-    try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="gemma2-9b-it",
-            temperature=0.3,
-            max_tokens=600
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error in AI extract key points: {e}")
-        return "Failed to extract key points."
-
-@retry_with_backoff
-def _ai_generate_test(text):
-    if not text.strip():
-        return "No text provided to generate test from."
-    
-    prompt = f"Generate 5 multiple choice questions based on the following text. Include the correct answers:\n\n{text}"
-    
-    try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="gemma2-9b-it",
-            temperature=0.4,
-            max_tokens=800
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error in AI generate test: {e}")
-        return "Failed to generate test."
-
-# Helper function to read extracted text content from disk
-def read_extracted_text_content(file_path):
-    try:
-        # Ensure the path is within the EXTRACTED_TEXT_FOLDER for security
-        abs_file_path = os.path.abspath(file_path)
-        if not abs_file_path.startswith(os.path.abspath(EXTRACTED_TEXT_FOLDER)):
-            print(f"Attempted to read file outside EXTRACTED_TEXT_FOLDER: {file_path}")
-            return "" # Prevent directory traversal attacks
-
-        with open(abs_file_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except Exception as e:
-        print(f"Error reading extracted text file {file_path}: {e}")
-        return ""
-
-# Helper function to read/write compressed JSON data
-def read_compressed_data(file_path):
-    try:
-        abs_file_path = os.path.abspath(file_path)
-        if not abs_file_path.startswith(os.path.abspath(COMPRESSED_DATA_FOLDER)):
-            print(f"Attempted to read file outside COMPRESSED_DATA_FOLDER: {file_path}")
-            return None
-        with open(abs_file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"Error reading compressed data from {file_path}: {e}")
-        return None
-
-def write_compressed_data(data, file_path):
-    try:
-        abs_file_path = os.path.abspath(file_path)
-        if not abs_file_path.startswith(os.path.abspath(COMPRESSED_DATA_FOLDER)):
-            print(f"Attempted to write file outside COMPRESSED_DATA_FOLDER: {file_path}")
-            return False
-        with open(abs_file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
-        return True
-    except Exception as e:
-        print(f"Error writing compressed data to {file_path}: {e}")
-        return False
-
-# IMPROVED NLTK-based compression
-def _nltk_compress_and_filter(structured_data):
-    """
-    Further compresses structured data using NLTK to focus on definitions and Q&A.
-    Returns a highly concise string.
-    """
-    lemmatizer = WordNetLemmatizer()
-    stop_words = set(stopwords.words('english'))
-
-    concise_parts = []
-
-    # Prioritize definitions and make them very concise
-    for definition in structured_data.get('definitions', []):
-        tokens = word_tokenize(definition.lower())
-        filtered_tokens = [lemmatizer.lemmatize(w) for w in tokens if w.isalnum() and w not in stop_words]
-        concise_parts.append("Definition: " + " ".join(filtered_tokens[:15])) # Limit to first 15 relevant words
-
-    # Prioritize questions and answers
-    questions = structured_data.get('questions', [])
-    answers = structured_data.get('answers', [])
-    for i in range(min(len(questions), len(answers))):
-        q_tokens = word_tokenize(questions[i].lower())
-        q_filtered = [lemmatizer.lemmatize(w) for w in q_tokens if w.isalnum() and w not in stop_words]
-        
-        a_tokens = word_tokenize(answers[i].lower())
-        a_filtered = [lemmatizer.lemmatize(w) for w in a_tokens if w.isalnum() and w not in stop_words]
-        
-        concise_parts.append(f"Q: {' '.join(q_filtered[:20])} A: {' '.join(a_filtered[:20])}") # Limit Q&A to 20 words each
+            combined_input = f"{prompt_input}\n\nAdditional Context:\n{file_context}"
+
+        streaming = _wants_streaming(data) and tool_type in STREAMABLE_AI_TOOLS and combined_input.strip()
+
+        # Identical low-temperature requests reuse the earlier output (opt out with "cache": false)
+        cache_key = None
+        cache_status = "bypass"
+        if _ai_result_cache_enabled(data, tool_type) and combined_input.strip():
+            cache_key = _ai_result_cache_key(tool_type, input_text, target_language, file_versions)
+            cached_result = _ai_result_cache_get(cache_key)
+            if cached_result is not None:
+                _log_ai_tool_usage(user_email, tool_type, len(input_text))
+                llm_gateway.record_cache_hit(f"ai_{tool_type}", AI_TOOL_SETTINGS[tool_type]["model"])
+                if streaming:
+                    return _stream_llm_response((part for part in [cached_result]), "output", lambda _output: None, cache_status="hit")
+                return jsonify({
+                    "success": True,
+                    "tool_type": tool_type,
+                    "output": cached_result,
+                    "cache": "hit"
+                }), 200, {"X-Cache": "hit"}
+            cache_status = "miss"
+
+        # Long-form tools can stream their output as it is generated (SSE)
+        if streaming:
+            if tool_type == "summarize":
+                completion_stream = _ai_summarize(combined_input, stream=True)
+            elif tool_type == "analyze":
+                completion_stream = _ai_analyze(combined_input, stream=True)
+            else:
+                completion_stream = _ai_translate(combined_input, target_language, stream=True)
 
-    # Add terms if they haven't been covered by definitions
-    terms_added = set()
-    for def_str in concise_parts:
-        if def_str.startswith("Definition: "):
-            # Simple way to get the potential term from the definition string
-            term_part = def_str.split(":")[1].strip().split(" ")[0] 
-            terms_added.add(lemmatizer.lemmatize(term_part.lower()))
-    
-    for term in structured_data.get('terms', []):
-        if lemmatizer.lemmatize(term.lower()) not in terms_added:
-            concise_parts.append("Term: " + term)
+            def on_complete(output):
+                _log_ai_tool_usage(user_email, tool_type, len(input_text))
+                if cache_key and output:
+                    _ai_result_cache_put(cache_key, output)
 
+            return _stream_llm_response(completion_stream, "output", on_complete, cache_status=cache_status)
 
-    # Join all concise parts, ensuring overall length is managed
-    final_concise_text = "\n".join(concise_parts)
-    
-    # Final check to ensure it's not excessively long for Groq input
-    # Aim for a very small fraction of original, so keep this tight
-    MAX_FINAL_COMPRESSED_CHARS = 2000 # Roughly 500 tokens for context
-    if len(final_concise_text) > MAX_FINAL_COMPRESSED_CHARS:
-        final_concise_text = final_concise_text[:MAX_FINAL_COMPRESSED_CHARS] + "..."
+        if tool_type == "summarize":
+            result = _ai_summarize(combined_input)
+        elif tool_type == "analyze":
+            result = _ai_analyze(combined_input)
+        elif tool_type == "translate":
+            result = _ai_translate(combined_input, target_language)
+        elif tool_type == "extract_key_points":
+            result = _ai_extract_key_points(combined_input)
+        elif tool_type == "generate_test":
+            result = _ai_generate_test(combined_input)
+        else:
+            return jsonify({"error": "Invalid tool type"}), 400
 
-    return final_concise_text
+        # Log AI tool usage
+        _log_ai_tool_usage(user_email, tool_type, len(input_text))
 
+        if cache_key and result and result != AI_TOOL_SETTINGS[tool_type]["failure_message"]:
+            _ai_result_cache_put(cache_key, result)
 
-# IMPROVED: AI-driven text compression/structured extraction for a single chunk
-@retry_with_backoff
-def _extract_key_study_elements_from_chunk(text_chunk):
-    if not text_chunk.strip():
-        return {
-            "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-        }
+        return jsonify({
+            "success": True,
+            "tool_type": tool_type,
+            "output": result,  # Changed from "result" to "output" to match frontend expectations
+            "cache": cache_status
+        }), 200, {"X-Cache": cache_status}
 
-    prompt = (
-        "From the following study material, extract and categorize the key information. "
-        "Provide the output as a JSON object with the following keys:\n"
-        "'terms': A list of important terms found (e.g., ['Term1', 'Term2']).\n"
-        "'definitions': A list of definitions, explicitly linking to a term if possible (e.g., ['Term1: Definition of Term1', 'Definition of concept']).\n"
-        "'examples': A list of specific examples related to concepts (e.g., ['Example 1 description', 'Example 2 description']).\n"
-        "'questions': A list of questions (from quizzes, practice problems, etc.) as plain strings (e.g., ['What is X?', 'How does Y work?']).\n"
-        "'answers': A list of answers corresponding to the questions, as plain strings. If an answer is not explicitly given, state 'Not provided' (e.g., ['Answer to Q1', 'Not provided']).\n\n"
-        "If a category is not found, its list should be empty. Output ONLY the JSON object. "
-        "Be extremely concise and extract only the most critical information to minimize output size. "
-        "Ensure ALL list items are plain strings, not nested objects or complex structures. Prioritize conciseness."
-    )
+    except LLMOverloadedError as e:
+        return _llm_overloaded_response(e)
+    except Exception as e:
+        print(f"Error executing AI tool: {e}")
+        return jsonify({"error": str(e), "message": "Failed to execute AI tool"}), 500
 
+def _log_ai_tool_usage(user_email, tool_type, input_length):
     try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "user", "content": prompt + "\n\nMaterial:\n" + text_chunk}
-            ],
-            model="gemma2-9b-it",
-            response_format={"type": "json_object"},
-            temperature=0.2, # Lower temperature for more factual extraction
-            max_tokens=4000, # Reduced max tokens for the extracted JSON output to enforce conciseness
-        )
-        response_content = chat_completion.choices[0].message.content
-        extracted_data = json.loads(response_content)
+        supabase.table('ai_usage_logs').insert({
+            "user_id": user_email,
+            "tool_type": tool_type,
+            "input_length": input_length,
+            "created_at": datetime.now().isoformat()
+        }).execute()
+    except Exception as log_err:
+        print(f"Error logging AI tool usage: {log_err}")
 
-        # Post-process to ensure all list items are strings, handling potential AI errors
-        def ensure_strings_in_list(lst):
-            if not isinstance(lst, list):
-                return []
-            return [str(item) if not isinstance(item, (dict, list)) else json.dumps(item) for item in lst]
+# ==================== AI TOOL RESULT CACHE ====================
+# In-process LRU with a TTL: maps a cache key to (stored_at, output).
+_ai_result_cache = collections.OrderedDict()
+_ai_result_cache_lock = threading.Lock()
 
-        return {
-            "terms": ensure_strings_in_list(extracted_data.get("terms", [])),
-            "definitions": ensure_strings_in_list(extracted_data.get("definitions", [])),
-            "examples": ensure_strings_in_list(extracted_data.get("examples", [])),
-            "questions": ensure_strings_in_list(extracted_data.get("questions", [])),
-            "answers": ensure_strings_in_list(extracted_data.get("answers", []))
-        }
+def _ai_result_cache_enabled(data, tool_type):
+    """Caching applies to low-temperature tools unless the request opts out with "cache": false or Cache-Control: no-cache."""
+    if not AI_RESULT_CACHE_MAX_ENTRIES:
+        return False
+    if AI_TOOL_SETTINGS[tool_type]["temperature"] > AI_RESULT_CACHE_MAX_TEMPERATURE:
+        return False
+    flag = data.get("cache", True)
+    if isinstance(flag, str):
+        flag = flag.lower() not in ("0", "false", "no")
+    return bool(flag) and "no-cache" not in request.headers.get("Cache-Control", "")
 
-    except json.JSONDecodeError as e:
-        print(f"JSONDecodeError in _extract_key_study_elements_from_chunk: {e}. Raw response: {response_content[:500]}...")
-        return { "terms": [], "definitions": [], "examples": [], "questions": [], "answers": [] }
-    except Exception as e:
-        print(f"Error extracting key study elements from chunk with Groq API: {e}")
-        return { "terms": [], "definitions": [], "examples": [], "questions": [], "answers": [] }
+def _ai_result_cache_key(tool_type, input_text, target_language, file_versions):
+    """
+    Key: tool, whitespace-normalized input, translation target, selected files' content hashes, model and temperature.
+    Editing or re-uploading a selected file changes its hash, so stale outputs are never served.
+    """
+    settings = AI_TOOL_SETTINGS[tool_type]
+    normalized_input = " ".join((input_text or "").split())
+    key_material = json.dumps([
+        tool_type,
+        hashlib.sha256(normalized_input.encode('utf-8')).hexdigest(),
+        target_language if tool_type == "translate" else None,
+        sorted(file_versions),
+        settings["model"],
+        settings["temperature"],
+        settings["max_tokens"]
+    ])
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+def _ai_result_cache_get(key):
+    with _ai_result_cache_lock:
+        entry = _ai_result_cache.get(key)
+        if entry is None:
+            return None
+        stored_at, output = entry
+        if time.time() - stored_at > AI_RESULT_CACHE_TTL_SECONDS:
+            del _ai_result_cache[key]
+            return None
+        _ai_result_cache.move_to_end(key)
+        return output
 
-# IMPROVED: Main text processing and compression pipeline
-def _process_and_compress_text(raw_text_content, file_id):
-    # This function will handle token limits and return structured data
+def _ai_result_cache_put(key, output):
+    with _ai_result_cache_lock:
+        _ai_result_cache[key] = (time.time(), output)
+        _ai_result_cache.move_to_end(key)
+        while len(_ai_result_cache) > AI_RESULT_CACHE_MAX_ENTRIES:
+            _ai_result_cache.popitem(last=False)
 
-    # Define a safe chunk size for the LLM input
-    # gemma2-9b-it has 8192 context window. Let's aim for 4000-6000 tokens per chunk
-    # Assuming ~4 chars per token for English, 4000 tokens is ~16000 characters.
-    # We'll use a character-based chunking for simplicity.
-    CHUNK_SIZE_CHARS = 13000 # Roughly 3000 tokens input to extraction LLM
-    OVERLAP_CHARS = 500 # To maintain context across chunks
+# AI Helper Functions
+def _ai_summarize(text, stream=False):
+    if not text.strip():
+        return "No text provided to summarize."
+    
+    settings = AI_TOOL_SETTINGS['summarize']
+    prompt = f"Summarize the following text in a concise manner:\n\n{text}"
+    
+    if stream:
+        return llm_gateway.chat_completion_stream(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_summarize",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
 
-    full_extracted_data = {
-        "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-    }
+    try:
+        chat_completion = llm_gateway.chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_summarize",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
+        return chat_completion.choices[0].message.content
+    except LLMOverloadedError:
+        raise
+    except Exception as e:
+        print(f"Error in AI summarize: {e}")
+        return settings["failure_message"]
 
-    if not raw_text_content.strip():
-        return None # Return None if no content to process
+def _ai_analyze(text, stream=False):
+    if not text.strip():
+        return "No text provided to analyze."
+    
+    settings = AI_TOOL_SETTINGS['analyze']
+    prompt = f"Analyze the following text and provide key insights:\n\n{text}"
+    
+    if stream:
+        return llm_gateway.chat_completion_stream(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_analyze",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
 
-    # Chunk the text
-    chunks = []
-    start = 0
-    while start < len(raw_text_content):
-        end = min(start + CHUNK_SIZE_CHARS, len(raw_text_content))
-        chunks.append(raw_text_content[start:end])
-        start += CHUNK_SIZE_CHARS - OVERLAP_CHARS # Move start by chunk size minus overlap
-        if start >= len(raw_text_content) - OVERLAP_CHARS: # Ensure last chunk is processed
-            break
+    try:
+        chat_completion = llm_gateway.chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_analyze",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
+        return chat_completion.choices[0].message.content
+    except LLMOverloadedError:
+        raise
+    except Exception as e:
+        print(f"Error in AI analyze: {e}")
+        return settings["failure_message"]
 
-    if not chunks: # Handle very small texts that don't form a full chunk
-        chunks.append(raw_text_content)
+def _ai_translate(text, target_language, stream=False):
+    if not text.strip():
+        return "No text provided to translate."
+    
+    settings = AI_TOOL_SETTINGS['translate']
+    prompt = f"Translate the following text to {target_language}:\n\n{text}"
+    
+    if stream:
+        return llm_gateway.chat_completion_stream(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_translate",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
 
-    print(f"Processing {len(chunks)} chunks for compression...")
-    for i, chunk in enumerate(chunks):
-        print(f"Processing chunk {i+1}/{len(chunks)}")
-        extracted_chunk_data = _extract_key_study_elements_from_chunk(chunk)
-        
-        # Aggregate results, avoiding duplicates (simple check for now)
-        full_extracted_data["terms"].extend([t for t in extracted_chunk_data["terms"] if t and t not in full_extracted_data["terms"]])
-        full_extracted_data["definitions"].extend([d for d in extracted_chunk_data["definitions"] if d and d not in full_extracted_data["definitions"]])
-        full_extracted_data["examples"].extend([e for e in extracted_chunk_data["examples"] if e and e not in full_extracted_data["examples"]])
-        full_extracted_data["questions"].extend([q for q in extracted_chunk_data["questions"] if q and q not in full_extracted_data["questions"]])
-        full_extracted_data["answers"].extend([a for a in extracted_chunk_data["answers"] if a and a not in full_extracted_data["answers"]])
-
-    # Return both the structured data and the compressed string
-    compressed_string = _nltk_compress_and_filter(full_extracted_data)
+    try:
+        chat_completion = llm_gateway.chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_translate",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
+        return chat_completion.choices[0].message.content
+    except LLMOverloadedError:
+        raise
+    except Exception as e:
+        print(f"Error in AI translate: {e}")
+        return settings["failure_message"]
+
+def _ai_extract_key_points(text):
+    if not text.strip():
+        return "No text provided to extract key points from."
     
-    return {
-        "structured_data": full_extracted_data,
-        "compressed_text": compressed_string
-    }
+    settings = AI_TOOL_SETTINGS['extract_key_points']
+    prompt = f"Extract the key points from the following text as a bulleted list:\n\n{text}"
+    
+    try:
+        chat_completion = llm_gateway.chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_extract_key_points",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
+        return chat_completion.choices[0].message.content
+    except LLMOverloadedError:
+        raise
+    except Exception as e:
+        print(f"Error in AI extract key points: {e}")
+        return settings["failure_message"]
 
+def _ai_generate_test(text):
+    if not text.strip():
+        return "No text provided to generate test from."
+    
+    settings = AI_TOOL_SETTINGS['generate_test']
+    prompt = f"Generate 5 multiple choice questions based on the following text. Include the correct answers:\n\n{text}"
+    
+    try:
+        chat_completion = llm_gateway.chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            model=settings["model"],
+            endpoint="ai_generate_test",
+            temperature=settings["temperature"],
+            max_tokens=settings["max_tokens"]
+        )
+        return chat_completion.choices[0].message.content
+    except LLMOverloadedError:
+        raise
+    except Exception as e:
+        print(f"Error in AI generate test: {e}")
+        return settings["failure_message"]
 
 @app.route('/import-file', methods=['POST'])
 def import_file():
     """
     Handles file uploads, extracts text (PDF/OCR), processes and compresses it,
     and stores everything directly in the database (no external files).
-    Returns the database record ID and processing results.
+    Returns the database record ID and processing results, or with async=true
+    a 202 with a job_id to poll at /api/jobs/<job_id>.
     """
     try:
         if 'file' not in request.files:
@@ -1395,6 +2944,10 @@ def import_file():
         if not project_id:
             return jsonify({"error": "Project ID is required"}), 400
 
+        ocr_mode = _requested_ocr_mode()
+        if not ocr_mode:
+            return jsonify({"error": f"ocr_mode must be one of: {', '.join(OCR_MODES)}"}), 400
+
         # Get authenticated user
         user_email = get_authenticated_user()
         if not user_email:
@@ -1402,54 +2955,54 @@ def import_file():
 
         # Generate unique file ID for processing
         file_id = str(uuid.uuid4())
-        
-        # Save file temporarily for text extraction only
-        file_extension = os.path.splitext(file.filename)[1]
-        temp_filename = f"temp_{file_id}_{file.filename}"
-        temp_file_path = os.path.join(UPLOAD_FOLDER, temp_filename)
-        
-        try:
-            file.save(temp_file_path)
-        except Exception as e:
-            print(f"Error saving temporary file: {e}")
-            return jsonify({"error": "Failed to save uploaded file"}), 500
 
-        # Extract text from the temporary file
-        try:
-            extracted_text = _extract_text_from_file(temp_file_path)
-        except Exception as e:
-            print(f"Error extracting text from file: {e}")
-            return jsonify({"error": "Failed to extract text from file"}), 500
-        finally:
-            # Clean up temporary file immediately after text extraction
-            try:
-                if os.path.exists(temp_file_path):
-                    os.remove(temp_file_path)
-            except Exception as cleanup_error:
-                print(f"Warning: Could not clean up temporary file: {cleanup_error}")
-        
-        # Process and compress the text using AI
+        # Read the upload into memory; nothing is written to disk
         try:
-            compression_result = _process_and_compress_text(extracted_text, file_id)
+            file_bytes = file.read()
         except Exception as e:
-            print(f"Error compressing text: {e}")
-            return jsonify({"error": "Failed to compress file content"}), 500
+            print(f"Error reading uploaded file: {e}")
+            return jsonify({"error": "Failed to read uploaded file"}), 500
 
-        if not compression_result:
-            return jsonify({"error": "Failed to compress file content"}), 500
+        if _wants_async_ingestion():
+            return _enqueue_ingest_job(user_email, "import_file", file.filename, _ingest_import_file,
+                                       user_email, project_id, doc_type, file.filename, file_bytes, file_id, ocr_mode)
+
+        payload, status_code = _ingest_import_file(user_email, project_id, doc_type, file.filename, file_bytes, file_id, ocr_mode)
+        return jsonify(payload), status_code
+
+    except Exception as e:
+        print(f"Unexpected error in import_file: {e}")
+        return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
+
+def _ingest_import_file(user_email, project_id, doc_type, filename, file_bytes, file_id, ocr_mode=None, progress_callback=None):
+    """Extract, compress and store a file uploaded to import_file. Returns (payload, status_code)."""
+    # Extract text and process/compress it using AI (skipped entirely on an ingestion cache hit)
+    try:
+        result = _run_ingestion_pipeline(file_bytes, filename, file_id, ocr_mode, progress_callback)
+    except LLMOverloadedError as e:
+        return {"error": "AI service is busy, please retry shortly", "retry_after": round(e.retry_after, 1)}, 503
+    except Exception as e:
+        print(f"Error extracting and compressing file: {e}")
+        return {"error": "Failed to process file content"}, 500
+
+    return _store_import_file(user_email, project_id, doc_type, filename, file_id, result)
+
+def _store_import_file(user_email, project_id, doc_type, filename, file_id, result):
+    """Stores one _run_ingestion_pipeline result as a file_imports row. Returns (payload, status_code)."""
+    try:
+        if result["error"]:
+            return {"error": "Failed to compress file content"}, 500
         
         # Extract both structured data and compressed text
-        structured_data = compression_result.get("structured_data", {})
-        compressed_text_content = compression_result.get("compressed_text", "")
+        extracted_text = result["extracted_text"]
+        structured_data = result["structured_data"]
+        compressed_text_content = result["compressed_text"]
         
-        # Create comprehensive data package for database storage
-        processed_data = {
+        # Processing details stored alongside the payload columns
+        metadata = {
             "file_id": file_id,
-            "original_filename": file.filename,
+            "original_filename": filename,
             "doc_type": doc_type,
-            "extracted_text": extracted_text,  # Store full extracted text
-            "structured_data": structured_data,
-            "compressed_text": compressed_text_content,
             "processing_metadata": {
                 "original_text_length": len(extracted_text),
                 "compressed_text_length": len(compressed_text_content),
@@ -1460,20 +3013,29 @@ def import_file():
                     "questions": len(structured_data.get("questions", [])),
                     "answers": len(structured_data.get("answers", []))
                 },
-                "processed_at": datetime.now().isoformat()
+                "processed_at": datetime.now().isoformat(),
+                "cache_hit": result["cache_hit"],
+                "stage_metrics": result["metrics"]
             }
         }
 
-        # Insert comprehensive file data into Supabase
+        # Insert the full extracted text, study elements and summary as separate columns
         try:
-            response = supabase.table("file_imports").insert({
-                "user_id": user_email,
-                "project_id": project_id,
-                "filename": file.filename,
-                "compressed_text": json.dumps(processed_data),  # Store all processed data as JSON
-                "text_length": len(extracted_text) if extracted_text else 0,
-                "created_at": datetime.now().isoformat()
-            }).execute()
+            columns = _file_import_columns(result, extracted_text=extracted_text, metadata=metadata)
+            persisted_bytes = _byte_len(json.dumps(columns))
+            with _ingest_stage(result["metrics"], "persist", persisted_bytes) as stage:
+                response = supabase.table("file_imports").insert({
+                    "user_id": user_email,
+                    "project_id": project_id,
+                    "filename": filename,
+                    **columns,
+                    "text_length": len(extracted_text) if extracted_text else 0,
+                    "created_at": datetime.now().isoformat()
+                }).execute()
+                stage["bytes_out"] = persisted_bytes
+            _log_ingest_metrics(filename, result["metrics"])
+            if response.data:
+                _study_context_file_added(user_email, response.data[0])
 
             print(f"Successfully stored processed file data in database for user {user_email}")
 
@@ -1481,30 +3043,95 @@ def import_file():
                 inserted_row = response.data[0]
                 
                 # Return success response with database record info
-                return jsonify({
+                return {
                     "success": True,
                     "message": "File imported and processed successfully",
                     "file_id": inserted_row["id"],  # Database record ID
-                    "original_filename": file.filename,
+                    "original_filename": filename,
                     "doc_type": doc_type,
                     "extracted_text_length": len(extracted_text),
                     "compressed_text_length": len(compressed_text_content),
-                    "structured_items": processed_data["processing_metadata"]["structured_items_count"],
+                    "structured_items": metadata["processing_metadata"]["structured_items_count"],
                     # Note: No file paths since everything is stored in database
                     "storage_type": "database",
-                    "database_record_id": inserted_row["id"]
-                }), 200
+                    "database_record_id": inserted_row["id"],
+                    "metrics": result["metrics"]
+                }, 200
             else:
-                return jsonify({"error": "Failed to record file import in database"}), 500
+                return {"error": "Failed to record file import in database"}, 500
 
         except Exception as e:
             print(f"Error inserting file import into database: {e}")
-            return jsonify({"error": f"Database error during file import: {str(e)}"}), 500
+            return {"error": f"Database error during file import: {str(e)}"}, 500
 
     except Exception as e:
         print(f"Unexpected error in import_file: {e}")
+        return {"error": f"Unexpected error: {str(e)}"}, 500
+
+@app.route('/import-files', methods=['POST'])
+def import_files():
+    """
+    Bulk form of /import-file: takes several 'file' parts with the same type/project_id/ocr_mode fields.
+    The files are ingested together, so small files share batched extraction requests instead of
+    costing one LLM call each. Returns {"success", "files": [...]} with one /import-file style result
+    per file (each with its own "status"), or with async=true a 202 with a single job_id for the set.
+    """
+    try:
+        files = [file for file in request.files.getlist('file') if file.filename]
+        if not files:
+            return jsonify({"error": "No file part"}), 400
+
+        doc_type = request.form.get("type", "unknown")
+        project_id = request.form.get("project_id")
+
+        if not project_id:
+            return jsonify({"error": "Project ID is required"}), 400
+
+        ocr_mode = _requested_ocr_mode()
+        if not ocr_mode:
+            return jsonify({"error": f"ocr_mode must be one of: {', '.join(OCR_MODES)}"}), 400
+
+        user_email = get_authenticated_user()
+        if not user_email:
+            return jsonify({"error": "Unauthorized"}), 401
+
+        try:
+            uploads = [(file.read(), file.filename, str(uuid.uuid4())) for file in files]
+        except Exception as e:
+            print(f"Error reading uploaded files: {e}")
+            return jsonify({"error": "Failed to read uploaded files"}), 500
+
+        if _wants_async_ingestion():
+            return _enqueue_ingest_job(user_email, "import_files", ", ".join(file.filename for file in files),
+                                       _ingest_import_files, user_email, project_id, doc_type, uploads, ocr_mode)
+
+        payload, status_code = _ingest_import_files(user_email, project_id, doc_type, uploads, ocr_mode)
+        return jsonify(payload), status_code
+
+    except Exception as e:
+        print(f"Unexpected error in import_files: {e}")
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
+def _ingest_import_files(user_email, project_id, doc_type, uploads, ocr_mode=None, progress_callback=None):
+    """
+    Extract, compress and store the (file_bytes, filename, file_id) uploads of import_files.
+    Returns (payload, status_code); the status is 200 if any file was stored.
+    """
+    try:
+        results = _run_ingestion_pipelines(uploads, ocr_mode, progress_callback)
+    except LLMOverloadedError as e:
+        return {"error": "AI service is busy, please retry shortly", "retry_after": round(e.retry_after, 1)}, 503
+    except Exception as e:
+        print(f"Error extracting and compressing files: {e}")
+        return {"error": "Failed to process file content"}, 500
+
+    files = []
+    for (_, filename, file_id), result in zip(uploads, results):
+        payload, status_code = _store_import_file(user_email, project_id, doc_type, filename, file_id, result)
+        files.append({"original_filename": filename, **payload, "status": status_code})
+    stored = [entry for entry in files if entry["status"] < 400]
+    return {"success": bool(stored), "files": files}, 200 if stored else 500
+
 
 
 # ==================== USER AUTHENTICATION ROUTES ====================
@@ -1793,7 +3420,7 @@ def get_recommended_projects(user_id):
 def upload_file():
     """
     Upload and process a file, extract text, compress it, and store directly in the database.
-    Matches file_imports schema (user_id, project_id, filename, compressed_text, text_length).
+    Matches file_imports schema (user_id, project_id, filename, structured_data, summary_text, text_length).
     """
     # Validate incoming file
     if 'file' not in request.files:
@@ -1812,32 +3439,32 @@ def upload_file():
     if not project_id:
         return jsonify({"error": "Project ID required"}), 400
 
-    try:
-        # Temporarily save file for text extraction
-        temp_name = f"{uuid.uuid4()}_{file.filename}"
-        temp_path = os.path.join(UPLOAD_FOLDER, temp_name)
-        file.save(temp_path)
+    ocr_mode = _requested_ocr_mode()
+    if not ocr_mode:
+        return jsonify({"error": f"ocr_mode must be one of: {', '.join(OCR_MODES)}"}), 400
 
-        # Extract text and remove temp file
-        extracted_text = _extract_text_from_file(temp_path)
-        try:
-            os.remove(temp_path)
-        except Exception:
-            pass
+    try:
+        # Extract and compress text straight from the uploaded bytes (cached by file content)
+        result = _run_ingestion_pipeline(file.read(), file.filename, str(uuid.uuid4()), ocr_mode=ocr_mode)
 
-        # Compress extracted text to a concise string
-        compressed_text = _process_and_compress_text(extracted_text, str(uuid.uuid4()))
-        if not compressed_text:
+        if result["error"]:
             return jsonify({"error": "Failed to compress file content"}), 500
 
-        # Insert record into file_imports with compressed_text stored directly
-        response = supabase.table('file_imports').insert({
-            'user_id': user_email,
-            'project_id': project_id,
-            'filename': file.filename,
-            'compressed_text': compressed_text,
-            'text_length': len(extracted_text)
-        }).execute()
+        # Insert record into file_imports with the study elements and summary in their own columns
+        columns = _file_import_columns(result)
+        persisted_bytes = _byte_len(json.dumps(columns))
+        with _ingest_stage(result["metrics"], "persist", persisted_bytes) as stage:
+            response = supabase.table('file_imports').insert({
+                'user_id': user_email,
+                'project_id': project_id,
+                'filename': file.filename,
+                **columns,
+                'text_length': len(result["extracted_text"])
+            }).execute()
+            stage["bytes_out"] = persisted_bytes
+        _log_ingest_metrics(file.filename, result["metrics"])
+        if response.data:
+            _study_context_file_added(user_email, response.data[0])
 
         if not response.data:
             return jsonify({"error": "Failed to record file import in database"}), 500
@@ -1852,6 +3479,8 @@ def upload_file():
             'text_length': row['text_length']
         }), 200
 
+    except LLMOverloadedError as e:
+        return _llm_overloaded_response(e)
     except Exception as e:
         print(f"Error uploading file: {e}")
         return jsonify({"error": str(e)}), 500
@@ -1865,7 +3494,7 @@ def get_uploaded_files(user_id):
     Get all uploaded files for a user
     """
     try:
-        response = supabase.table('file_imports').select('*').eq('user_id', user_id).order('created_at', desc=True).execute()
+        response = supabase.table('file_imports').select(FILE_IMPORT_LIST_COLUMNS).eq('user_id', user_id).order('created_at', desc=True).execute()
         return jsonify({"files": response.data}), 200
     except Exception as e:
         print(f"Error fetching uploaded files: {e}")
@@ -1887,60 +3516,25 @@ def generate_flashcards():
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
 
-    combined_structured_data = {
-        "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-    }
-    
-    # Get all processed files from database for this user
+    # Merged study elements of the user's files, optionally limited to one project and/or selected file_ids
     try:
-        response = supabase.table('file_imports').select('compressed_text').eq('user_id', user_email).execute()
-        
-        if response.data:
-            for file_record in response.data:
-                compressed_text = file_record.get('compressed_text', '')
-                if compressed_text:
-                    try:
-                        # Parse the processed data from database
-                        processed_data = json.loads(compressed_text)
-                        
-                        # Extract structured data
-                        if isinstance(processed_data, dict) and "structured_data" in processed_data:
-                            structured_data = processed_data["structured_data"]
-                            if isinstance(structured_data, dict):
-                                # Safely extract each field with defaults
-                                terms = structured_data.get("terms", [])
-                                definitions = structured_data.get("definitions", [])
-                                examples = structured_data.get("examples", [])
-                                questions = structured_data.get("questions", [])
-                                answers = structured_data.get("answers", [])
-                                
-                                # Ensure all are lists and extend combined data
-                                if isinstance(terms, list):
-                                    combined_structured_data["terms"].extend([t for t in terms if t and t not in combined_structured_data["terms"]])
-                                if isinstance(definitions, list):
-                                    combined_structured_data["definitions"].extend([d for d in definitions if d and d not in combined_structured_data["definitions"]])
-                                if isinstance(examples, list):
-                                    combined_structured_data["examples"].extend([e for e in examples if e and e not in combined_structured_data["examples"]])
-                                if isinstance(questions, list):
-                                    combined_structured_data["questions"].extend([q for q in questions if q and q not in combined_structured_data["questions"]])
-                                if isinstance(answers, list):
-                                    combined_structured_data["answers"].extend([a for a in answers if a and a not in combined_structured_data["answers"]])
-                    except json.JSONDecodeError:
-                        print(f"Skipping invalid JSON in compressed_text")
-                        continue
-                    except Exception as e:
-                        print(f"Error processing database record: {e}")
-                        continue
-    except Exception as e:
-        print(f"Error fetching data from database: {e}")
+        project_id, file_ids = _study_scope_from_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        study_context = _get_study_context(user_email, project_id, file_ids)
+    except Exception as e:
+        print(f"Error fetching study context: {e}")
         return jsonify({"error": "Failed to fetch file data"}), 500
 
-    further_compressed_context = _nltk_compress_and_filter(combined_structured_data)
+    further_compressed_context = study_context["compressed_context"]
 
     if not further_compressed_context.strip():
         return jsonify({"error": "No processed content available for flashcard generation. Please upload and process files first."}), 400
     
-    context_for_llm = further_compressed_context
+    # Trim the material to the model's context before building the prompt
+    budget = llm_gateway.input_budget("gemma2-9b-it", MIN_GENERATION_OUTPUT_TOKENS) - GENERATION_PROMPT_OVERHEAD_TOKENS
+    context_for_llm = llm_gateway.fit_text(further_compressed_context, budget)
 
     prompt = (
         f"Generate exactly {num_flashcards} flashcards based on the following highly concise study material. "
@@ -1952,11 +3546,12 @@ def generate_flashcards():
     )
 
     try:
-        chat_completion = groq_client.chat.completions.create(
+        chat_completion = llm_gateway.chat_completion(
             messages=[
                 {"role": "user", "content": prompt}
             ],
             model="gemma2-9b-it",
+            endpoint="generate_flashcards",
             response_format={"type": "json_object"},
             temperature=0.7,
             max_tokens=4000,
@@ -1978,7 +3573,7 @@ def generate_flashcards():
                     "user_id": int(user_id),
                     "flashcard_count": len(flashcards),
                     "flashcards_content": json.dumps(flashcards),
-                    "source_files_count": len(response.data) if response.data else 0,
+                    "source_files_count": study_context["file_count"],
                     "created_at": datetime.now().isoformat()
                 }).execute()
         except Exception as e:
@@ -1986,6 +3581,8 @@ def generate_flashcards():
 
         return jsonify({"flashcards": flashcards})
 
+    except LLMOverloadedError as e:
+        return _llm_overloaded_response(e)
     except json.JSONDecodeError as e:
         print(f"JSONDecodeError in generate_flashcards: {e}. Raw response: {response_content[:500]}...")
         return jsonify({"error": "AI response was not valid JSON.", "flashcards": []}), 500
@@ -2010,60 +3607,25 @@ def generate_test():
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
 
-    combined_structured_data = {
-        "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-    }
-    
-    # Get all processed files from database for this user
+    # Merged study elements of the user's files, optionally limited to one project and/or selected file_ids
     try:
-        response = supabase.table('file_imports').select('compressed_text').eq('user_id', user_email).execute()
-        
-        if response.data:
-            for file_record in response.data:
-                compressed_text = file_record.get('compressed_text', '')
-                if compressed_text:
-                    try:
-                        # Parse the processed data from database
-                        processed_data = json.loads(compressed_text)
-                        
-                        # Extract structured data
-                        if isinstance(processed_data, dict) and "structured_data" in processed_data:
-                            structured_data = processed_data["structured_data"]
-                            if isinstance(structured_data, dict):
-                                # Safely extract each field with defaults
-                                terms = structured_data.get("terms", [])
-                                definitions = structured_data.get("definitions", [])
-                                examples = structured_data.get("examples", [])
-                                questions = structured_data.get("questions", [])
-                                answers = structured_data.get("answers", [])
-                                
-                                # Ensure all are lists and extend combined data
-                                if isinstance(terms, list):
-                                    combined_structured_data["terms"].extend([t for t in terms if t and t not in combined_structured_data["terms"]])
-                                if isinstance(definitions, list):
-                                    combined_structured_data["definitions"].extend([d for d in definitions if d and d not in combined_structured_data["definitions"]])
-                                if isinstance(examples, list):
-                                    combined_structured_data["examples"].extend([e for e in examples if e and e not in combined_structured_data["examples"]])
-                                if isinstance(questions, list):
-                                    combined_structured_data["questions"].extend([q for q in questions if q and q not in combined_structured_data["questions"]])
-                                if isinstance(answers, list):
-                                    combined_structured_data["answers"].extend([a for a in answers if a and a not in combined_structured_data["answers"]])
-                    except json.JSONDecodeError:
-                        print(f"Skipping invalid JSON in compressed_text")
-                        continue
-                    except Exception as e:
-                        print(f"Error processing database record: {e}")
-                        continue
-    except Exception as e:
-        print(f"Error fetching data from database: {e}")
+        project_id, file_ids = _study_scope_from_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        study_context = _get_study_context(user_email, project_id, file_ids)
+    except Exception as e:
+        print(f"Error fetching study context: {e}")
         return jsonify({"error": "Failed to fetch file data"}), 500
 
-    further_compressed_context = _nltk_compress_and_filter(combined_structured_data)
+    further_compressed_context = study_context["compressed_context"]
 
     if not further_compressed_context.strip():
         return jsonify({"error": "No processed content available for test generation. Please upload and process files first."}), 400
     
-    context_for_llm = further_compressed_context
+    # Trim the material to the model's context before building the prompt
+    budget = llm_gateway.input_budget("gemma2-9b-it", MIN_GENERATION_OUTPUT_TOKENS, f"{test_name} {question_type}") - GENERATION_PROMPT_OVERHEAD_TOKENS
+    context_for_llm = llm_gateway.fit_text(further_compressed_context, budget)
 
 
     prompt = (
@@ -2078,11 +3640,12 @@ def generate_test():
     )
 
     try:
-        chat_completion = groq_client.chat.completions.create(
+        chat_completion = llm_gateway.chat_completion(
             messages=[
                 {"role": "user", "content": prompt}
             ],
             model="gemma2-9b-it",
+            endpoint="generate_test",
             temperature=0.7,
             max_tokens=5000,
         )
@@ -2100,7 +3663,7 @@ def generate_test():
                     "question_type": question_type,
                     "num_questions": num_questions,
                     "test_content": test_content,
-                    "source_files_count": len(response.data) if response.data else 0,
+                    "source_files_count": study_context["file_count"],
                     "created_at": datetime.now().isoformat()
                 }).execute()
         except Exception as e:
@@ -2108,15 +3671,35 @@ def generate_test():
 
         return jsonify({"testContent": test_content})
 
+    except LLMOverloadedError as e:
+        return _llm_overloaded_response(e)
     except Exception as e:
         print(f"Error calling Groq API for Test Generation: {e}")
         return jsonify({"error": str(e)}), 500
 
+def _log_generated_notes(user_email, topic, notes_content, source_files_count):
+    try:
+        # Get user ID from email for logging
+        user_response = supabase.table("users").select("id").eq("email", user_email).execute()
+        if user_response.data:
+            user_id = user_response.data[0]["id"]
+            supabase.table('generated_notes').insert({
+                "user_id": int(user_id),
+                "topic": topic,
+                "notes_content": notes_content,
+                "source_files_count": source_files_count,
+                "created_at": datetime.now().isoformat()
+            }).execute()
+    except Exception as e:
+        print(f"Error logging notes generation: {e}")
+
 @app.route('/generate-notes', methods=['POST'])
 def generate_notes():
     """
     Generates detailed notes based on a topic and user's database-stored processed files.
-    Expects {topic: string, existingContent: string}
+    Expects {topic: string, existingContent: string, stream?: bool}
+    With stream=true (or Accept: text/event-stream) the notes are sent as Server-Sent Events
+    while they are generated; the final event is `done` with {notesContent}.
     """
     data = request.json
     topic = data.get('topic', 'General Study Notes')
@@ -2127,61 +3710,25 @@ def generate_notes():
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
 
-    combined_structured_data = {
-        "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-    }
-    
-    # Get all processed files from database for this user
+    # Merged study elements of the user's files, optionally limited to one project and/or selected file_ids
     try:
-        response = supabase.table('file_imports').select('compressed_text').eq('user_id', user_email).execute()
-        
-        if response.data:
-            for file_record in response.data:
-                compressed_text = file_record.get('compressed_text', '')
-                if compressed_text:
-                    try:
-                        # Parse the processed data from database
-                        processed_data = json.loads(compressed_text)
-                        
-                        # Extract structured data
-                        if isinstance(processed_data, dict) and "structured_data" in processed_data:
-                            structured_data = processed_data["structured_data"]
-                            if isinstance(structured_data, dict):
-                                # Safely extract each field with defaults
-                                terms = structured_data.get("terms", [])
-                                definitions = structured_data.get("definitions", [])
-                                examples = structured_data.get("examples", [])
-                                questions = structured_data.get("questions", [])
-                                answers = structured_data.get("answers", [])
-                                
-                                # Ensure all are lists and extend combined data
-                                if isinstance(terms, list):
-                                    combined_structured_data["terms"].extend([t for t in terms if t and t not in combined_structured_data["terms"]])
-                                if isinstance(definitions, list):
-                                    combined_structured_data["definitions"].extend([d for d in definitions if d and d not in combined_structured_data["definitions"]])
-                                if isinstance(examples, list):
-                                    combined_structured_data["examples"].extend([e for e in examples if e and e not in combined_structured_data["examples"]])
-                                if isinstance(questions, list):
-                                    combined_structured_data["questions"].extend([q for q in questions if q and q not in combined_structured_data["questions"]])
-                                if isinstance(answers, list):
-                                    combined_structured_data["answers"].extend([a for a in answers if a and a not in combined_structured_data["answers"]])
-                    except json.JSONDecodeError:
-                        print(f"Skipping invalid JSON in compressed_text")
-                        continue
-                    except Exception as e:
-                        print(f"Error processing database record: {e}")
-                        continue
-    except Exception as e:
-        print(f"Error fetching data from database: {e}")
+        project_id, file_ids = _study_scope_from_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        study_context = _get_study_context(user_email, project_id, file_ids)
+    except Exception as e:
+        print(f"Error fetching study context: {e}")
         return jsonify({"error": "Failed to fetch file data"}), 500
 
-    # Further compress the combined structured data for notes generation context
-    further_compressed_context = _nltk_compress_and_filter(combined_structured_data)
+    further_compressed_context = _topic_study_context(user_email, topic, STUDY_SEARCH_NOTES_TOP_K, study_context, project_id, file_ids)
 
     if not further_compressed_context.strip() and not existing_content.strip():
         return jsonify({"error": "No processed content or existing content available for notes generation. Please upload and process files first."}), 400
     
-    context_for_llm = further_compressed_context
+    # Existing content and study material share what the model's context leaves for inputs
+    budget = llm_gateway.input_budget("gemma2-9b-it", MIN_GENERATION_OUTPUT_TOKENS, topic) - GENERATION_PROMPT_OVERHEAD_TOKENS
+    existing_content, context_for_llm = llm_gateway.fit_texts([existing_content, further_compressed_context], budget)
 
 
     prompt = (
@@ -2193,35 +3740,41 @@ def generate_notes():
         "\n\nHighly Concise Relevant Study Material:\n" + context_for_llm
     )
 
+    source_files_count = study_context["file_count"]
     try:
-        chat_completion = groq_client.chat.completions.create(
+        if _wants_streaming(data):
+            completion_stream = llm_gateway.chat_completion_stream(
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                model="gemma2-9b-it",
+                endpoint="generate_notes",
+                temperature=0.7,
+                max_tokens=4000,
+            )
+            return _stream_llm_response(
+                completion_stream, "notesContent",
+                lambda notes: _log_generated_notes(user_email, topic, notes, source_files_count)
+            )
+
+        chat_completion = llm_gateway.chat_completion(
             messages=[
                 {"role": "user", "content": prompt}
             ],
             model="gemma2-9b-it",
+            endpoint="generate_notes",
             temperature=0.7,
             max_tokens=4000,
         )
         notes_content = chat_completion.choices[0].message.content
 
         # Log notes generation to Supabase
-        try:
-            # Get user ID from email for logging
-            user_response = supabase.table("users").select("id").eq("email", user_email).execute()
-            if user_response.data:
-                user_id = user_response.data[0]["id"]
-                supabase.table('generated_notes').insert({
-                    "user_id": int(user_id),
-                    "topic": topic,
-                    "notes_content": notes_content,
-                    "source_files_count": len(response.data) if response.data else 0,
-                    "created_at": datetime.now().isoformat()
-                }).execute()
-        except Exception as e:
-            print(f"Error logging notes generation: {e}")
+        _log_generated_notes(user_email, topic, notes_content, source_files_count)
 
         return jsonify({"notesContent": notes_content})
 
+    except LLMOverloadedError as e:
+        return _llm_overloaded_response(e)
     except Exception as e:
         print(f"Error calling Groq API for Notes Generation: {e}")
         return jsonify({"error": str(e)}), 500
@@ -2243,80 +3796,26 @@ def generate_study_guide():
     if not user_email:
         return jsonify({"error": "Unauthorized", "nodes": [], "edges": []}), 401
 
-    combined_structured_data = {
-        "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-    }
-    
-    # Extract data directly from Supabase instead of files
+    # Merged study elements of the user's files, optionally limited to one project and/or selected file_ids
     try:
-        # Get all file imports for this user
-        response = supabase.table('file_imports').select('compressed_text').eq('user_id', user_email).execute()
-        
-        if response.data:
-            for file_record in response.data:
-                compressed_text = file_record.get('compressed_text', '')
-                if compressed_text:
-                    try:
-                        # Try to parse as JSON first (new structured format)
-                        parsed_data = json.loads(compressed_text)
-                        if isinstance(parsed_data, dict) and "structured_data" in parsed_data:
-                            # New format with structured data
-                            structured_data = parsed_data["structured_data"]
-                            if isinstance(structured_data, dict):
-                                # Safely extract each field with defaults
-                                terms = structured_data.get("terms", [])
-                                definitions = structured_data.get("definitions", [])
-                                examples = structured_data.get("examples", [])
-                                questions = structured_data.get("questions", [])
-                                answers = structured_data.get("answers", [])
-                                
-                                # Ensure all are lists and extend combined data
-                                if isinstance(terms, list):
-                                    combined_structured_data["terms"].extend([t for t in terms if t and t not in combined_structured_data["terms"]])
-                                if isinstance(definitions, list):
-                                    combined_structured_data["definitions"].extend([d for d in definitions if d and d not in combined_structured_data["definitions"]])
-                                if isinstance(examples, list):
-                                    combined_structured_data["examples"].extend([e for e in examples if e and e not in combined_structured_data["examples"]])
-                                if isinstance(questions, list):
-                                    combined_structured_data["questions"].extend([q for q in questions if q and q not in combined_structured_data["questions"]])
-                                if isinstance(answers, list):
-                                    combined_structured_data["answers"].extend([a for a in answers if a and a not in combined_structured_data["answers"]])
-                        elif isinstance(parsed_data, dict):
-                            # Old structured format (direct terms, definitions, etc.)
-                            terms = parsed_data.get("terms", [])
-                            definitions = parsed_data.get("definitions", [])
-                            examples = parsed_data.get("examples", [])
-                            questions = parsed_data.get("questions", [])
-                            answers = parsed_data.get("answers", [])
-                            
-                            # Ensure all are lists
-                            if isinstance(terms, list):
-                                combined_structured_data["terms"].extend([t for t in terms if t and t not in combined_structured_data["terms"]])
-                            if isinstance(definitions, list):
-                                combined_structured_data["definitions"].extend([d for d in definitions if d and d not in combined_structured_data["definitions"]])
-                            if isinstance(examples, list):
-                                combined_structured_data["examples"].extend([e for e in examples if e and e not in combined_structured_data["examples"]])
-                            if isinstance(questions, list):
-                                combined_structured_data["questions"].extend([q for q in questions if q and q not in combined_structured_data["questions"]])
-                            if isinstance(answers, list):
-                                combined_structured_data["answers"].extend([a for a in answers if a and a not in combined_structured_data["answers"]])
-                    except json.JSONDecodeError:
-                        # If it's not JSON, it's probably the old compressed string format
-                        # We can't extract structured data from it easily, so skip
-                        print(f"Skipping non-JSON compressed text: {compressed_text[:100]}...")
-                        continue
-                    except Exception as e:
-                        print(f"Error processing compressed text: {e}")
-                        continue
-    except Exception as e:
-        print(f"Error fetching data from Supabase: {e}")
+        project_id, file_ids = _study_scope_from_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e), "nodes": [], "edges": []}), 400
+    try:
+        study_context = _get_study_context(user_email, project_id, file_ids)
+    except Exception as e:
+        print(f"Error fetching study context: {e}")
         return jsonify({"error": "Failed to fetch file data", "nodes": [], "edges": []}), 500
 
-    further_compressed_context = _nltk_compress_and_filter(combined_structured_data)
+    further_compressed_context = study_context["compressed_context"]
 
     if not further_compressed_context.strip() and not topics:
         return jsonify({"error": "No relevant study elements or topics found for study guide generation.", "nodes": [], "edges": []}), 400
 
+    # Topics and study elements share what the model's context leaves for inputs
+    budget = llm_gateway.input_budget("gemma2-9b-it", MIN_GENERATION_OUTPUT_TOKENS) - GENERATION_PROMPT_OVERHEAD_TOKENS
+    topics_text, further_compressed_context = llm_gateway.fit_texts([", ".join(topics), further_compressed_context], budget)
+
     prompt = (
         "You are an AI assistant for creating visual study guides. "
         "Based on the following topics and highly concise extracted study elements, "
@@ -2330,16 +3829,17 @@ def generate_study_guide():
         "Edges should have an 'id' (string), 'source' node id, and 'target' node id, showing logical relationships (e.g., mainTopic to subTopic, subTopic to term, term to definition/example). "
         "Ensure the nodes are spread out and don't overlap too much, forming a clear tree-like or hierarchical structure. "
         "Output ONLY the JSON object."
-        "\n\nTopics to prioritize: " + ", ".join(topics) +
+        "\n\nTopics to prioritize: " + topics_text +
         "\n\nHighly Concise Extracted Study Elements:\n" + further_compressed_context
     )
 
     try:
-        chat_completion = groq_client.chat.completions.create(
+        chat_completion = llm_gateway.chat_completion(
             messages=[
                 {"role": "user", "content": prompt}
             ],
             model="gemma2-9b-it",
+            endpoint="generate_study_guide",
             response_format={"type": "json_object"},
             temperature=0.7,
             max_tokens=4000,
@@ -2375,6 +3875,8 @@ def generate_study_guide():
 
         return jsonify({"nodes": nodes, "edges": edges})
 
+    except LLMOverloadedError as e:
+        return _llm_overloaded_response(e)
     except json.JSONDecodeError as e:
         print(f"JSONDecodeError in generate_study_guide: {e}. Raw response: {response_content[:500]}...")
         return jsonify({"error": "AI response was not valid JSON.", "nodes": [], "edges": []}), 500
@@ -2400,72 +3902,15 @@ def autofill_info():
     if not user_email:
         return jsonify({"error": "Unauthorized"}), 401
 
-    combined_structured_data = {
-        "terms": [], "definitions": [], "examples": [], "questions": [], "answers": []
-    }
-    
-    # Extract data directly from Supabase instead of files
+    # Merged study elements of the user's files, optionally limited to one project and/or selected file_ids
     try:
-        # Get all file imports for this user
-        response = supabase.table('file_imports').select('compressed_text').eq('user_id', user_email).execute()
-        
-        if response.data:
-            for file_record in response.data:
-                compressed_text = file_record.get('compressed_text', '')
-                if compressed_text:
-                    try:
-                        # Try to parse as JSON first (new structured format)
-                        parsed_data = json.loads(compressed_text)
-                        if isinstance(parsed_data, dict) and "structured_data" in parsed_data:
-                            # New format with structured data
-                            structured_data = parsed_data["structured_data"]
-                            if isinstance(structured_data, dict):
-                                # Safely extract each field with defaults
-                                terms = structured_data.get("terms", [])
-                                definitions = structured_data.get("definitions", [])
-                                examples = structured_data.get("examples", [])
-                                questions = structured_data.get("questions", [])
-                                answers = structured_data.get("answers", [])
-                                
-                                # Ensure all are lists and extend combined data
-                                if isinstance(terms, list):
-                                    combined_structured_data["terms"].extend([t for t in terms if t and t not in combined_structured_data["terms"]])
-                                if isinstance(definitions, list):
-                                    combined_structured_data["definitions"].extend([d for d in definitions if d and d not in combined_structured_data["definitions"]])
-                                if isinstance(examples, list):
-                                    combined_structured_data["examples"].extend([e for e in examples if e and e not in combined_structured_data["examples"]])
-                                if isinstance(questions, list):
-                                    combined_structured_data["questions"].extend([q for q in questions if q and q not in combined_structured_data["questions"]])
-                                if isinstance(answers, list):
-                                    combined_structured_data["answers"].extend([a for a in answers if a and a not in combined_structured_data["answers"]])
-                        elif isinstance(parsed_data, dict):
-                            # Old structured format (direct terms, definitions, etc.)
-                            terms = parsed_data.get("terms", [])
-                            definitions = parsed_data.get("definitions", [])
-                            examples = parsed_data.get("examples", [])
-                            questions = parsed_data.get("questions", [])
-                            answers = parsed_data.get("answers", [])
-                            
-                            # Ensure all are lists
-                            if isinstance(terms, list):
-                                combined_structured_data["terms"].extend([t for t in terms if t and t not in combined_structured_data["terms"]])
-                            if isinstance(definitions, list):
-                                combined_structured_data["definitions"].extend([d for d in definitions if d and d not in combined_structured_data["definitions"]])
-                            if isinstance(examples, list):
-                                combined_structured_data["examples"].extend([e for e in examples if e and e not in combined_structured_data["examples"]])
-                            if isinstance(questions, list):
-                                combined_structured_data["questions"].extend([q for q in questions if q and q not in combined_structured_data["questions"]])
-                            if isinstance(answers, list):
-                                combined_structured_data["answers"].extend([a for a in answers if a and a not in combined_structured_data["answers"]])
-                    except json.JSONDecodeError:
-                        # If it's not JSON, it's probably the old compressed string format
-                        print(f"Skipping non-JSON compressed text: {compressed_text[:100]}...")
-                        continue
-                    except Exception as e:
-                        print(f"Error processing compressed text: {e}")
-                        continue
-    except Exception as e:
-        print(f"Error fetching data from Supabase: {e}")
+        project_id, file_ids = _study_scope_from_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        study_context = _get_study_context(user_email, project_id, file_ids)
+    except Exception as e:
+        print(f"Error fetching study context: {e}")
         return jsonify({"error": "Failed to fetch file data"}), 500
 
     # Use JWT to extract user info for context selection
@@ -2487,14 +3932,18 @@ def autofill_info():
     else:
         return jsonify({"error": "Authorization token missing."}), 401
 
+    # Only the study elements most relevant to the topic go into the prompt
+    context = _topic_study_context(user_email, topic, STUDY_SEARCH_AUTOFILL_TOP_K, study_context, project_id, file_ids)
+    budget = llm_gateway.input_budget("compound-beta-mini", 100, topic) - GENERATION_PROMPT_OVERHEAD_TOKENS
+    context_for_llm = llm_gateway.fit_text(context, budget)
 
-#//{context_for_llm} for actually making work
     prompt = f"""
 You are an AI assistant trained to highlight only specific terms and definitions in academics.
 
 Topic: {topic}
 
 Context:
+{context_for_llm}
 
 
 Instructions:
@@ -2519,11 +3968,13 @@ DO NOT ADD ANY EXTRA WORDS, BULLETPOINTS, SPACES, ENTERS, OR ANYTHING ELSE THAT
 """
 
     try:
-        chat_completion = groq_client.chat.completions.create(
+        chat_completion = llm_gateway.chat_completion(
             messages=[
                 {"role": "user", "content": prompt}
             ],
             model="compound-beta-mini",
+            endpoint="autofill_info",
+            hedge=True,
             temperature=0.4,
             max_tokens=100,
         )
@@ -2539,7 +3990,7 @@ DO NOT ADD ANY EXTRA WORDS, BULLETPOINTS, SPACES, ENTERS, OR ANYTHING ELSE THAT
                     "user_id": int(user_id),
                     "topic": topic,
                     "filled_content": filled_content,
-                    "source_files_count": len(response.data) if response.data else 0,
+                    "source_files_count": study_context["file_count"],
                     "created_at": datetime.now().isoformat()
                 }).execute()
         except Exception as e:
@@ -2547,6 +3998,8 @@ DO NOT ADD ANY EXTRA WORDS, BULLETPOINTS, SPACES, ENTERS, OR ANYTHING ELSE THAT
 
         return jsonify({"filledContent": filled_content})
 
+    except LLMOverloadedError as e:
+        return _llm_overloaded_response(e)
     except Exception as e:
         print(f"Error calling Groq API for Autofill: {e}")
         return jsonify({"error": str(e)}), 500
@@ -3115,8 +4568,12 @@ def get_post_likes(post_id):
 @app.route('/health', methods=['GET'])
 def health_check():
     """
-    Health check endpoint
+    Health check endpoint. Reports this worker's LLM circuit breakers; groq is "degraded" while any is open.
     """
+    breakers = llm_gateway.breaker_states()
+    groq_status = "connected" if GROQ_API_KEY else "not configured"
+    if any(breaker["state"] != "closed" for breaker in breakers.values()):
+        groq_status = "degraded"
     return jsonify({
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
@@ -3124,11 +4581,38 @@ def health_check():
         "files": len(files_memory),
         "services": {
             "supabase": "connected" if SUPABASE_URL and SUPABASE_ANON_KEY else "not configured",
-            "groq": "connected" if GROQ_API_KEY else "not configured"
-        }
+            "groq": groq_status
+        },
+        "llm_circuit_breakers": breakers
     }), 200
 
 
+def _is_ops_request():
+    """True when the request carries the configured OPS_API_TOKEN in its X-Ops-Token header."""
+    token = request.headers.get("X-Ops-Token", "")
+    return bool(OPS_API_TOKEN) and hmac.compare_digest(token.encode('utf-8'), OPS_API_TOKEN.encode('utf-8'))
+
+@app.route('/api/llm-usage', methods=['GET'])
+def llm_usage():
+    """
+    LLM accounting for this worker: calls, outcomes, prompt/completion tokens, retries, queue wait and
+    latency percentiles per endpoint and model. Ops only (X-Ops-Token).
+    """
+    if not _is_ops_request():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(llm_gateway.usage_stats()), 200
+
+
+@app.route('/api/llm-usage/reset', methods=['POST'])
+def reset_llm_usage():
+    """Clears this worker's LLM accounting and returns the counters as they were. Ops only (X-Ops-Token)."""
+    if not _is_ops_request():
+        return jsonify({"error": "Forbidden"}), 403
+    stats = llm_gateway.usage_stats()
+    llm_gateway.reset_usage_stats()
+    return jsonify(stats), 200
+
+
 @app.route('/api/posts', methods=['POST'])
 def create_post():
     """Create a new post in feed_posts table"""
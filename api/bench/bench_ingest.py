@@ -0,0 +1,353 @@
+"""
+Ingestion benchmark.
+
+Generates synthetic documents (text-layer PDFs, scanned PDFs, mixed PDFs and images), runs them through
+_extract_text_from_file and _process_and_compress_text against a deterministic local fake Groq client
+(installed in llm_gateway), and prints a JSON report (pages/sec, chunks/sec, peak RSS, per-stage latency percentiles) so runs can be compared.
+
+Usage (from the api/ directory):
+    python bench/bench_ingest.py --docs 4 --pages 6 --llm-latency-ms 300 --output bench_ingest.json
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = (
+    "cell membrane protein enzyme energy mitochondria nucleus gene chromosome photosynthesis "
+    "osmosis diffusion respiration glucose ribosome transcription translation mutation evolution "
+    "ecosystem population species habitat predator climate carbon nitrogen cycle molecule atom"
+).split()
+
+DOC_KINDS = ("text_pdf", "scanned_pdf", "mixed_pdf", "image")
+
+
+# ==================== SYNTHETIC DOCUMENTS ====================
+
+def _synthetic_paragraphs(rng, count):
+    paragraphs = []
+    for _ in range(count):
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(8, 16))]
+            words[0] = words[0].capitalize()
+            sentences.append(" ".join(words) + ".")
+        paragraphs.append(" ".join(sentences))
+    return paragraphs
+
+
+def _text_page(doc, text):
+    page = doc.new_page()
+    page.insert_textbox(page.rect + (48, 48, -48, -48), text, fontsize=10)
+    return page
+
+
+def _scanned_page(doc, text, dpi=150):
+    """Renders a text page to pixels and places only the image on a new page, like a scanner would."""
+    import fitz
+    scratch = fitz.open()
+    _text_page(scratch, text)
+    pix = scratch[0].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    page = doc.new_page()
+    page.insert_image(page.rect, stream=pix.tobytes("png"))
+    scratch.close()
+    return page
+
+
+def _make_pdf(kind, pages, rng):
+    import fitz
+    doc = fitz.open()
+    for page_num in range(pages):
+        text = "\n\n".join(_synthetic_paragraphs(rng, 4))
+        scanned = kind == "scanned_pdf" or (kind == "mixed_pdf" and page_num % 2 == 1)
+        if scanned:
+            _scanned_page(doc, text)
+        else:
+            _text_page(doc, text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _make_image(rng):
+    from PIL import Image, ImageDraw
+    img = Image.new("L", (1240, 1754), 255)
+    draw = ImageDraw.Draw(img)
+    y = 60
+    for paragraph in _synthetic_paragraphs(rng, 6):
+        words = paragraph.split()
+        for start in range(0, len(words), 12):
+            draw.text((60, y), " ".join(words[start:start + 12]), fill=0)
+            y += 22
+        y += 22
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def generate_corpus(out_dir, docs_per_kind, pages, seed, kinds=DOC_KINDS):
+    """Writes the synthetic corpus to out_dir and returns [(path, kind, page_count)]."""
+    rng = random.Random(seed)
+    corpus = []
+    for kind in kinds:
+        for i in range(docs_per_kind):
+            if kind == "image":
+                path = os.path.join(out_dir, f"{kind}_{i}.png")
+                data = _make_image(rng)
+                page_count = 1
+            else:
+                path = os.path.join(out_dir, f"{kind}_{i}.pdf")
+                data = _make_pdf(kind, pages, rng)
+                page_count = pages
+            with open(path, "wb") as f:
+                f.write(data)
+            corpus.append((path, kind, page_count))
+    return corpus
+
+
+# ==================== FAKE GROQ ====================
+
+class FakeGroqClient:
+    """
+    Deterministic stand-in for groq_client: the same prompt always yields the same JSON, after
+    latency_ms (+/- jitter_ms, seeded by the prompt) of sleep. Counts calls for the report.
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.calls = 0
+        self._calls_lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    @staticmethod
+    def _elements(text):
+        words = sorted({w.strip(".,").lower() for w in text.split() if w.strip(".,").lower() in WORDS})
+        terms = words[:8]
+        return {
+            "terms": terms,
+            "definitions": [f"{t}: a key idea in the material" for t in terms[:4]],
+            "examples": [f"Example involving {t}" for t in terms[4:6]],
+            "questions": [f"What is {t}?" for t in terms[:2]],
+            "answers": [f"{t} is a key idea in the material" for t in terms[:2]]
+        }
+
+    def _create(self, messages=None, **kwargs):
+        with self._calls_lock:
+            self.calls += 1
+        prompt = "".join(m.get("content", "") for m in (messages or []))
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        rng = random.Random(digest)
+        delay = self.latency_ms + rng.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        # Batched extraction prompts wrap each document in <doc_N> tags and expect one key per document
+        documents = re.findall(r"<(doc_\d+)>(.*?)</\1>", prompt, flags=re.S)
+        if documents:
+            content = json.dumps({key: self._elements(text) for key, text in documents})
+        else:
+            content = json.dumps(self._elements(prompt))
+        message = types.SimpleNamespace(content=content, role="assistant")
+        usage = types.SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4,
+                                      total_tokens=(len(prompt) + len(content)) // 4)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason="stop")], usage=usage)
+
+
+def install_fake_groq(fake):
+    import llm_gateway
+    llm_gateway.set_client(fake)
+
+
+# ==================== BENCHMARK ====================
+
+def _percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return round(ordered[index], 2)
+
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1], 2)}
+
+
+def _shutdown_ocr_pool(app):
+    """Stops the app's OCR process pool and waits for its workers, so RUSAGE_CHILDREN includes them."""
+    with app._ocr_process_pool_lock:
+        if app._ocr_process_pool is not None:
+            app._ocr_process_pool.shutdown(wait=True)
+            app._ocr_process_pool = None
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux. RUSAGE_CHILDREN only covers children that have been waited for, so call
+    # _shutdown_ocr_pool first; it then reports the largest OCR worker, not their sum.
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"self": round(self_kb / 1024, 1), "children": round(children_kb / 1024, 1)}
+
+
+def _clear_caches(app):
+    for folder in (app.INGEST_CACHE_FOLDER, app.CHUNK_CACHE_FOLDER):
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+
+def _ingest_one(app, path, parallel_ocr, ocr_mode):
+    metrics = app._new_ingest_metrics()
+    with app._ingest_stage(metrics, "extract", os.path.getsize(path)) as stage:
+        text = app._extract_text_from_file(path, parallel_ocr=parallel_ocr, ocr_mode=ocr_mode)
+        stage["bytes_out"] = len(text.encode("utf-8"))
+
+    start = time.perf_counter()
+    result = app._process_and_compress_text(text, os.path.basename(path), metrics=metrics)
+    return text, result, metrics, time.perf_counter() - start
+
+
+def run_benchmark(app, corpus, iterations, parallel_ocr, ocr_mode, keep_cache, concurrency=1):
+    """
+    Ingests the corpus `iterations` times, `concurrency` documents at a time (concurrent small documents
+    are what the extraction batcher packs together). pages/sec and chunks/sec are per ingestion thread
+    (from stage time); docs/sec is wall-clock throughput across all threads.
+    """
+    stage_samples = {}
+    per_kind = {}
+    total_pages = 0
+    total_chunks = 0
+    extract_seconds = 0.0
+    process_seconds = 0.0
+
+    wall_start = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    for _ in range(iterations):
+        if not keep_cache:
+            _clear_caches(app)
+        runs = pool.map(lambda doc: _ingest_one(app, doc[0], parallel_ocr, ocr_mode), corpus)
+        for (path, kind, page_count), (text, result, metrics, seconds) in zip(corpus, runs):
+            process_seconds += seconds
+            extract_seconds += metrics["stages"]["extract"]["duration_ms"] / 1000
+
+            chunks = len(result["chunk_token_estimates"]) if result else 0
+            total_pages += page_count
+            total_chunks += chunks
+            for name, record in metrics["stages"].items():
+                stage_samples.setdefault(name, []).append(record["duration_ms"])
+            stats = per_kind.setdefault(kind, {"docs": 0, "pages": 0, "chunks": 0, "chars": 0, "total_ms": []})
+            stats["docs"] += 1
+            stats["pages"] += page_count
+            stats["chunks"] += chunks
+            stats["chars"] += len(text)
+            stats["total_ms"].append(metrics["total_ms"])
+    wall_seconds = time.perf_counter() - wall_start
+    pool.shutdown()
+
+    for stats in per_kind.values():
+        stats["total_ms"] = _percentiles(stats["total_ms"])
+
+    return {
+        "wall_seconds": round(wall_seconds, 3),
+        "pages": total_pages,
+        "chunks": total_chunks,
+        "pages_per_sec": round(total_pages / extract_seconds, 2) if extract_seconds else None,
+        "chunks_per_sec": round(total_chunks / process_seconds, 2) if process_seconds else None,
+        "docs_per_sec": round(len(corpus) * iterations / wall_seconds, 2) if wall_seconds else None,
+        "stages_ms": {name: _percentiles(values) for name, values in stage_samples.items()},
+        "per_kind": per_kind,
+    }
+
+
+def _prepare_workdir(workdir):
+    """app.py reads sb.env/groqapi.env and creates its folders relative to the cwd; give it a scratch one."""
+    os.chdir(workdir)
+    for name, body in (("sb.env", "SUPABASE_URL=http://127.0.0.1:1\nSUPABASE_ANON_KEY=bench\n"),
+                       ("groqapi.env", "GROQ_API_KEY=bench\n")):
+        if not os.path.exists(name):
+            with open(name, "w") as f:
+                f.write(body)
+    # The LLM rate limits are off unless LLM_* limits are exported, which benchmarks the limiter too
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark document ingestion against a fake Groq backend.")
+    parser.add_argument("--docs", type=int, default=2, help="documents generated per kind")
+    parser.add_argument("--pages", type=int, default=4, help="pages per synthetic PDF")
+    parser.add_argument("--kinds", default=",".join(DOC_KINDS), help="comma-separated subset of " + ",".join(DOC_KINDS))
+    parser.add_argument("--iterations", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1, help="documents ingested at the same time")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--llm-latency-ms", type=float, default=250.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=50.0)
+    parser.add_argument("--ocr-mode", choices=("fast", "accurate"), default="fast")
+    parser.add_argument("--serial-ocr", action="store_true", help="disable the OCR process pool")
+    parser.add_argument("--keep-cache", action="store_true", help="keep ingestion/chunk caches warm across iterations")
+    parser.add_argument("--workdir", help="scratch directory (default: a new temp dir)")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    kinds = [k for k in args.kinds.split(",") if k]
+    unknown = set(kinds) - set(DOC_KINDS)
+    if unknown:
+        parser.error(f"unknown kinds: {', '.join(sorted(unknown))}")
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_ingest_")
+    os.makedirs(workdir, exist_ok=True)
+    _prepare_workdir(workdir)
+
+    import app
+    fake = FakeGroqClient(args.llm_latency_ms, args.llm_jitter_ms)
+    install_fake_groq(fake)
+
+    corpus_dir = os.path.join(workdir, "corpus")
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = generate_corpus(corpus_dir, args.docs, args.pages, args.seed, kinds)
+
+    results = run_benchmark(app, corpus, args.iterations, not args.serial_ocr, args.ocr_mode, args.keep_cache,
+                            args.concurrency)
+    _shutdown_ocr_pool(app)
+    report = {
+        "benchmark": "ingest",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "docs_per_kind": args.docs, "pages": args.pages, "kinds": kinds, "iterations": args.iterations,
+            "concurrency": args.concurrency, "extraction_batching": app.EXTRACTION_BATCHING,
+            "seed": args.seed, "llm_latency_ms": args.llm_latency_ms, "llm_jitter_ms": args.llm_jitter_ms,
+            "ocr_mode": args.ocr_mode, "parallel_ocr": not args.serial_ocr, "keep_cache": args.keep_cache,
+            "chunk_concurrency": app.INGEST_CHUNK_CONCURRENCY, "ocr_workers": app.PDF_OCR_WORKERS,
+            "chunk_tokens": app.EXTRACTION_CHUNK_TOKENS,
+            "llm_requests_per_minute": app.llm_gateway.LLM_REQUESTS_PER_MINUTE,
+            "llm_tokens_per_minute": app.llm_gateway.LLM_TOKENS_PER_MINUTE,
+        },
+        "llm_calls": fake.calls,
+        "peak_rss_mb": _peak_rss_mb(),
+        **results,
+    }
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Study element merge benchmark.
+
+Merges N synthetic extracted items (spread over chunk results of --per-chunk items, with a share of
+repeats as real extractions have) through the shared aggregate (_new_study_aggregate /
+_merge_study_elements / _study_aggregate_lists) and, for comparison, the list-membership merge it
+replaced. Prints a JSON report with time and ns/item per size; ns/item staying flat as N grows is
+linear scaling. The legacy merge is quadratic, so it only runs up to --legacy-max items.
+
+Usage (from the api/ directory):
+    python bench/bench_merge.py --sizes 10000,50000,100000 --output bench_merge.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_ingest import WORDS, _prepare_workdir  # noqa: E402
+
+CATEGORIES = ("terms", "definitions", "examples", "questions", "answers")
+
+
+def make_chunks(total_items, per_chunk, duplicate_ratio, seed):
+    """Chunk results totalling total_items items; duplicate_ratio of them repeat an earlier item."""
+    rng = random.Random(seed)
+    seen = []
+    chunks = []
+    produced = 0
+    while produced < total_items:
+        chunk = {category: [] for category in CATEGORIES}
+        for _ in range(min(per_chunk, total_items - produced)):
+            category = CATEGORIES[produced % len(CATEGORIES)]
+            if seen and rng.random() < duplicate_ratio:
+                item = rng.choice(seen)
+            else:
+                item = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {produced}: a key idea in the material"
+                seen.append(item)
+            chunk[category].append(item)
+            produced += 1
+        chunks.append(chunk)
+    return chunks
+
+
+def legacy_merge(chunks):
+    """The previous merge: list membership checks against the growing result (O(n^2))."""
+    merged = {category: [] for category in CATEGORIES}
+    for chunk in chunks:
+        for category in CATEGORIES:
+            merged[category].extend([item for item in chunk[category] if item and item not in merged[category]])
+    return merged
+
+
+def aggregate_merge(app, chunks):
+    aggregate = app._new_study_aggregate()
+    for chunk in chunks:
+        app._merge_study_elements(aggregate, chunk)
+    return app._study_aggregate_lists(aggregate)
+
+
+def _time(merge, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = merge()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the study element merge.")
+    parser.add_argument("--sizes", default="10000,50000,100000", help="comma-separated item counts")
+    parser.add_argument("--per-chunk", type=int, default=40, help="items per chunk result")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size; the best is reported")
+    parser.add_argument("--legacy-max", type=int, default=50000, help="largest size to run the legacy merge on (0 = never)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output) if args.output else None
+    _prepare_workdir(tempfile.mkdtemp(prefix="bench_merge_"))
+    import app
+
+    rows = []
+    for size in [int(value) for value in args.sizes.split(",") if value]:
+        chunks = make_chunks(size, args.per_chunk, args.duplicate_ratio, args.seed)
+        seconds, merged = _time(lambda: aggregate_merge(app, chunks), args.repeat)
+        row = {
+            "items": size,
+            "unique_items": sum(len(items) for items in merged.values()),
+            "aggregate_ms": round(seconds * 1000, 2),
+            "aggregate_ns_per_item": round(seconds * 1e9 / size, 1),
+        }
+        if args.legacy_max and size <= args.legacy_max:
+            legacy_seconds, legacy = _time(lambda: legacy_merge(chunks), 1)
+            # The legacy merge also let repeats within one chunk through; compare the unique items in order
+            if {category: list(dict.fromkeys(items)) for category, items in legacy.items()} != merged:
+                raise AssertionError(f"merge results differ at {size} items")
+            row["legacy_ms"] = round(legacy_seconds * 1000, 2)
+            row["legacy_ns_per_item"] = round(legacy_seconds * 1e9 / size, 1)
+            row["speedup"] = round(legacy_seconds / seconds, 1) if seconds else None
+        rows.append(row)
+
+    report = {
+        "benchmark": "merge",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"per_chunk": args.per_chunk, "duplicate_ratio": args.duplicate_ratio, "repeat": args.repeat,
+                   "legacy_max": args.legacy_max, "seed": args.seed},
+        "results": rows,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Local fake Groq server.
+
+Serves the OpenAI-compatible /openai/v1/chat/completions route the Groq SDK calls, with configurable
+latency, error rate and periodic 429 bursts, so the AI endpoints can be load tested without spending
+real Groq quota. JSON-mode requests get canned answers shaped like what each endpoint parses
+(flashcards, study guide nodes/edges, extraction elements, batched <doc_N> extraction); text requests
+get Markdown/HTML filler. stream=true is answered with SSE chunks.
+
+Usage (from the api/ directory):
+    python bench/fake_groq_server.py --port 8090 --latency lognormal:800,0.5 --error-rate 0.02 \\
+        --burst-every 60 --burst-seconds 5
+    GROQ_BASE_URL=http://127.0.0.1:8090 python app.py
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "cell membrane protein enzyme energy mitochondria nucleus gene chromosome photosynthesis "
+    "osmosis diffusion respiration glucose ribosome transcription translation mutation evolution "
+    "ecosystem population species habitat predator climate carbon nitrogen cycle molecule atom"
+).split()
+
+
+# ==================== BEHAVIOUR ====================
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution in milliseconds: "fixed:300", "uniform:200,900" or
+    "lognormal:800,0.5" (median, sigma). Returns a function rng -> seconds.
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v.strip()] if args else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(max(values[0], 0.001)), values[1]) / 1000
+    raise argparse.ArgumentTypeError(f"Invalid latency distribution: {spec}")
+
+
+class FakeBehaviour:
+    """Decides per request how long to wait and whether to fail; counts outcomes for /stats."""
+
+    def __init__(self, latency, error_rate=0.0, burst_every=0.0, burst_seconds=0.0, retry_after=1.0,
+                 stream_chunk_chars=24, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_seconds = burst_seconds
+        self.retry_after = retry_after
+        self.stream_chunk_chars = max(1, stream_chunk_chars)
+        self.started = time.monotonic()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "rate_limited": 0, "errors": 0, "streamed": 0}
+
+    def _random(self):
+        with self._lock:
+            return random.Random(self._rng.random())
+
+    def in_burst(self):
+        # 429 bursts repeat every burst_every seconds and last burst_seconds, starting burst_every in
+        if self.burst_every <= 0 or self.burst_seconds <= 0:
+            return False
+        elapsed = time.monotonic() - self.started
+        return elapsed >= self.burst_every and (elapsed % self.burst_every) < self.burst_seconds
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def decide(self):
+        """Returns (outcome, delay_seconds) where outcome is "ok", "rate_limited" or "error"."""
+        rng = self._random()
+        self.count("requests")
+        if self.in_burst():
+            return "rate_limited", 0.0
+        delay = max(0.0, self.latency(rng))
+        if rng.random() < self.error_rate:
+            return "error", delay
+        return "ok", delay
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts["in_burst"] = self.in_burst()
+        counts["uptime_seconds"] = round(time.monotonic() - self.started, 1)
+        return counts
+
+
+# ==================== CANNED ANSWERS ====================
+
+def _topic_words(prompt, limit=8):
+    seen = []
+    for word in re.findall(r"[a-z]+", prompt.lower()):
+        if word in WORDS and word not in seen:
+            seen.append(word)
+    return seen[:limit] or WORDS[:limit]
+
+
+def _elements(text):
+    terms = _topic_words(text)
+    return {
+        "terms": terms,
+        "definitions": [f"{t}: a key idea in the material" for t in terms[:4]],
+        "examples": [f"Example involving {t}" for t in terms[4:6]],
+        "questions": [f"What is {t}?" for t in terms[:2]],
+        "answers": [f"{t} is a key idea in the material" for t in terms[:2]]
+    }
+
+
+def canned_json(prompt):
+    """Answers a JSON-mode prompt with the shape the calling endpoint parses."""
+    documents = re.findall(r"<(doc_\d+)>(.*?)</\1>", prompt, flags=re.S)
+    if documents:
+        return {key: _elements(text) for key, text in documents}
+    if "'nodes' and 'edges'" in prompt:
+        terms = _topic_words(prompt, 6)
+        nodes = [{"id": "root", "type": "mainTopic", "data": {"label": "Overview", "description": "Main topic"},
+                  "position": {"x": 250, "y": 50}}]
+        edges = []
+        for i, term in enumerate(terms):
+            nodes.append({"id": f"n{i}", "type": "term", "data": {"label": term, "description": f"About {term}"},
+                          "position": {"x": 50 + i * 75, "y": 250}})
+            edges.append({"id": f"e{i}", "source": "root", "target": f"n{i}"})
+        return {"nodes": nodes, "edges": edges}
+    if "flashcards" in prompt:
+        match = re.search(r"exactly (\d+) flashcards", prompt)
+        count = min(int(match.group(1)), 50) if match else 10
+        terms = _topic_words(prompt, 30)
+        return {"flashcards": [{"front": f"What is {terms[i % len(terms)]}?",
+                                "back": f"{terms[i % len(terms)]} is a key idea in the material"}
+                               for i in range(count)]}
+    return _elements(prompt)
+
+
+def canned_text(prompt):
+    terms = _topic_words(prompt, 6)
+    if "HTML" in prompt:
+        items = "".join(f"<li><strong>{t}</strong>: a key idea in the material.</li>" for t in terms)
+        return f"<h2>Study Notes</h2><ul>{items}</ul>"
+    lines = ["## Summary", ""] + [f"- **{t}**: a key idea in the material." for t in terms]
+    return "\n".join(lines)
+
+
+# ==================== HTTP ====================
+
+def _usage(prompt, content):
+    prompt_tokens = len(prompt) // 4
+    completion_tokens = max(1, len(content) // 4)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+class FakeGroqHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    behaviour = None
+    quiet = True
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            return self._send_json(200, self.behaviour.snapshot())
+        if self.path.rstrip("/") == "/openai/v1/models":
+            return self._send_json(200, {"object": "list", "data": [
+                {"id": "gemma2-9b-it", "object": "model"}, {"id": "compound-beta-mini", "object": "model"}]})
+        self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send_json(400, {"error": {"message": "Invalid JSON", "type": "invalid_request_error"}})
+        if self.path.rstrip("/") != "/openai/v1/chat/completions":
+            return self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+        outcome, delay = self.behaviour.decide()
+        if outcome == "rate_limited":
+            self.behaviour.count("rate_limited")
+            return self._send_json(429, {"error": {"message": "Rate limit reached (fake)", "type": "tokens",
+                                                   "code": "rate_limit_exceeded"}},
+                                   headers={"Retry-After": str(self.behaviour.retry_after)})
+        time.sleep(delay)
+        if outcome == "error":
+            self.behaviour.count("errors")
+            return self._send_json(503, {"error": {"message": "Service unavailable (fake)", "type": "internal_server_error"}})
+
+        prompt = "".join(str(m.get("content", "")) for m in body.get("messages") or [])
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        content = json.dumps(canned_json(prompt)) if json_mode else canned_text(prompt)
+        model = body.get("model", "gemma2-9b-it")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        usage = _usage(prompt, content)
+
+        if body.get("stream"):
+            self.behaviour.count("streamed")
+            return self._stream(completion_id, model, content, usage)
+        self.behaviour.count("ok")
+        self._send_json(200, {
+            "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+            "x_groq": {"id": f"req_{completion_id}"}
+        })
+
+    def _stream(self, completion_id, model, content, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish_reason=None, extra=None):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            payload.update(extra or {})
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        size = self.behaviour.stream_chunk_chars
+        try:
+            chunk({"role": "assistant", "content": ""})
+            for start in range(0, len(content), size):
+                chunk({"content": content[start:start + size]})
+            chunk({}, "stop", {"x_groq": {"id": f"req_{completion_id}", "usage": usage}})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve(host, port, behaviour, quiet=True):
+    handler = type("Handler", (FakeGroqHandler,), {"behaviour": behaviour, "quiet": quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible fake of the Groq API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("lognormal:600,0.4"),
+                        help="fixed:MS | uniform:LO,HI | lognormal:MEDIAN,SIGMA (milliseconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--burst-every", type=float, default=0.0, help="Start a 429 burst every N seconds (0 = never)")
+    parser.add_argument("--burst-seconds", type=float, default=0.0, help="Length of each 429 burst")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with 429s")
+    parser.add_argument("--stream-chunk-chars", type=int, default=24, help="Characters per streamed delta")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args(argv)
+
+    behaviour = FakeBehaviour(args.latency, args.error_rate, args.burst_every, args.burst_seconds,
+                              args.retry_after, args.stream_chunk_chars, args.seed)
+    server = serve(args.host, args.port, behaviour, quiet=not args.verbose)
+    print(f"Fake Groq listening on http://{args.host}:{server.server_address[1]} (set GROQ_BASE_URL to this)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(behaviour.snapshot(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
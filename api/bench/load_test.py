@@ -0,0 +1,269 @@
+"""
+Load test for the AI endpoints.
+
+Drives a running app (usually pointed at bench/fake_groq_server.py through GROQ_BASE_URL) with a weighted
+mix of /generate-flashcards, /generate-test, /generate-notes, /generate-study-guide, /autofill-info and
+/api/ai-tools/execute from `--concurrency` closed-loop workers, then prints a JSON report with throughput,
+status codes and p50/p95/p99 latency per endpoint (plus time to first event for streamed requests),
+together with the app's own /api/llm-usage accounting for the worker that answered (needs the app's
+OPS_API_TOKEN, passed as --ops-token or read from the environment / sb.env).
+
+The app still talks to Supabase for auth and file context, so use an account that has processed files.
+
+Usage (from the api/ directory):
+    python bench/fake_groq_server.py --port 8090 &
+    GROQ_BASE_URL=http://127.0.0.1:8090 python app.py &
+    python bench/load_test.py --app-url http://127.0.0.1:5000 --email me@example.com \\
+        --concurrency 16 --duration 60 --fake-url http://127.0.0.1:8090 --output load.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import jwt
+import requests
+from dotenv import dotenv_values
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOPICS = ("photosynthesis", "cell respiration", "mitochondria", "gene expression", "evolution", "ecosystems",
+          "chemical bonding", "the nitrogen cycle")
+
+ENDPOINTS = {
+    "generate-flashcards": "/generate-flashcards",
+    "generate-test": "/generate-test",
+    "generate-notes": "/generate-notes",
+    "generate-study-guide": "/generate-study-guide",
+    "autofill-info": "/autofill-info",
+    "ai-tools-execute": "/api/ai-tools/execute",
+}
+STREAMABLE = ("generate-notes", "ai-tools-execute")
+DEFAULT_MIX = "generate-flashcards=2,generate-test=1,generate-notes=2,generate-study-guide=1,ai-tools-execute=3"
+
+
+# ==================== REQUESTS ====================
+
+def mint_token(email, secret):
+    """Same claims as app.create_jwt_token, short-lived."""
+    now = datetime.utcnow()
+    return jwt.encode({"email": email, "exp": now + timedelta(hours=2), "iat": now}, secret, algorithm="HS256")
+
+
+def build_payload(name, sequence, args):
+    # A unique nonce keeps requests out of the AI result cache and single-flight unless --repeat-inputs is set
+    nonce = "" if args.repeat_inputs else f" #{sequence}"
+    topic = TOPICS[sequence % len(TOPICS)] + nonce
+    if name == "ai-tools-execute":
+        tool = ("summarize", "analyze", "translate", "extract_key_points")[sequence % 4]
+        payload = {"tool_type": tool, "input_text": f"Explain {topic} for an exam.", "stream": args.stream}
+        if tool == "translate":
+            payload["target_language"] = "Spanish"
+        return payload
+
+    if name == "generate-flashcards":
+        payload = {"numFlashcards": 10}
+    elif name == "generate-test":
+        payload = {"config": {"name": f"Load test{nonce}", "type": "mcq", "questionCount": 5}}
+    elif name == "generate-notes":
+        payload = {"topic": topic, "existingContent": "", "stream": args.stream}
+    elif name == "generate-study-guide":
+        payload = {"topics": [topic]}
+    else:
+        payload = {"topic": topic, "existingContent": ""}
+    # The generate and autofill endpoints read the study context of this project only
+    if args.project_id:
+        payload["project_id"] = args.project_id
+    return payload
+
+
+def send(session, url, name, payload, timeout):
+    """Returns (status, latency_seconds, first_event_seconds or None)."""
+    start = time.perf_counter()
+    if payload.get("stream") and name in STREAMABLE:
+        with session.post(url, json=payload, timeout=timeout, stream=True) as response:
+            first_event = None
+            for line in response.iter_lines():
+                if first_event is None and line:
+                    first_event = time.perf_counter() - start
+            return response.status_code, time.perf_counter() - start, first_event
+    response = session.post(url, json=payload, timeout=timeout)
+    return response.status_code, time.perf_counter() - start, None
+
+
+# ==================== DRIVER ====================
+
+def _percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+        return round(ordered[index] * 1000, 1)
+
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "max": round(ordered[-1] * 1000, 1)}
+
+
+def parse_mix(spec):
+    weights = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint in mix: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def run_load(args, token, mix):
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    sequence = itertools.count()
+    samples = {name: [] for name in names}
+    samples_lock = threading.Lock()
+    stop_at = time.monotonic() + args.duration
+    remaining = [args.requests] if args.requests else None
+
+    def take_request():
+        with samples_lock:
+            if time.monotonic() >= stop_at:
+                return None
+            if remaining is not None:
+                if remaining[0] <= 0:
+                    return None
+                remaining[0] -= 1
+            return next(sequence)
+
+    def worker(worker_id):
+        rng = random.Random(args.seed + worker_id)
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {token}"
+        while True:
+            number = take_request()
+            if number is None:
+                break
+            name = rng.choices(names, weights)[0]
+            try:
+                status, latency, first_event = send(session, args.app_url.rstrip("/") + ENDPOINTS[name], name,
+                                                    build_payload(name, number, args), args.timeout)
+            except requests.RequestException as e:
+                status, latency, first_event = type(e).__name__, args.timeout, None
+            with samples_lock:
+                samples[name].append((status, latency, first_event))
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.concurrency)]
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - wall_start
+
+    endpoints = {}
+    total = 0
+    for name, rows in samples.items():
+        if not rows:
+            continue
+        total += len(rows)
+        statuses = {}
+        for status, _, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        ok = [latency for status, latency, _ in rows if status == 200]
+        endpoints[name] = {
+            "requests": len(rows),
+            "ok": len(ok),
+            "throughput_rps": round(len(rows) / wall_seconds, 2),
+            "ok_rps": round(len(ok) / wall_seconds, 2),
+            "status_codes": statuses,
+            "latency_ms": _percentiles([latency for _, latency, _ in rows]),
+            "ok_latency_ms": _percentiles(ok),
+            "first_event_ms": _percentiles([f for _, _, f in rows if f is not None]),
+        }
+    return {
+        "wall_seconds": round(wall_seconds, 2),
+        "requests": total,
+        "throughput_rps": round(total / wall_seconds, 2) if wall_seconds else None,
+        "endpoints": endpoints,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the AI endpoints of a running app.")
+    parser.add_argument("--app-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--token", help="JWT to send (default: minted for --email)")
+    parser.add_argument("--email", help="user to mint a JWT for; must exist in the users table")
+    parser.add_argument("--jwt-secret", help="default: FLASK_SECRET_KEY from sb.env")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help="weighted endpoints, e.g. " + DEFAULT_MIX + " (also: autofill-info)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to keep sending")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0 = duration only)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--stream", action="store_true", help="request SSE from generate-notes and ai-tools")
+    parser.add_argument("--repeat-inputs", action="store_true",
+                        help="reuse identical inputs so the result cache and coalescing are exercised")
+    parser.add_argument("--project-id", help="scope generate and autofill requests to this project")
+    parser.add_argument("--ops-token", help="app OPS_API_TOKEN for /api/llm-usage (default: environment, then sb.env)")
+    parser.add_argument("--fake-url", help="fake Groq server whose /stats are added to the report")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    token = args.token
+    if not token:
+        if not args.email:
+            parser.error("pass --token or --email")
+        secret = args.jwt_secret or dotenv_values(os.path.join(API_DIR, "sb.env")).get("FLASK_SECRET_KEY")
+        if not secret:
+            parser.error("no --jwt-secret and no FLASK_SECRET_KEY in sb.env")
+        token = mint_token(args.email, secret)
+
+    results = run_load(args, token, args.mix)
+    report = {
+        "benchmark": "load",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "app_url": args.app_url,
+            "mix": args.mix,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "requests": args.requests,
+            "stream": args.stream,
+            "repeat_inputs": args.repeat_inputs,
+        },
+        "results": results,
+    }
+    ops_token = (args.ops_token or os.environ.get("OPS_API_TOKEN")
+                 or dotenv_values(os.path.join(API_DIR, "sb.env")).get("OPS_API_TOKEN"))
+    try:
+        if not ops_token:
+            raise ValueError("no --ops-token and no OPS_API_TOKEN configured")
+        usage = requests.get(args.app_url.rstrip("/") + "/api/llm-usage", timeout=5,
+                             headers={"X-Ops-Token": ops_token})
+        report["llm_usage"] = usage.json() if usage.status_code == 200 else {"status": usage.status_code}
+    except (requests.RequestException, ValueError) as e:
+        report["llm_usage"] = {"error": str(e)}
+    if args.fake_url:
+        try:
+            report["fake_groq"] = requests.get(args.fake_url.rstrip("/") + "/stats", timeout=5).json()
+        except (requests.RequestException, ValueError) as e:
+            report["fake_groq"] = {"error": str(e)}
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1026 @@
+"""
+LLM gateway: the single place the app talks to Groq.
+
+Owns the Groq client (pooled HTTP connections, timeouts, no SDK-level retries) and puts every call
+through admission control:
+  - a per-process cap on in-flight requests, and
+  - per-model token buckets (requests/minute and tokens/minute) whose state lives in a small
+    file guarded by fcntl.flock, so every thread and every gunicorn worker on the host shares one budget.
+
+A call that cannot be admitted within its max_wait is rejected with LLMOverloadedError (carrying a
+retry_after hint) instead of sleeping in the request worker. Upstream 429s are turned into a shared
+back-off window for that model so the other workers stop sending too.
+
+Failures are bounded by a per-call deadline: retries use full-jitter backoff (or the server's
+Retry-After) and only happen if they fit in the call's retry window (a few seconds for interactive
+calls, the whole deadline for background ingestion). The in-flight slot is not held while backing off. A per-model circuit breaker counts
+upstream failures and, while open, fails calls immediately with LLMUnavailableError. Callers on
+latency-sensitive paths can opt into hedging: a capped fraction of slow calls get a duplicate request.
+
+Every call is accounted per endpoint label and model (tokens from the response usage, queue wait,
+upstream latency, retries, coalesced and cache-served calls) in memory; usage_stats() reports it.
+
+Token budgeting is also pre-flight: prompt builders trim their inputs with input_budget/fit_text(s),
+and max_tokens is sized to whatever context the prompt leaves, so oversized prompts never reach Groq.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import types
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+from groq import APIConnectionError, APIStatusError, BadRequestError, Groq, RateLimitError
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: limiter state is then only shared between threads
+    fcntl = None
+
+# ==================== CONFIGURATION ====================
+
+# Per-model budgets shared by all workers on the host; opt-in, set them to the Groq account's limits.
+# Unset or 0 disables that bucket (upstream 429s still pause the model on every worker).
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE") or 0)
+LLM_TOKENS_PER_MINUTE = float(os.environ.get("LLM_TOKENS_PER_MINUTE") or 0)
+# Max concurrent Groq requests per worker process; also sizes the HTTP connection pool
+LLM_MAX_IN_FLIGHT = max(1, int(os.environ.get("LLM_MAX_IN_FLIGHT", 8)))
+# How long an interactive call may wait for admission before it is rejected (0 = reject immediately)
+LLM_ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("LLM_ADMISSION_MAX_WAIT_SECONDS", 0.5))
+# Ingestion chunk extraction is not user-facing per call, so it may queue for longer
+LLM_BACKGROUND_MAX_WAIT_SECONDS = float(os.environ.get("LLM_BACKGROUND_MAX_WAIT_SECONDS", 20))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", 60))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("LLM_CONNECT_TIMEOUT_SECONDS", 5))
+# Used when a 429 arrives without a Retry-After header
+LLM_DEFAULT_RETRY_AFTER_SECONDS = float(os.environ.get("LLM_DEFAULT_RETRY_AFTER_SECONDS", 5))
+# Every call has a deadline covering admission, attempts and backoff; retries only happen inside it
+LLM_REQUEST_DEADLINE_SECONDS = float(os.environ.get("LLM_REQUEST_DEADLINE_SECONDS", 20))
+LLM_BACKGROUND_DEADLINE_SECONDS = float(os.environ.get("LLM_BACKGROUND_DEADLINE_SECONDS", 90))
+# Interactive calls only retry while the backoff ends within this many seconds of the call's start, so an
+# incident fails user requests fast instead of parking request workers in backoff sleeps. Background
+# callers pass retry_window=deadline to keep retrying for their whole deadline.
+LLM_REQUEST_RETRY_WINDOW_SECONDS = float(os.environ.get("LLM_REQUEST_RETRY_WINDOW_SECONDS", 3))
+LLM_MAX_ATTEMPTS = max(1, int(os.environ.get("LLM_MAX_ATTEMPTS", 3)))
+# Full-jitter exponential backoff between attempts: uniform(0, min(cap, base * 2^attempt))
+LLM_BACKOFF_BASE_SECONDS = float(os.environ.get("LLM_BACKOFF_BASE_SECONDS", 0.5))
+LLM_BACKOFF_CAP_SECONDS = float(os.environ.get("LLM_BACKOFF_CAP_SECONDS", 8))
+# Circuit breaker per model: opens after this many consecutive upstream failures (5xx, timeouts,
+# connection errors), fails calls fast while open, then lets one probe through after the cool-down
+LLM_BREAKER_FAILURE_THRESHOLD = max(1, int(os.environ.get("LLM_BREAKER_FAILURE_THRESHOLD", 5)))
+LLM_BREAKER_OPEN_SECONDS = float(os.environ.get("LLM_BREAKER_OPEN_SECONDS", 30))
+# Point the client at another OpenAI-compatible Groq endpoint (e.g. bench/fake_groq_server.py for load tests)
+LLM_BASE_URL = os.environ.get("GROQ_BASE_URL") or None
+# Latency / queue-wait samples kept per endpoint and model for percentiles
+LLM_STATS_SAMPLES = max(1, int(os.environ.get("LLM_STATS_SAMPLES", 1000)))
+# Hedging (for calls made with hedge=True): once a call has run longer than the observed p95 latency
+# of its endpoint and model, a duplicate is sent and the first to finish wins. Hedges are capped at
+# this fraction of the hedge-eligible calls made in the last LLM_HEDGE_WINDOW_SECONDS (0 disables
+# hedging), so quiet hours do not bank a budget for the next slowdown, and need this many samples for the p95.
+LLM_HEDGE_MAX_FRACTION = float(os.environ.get("LLM_HEDGE_MAX_FRACTION", 0.05))
+LLM_HEDGE_WINDOW_SECONDS = float(os.environ.get("LLM_HEDGE_WINDOW_SECONDS", 60))
+LLM_HEDGE_MIN_SAMPLES = max(1, int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", 20)))
+# Both halves of a hedged call run on one shared pool of this many threads; when it is busy, calls
+# run unhedged in the caller's thread instead of queueing
+LLM_HEDGE_THREADS = max(2, int(os.environ.get("LLM_HEDGE_THREADS", 2 * LLM_MAX_IN_FLIGHT)))
+LLM_RATE_LIMIT_STATE_PATH = os.environ.get("LLM_RATE_LIMIT_STATE_PATH", os.path.join("llm_ratelimit.json"))
+
+# Context window (prompt + completion tokens) per model
+MODEL_CONTEXT_TOKENS = {
+    "gemma2-9b-it": 8192,
+    "compound-beta-mini": 131072,
+}
+DEFAULT_MODEL_CONTEXT_TOKENS = 8192
+# Headroom for chat formatting tokens and estimation error
+LLM_CONTEXT_SAFETY_TOKENS = 256
+# A completion budget below this means the prompt was not trimmed; refuse instead of sending it
+LLM_MIN_COMPLETION_TOKENS = 64
+
+
+class LLMPromptTooLargeError(ValueError):
+    """Raised before sending when a prompt leaves no room for the completion in the model's context."""
+
+
+class LLMOverloadedError(Exception):
+    """Raised when a call is not admitted (local budget exhausted or upstream 429) within its deadline."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(0.0, float(retry_after))
+
+
+class LLMUnavailableError(LLMOverloadedError):
+    """Raised when Groq is failing: the circuit is open, or upstream errors outlasted the call's deadline."""
+
+
+class _HedgeSuperseded(LLMOverloadedError):
+    """Raised inside the losing half of a hedged call so it stops before its next attempt."""
+
+
+# ==================== TOKEN BUCKETS ====================
+
+class SharedTokenBucketLimiter:
+    """
+    Per-model requests/minute and tokens/minute buckets.
+    State is a JSON file read-modify-written under an exclusive flock, plus a thread lock
+    (flock alone does not serialize threads sharing one process).
+    """
+
+    def __init__(self, state_path, requests_per_minute, tokens_per_minute):
+        self.state_path = state_path
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._thread_lock = threading.Lock()
+        self._memory_state = {}
+
+    def _refill(self, bucket, now):
+        elapsed = max(0.0, now - bucket.get("updated", now))
+        if self.requests_per_minute:
+            bucket["requests"] = min(self.requests_per_minute,
+                                     bucket.get("requests", self.requests_per_minute) + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            bucket["tokens"] = min(self.tokens_per_minute,
+                                   bucket.get("tokens", self.tokens_per_minute) + elapsed * self.tokens_per_minute / 60)
+        bucket["updated"] = now
+        return bucket
+
+    def _with_state(self, mutate):
+        """
+        Runs mutate(state) -> (result, changed) with exclusive access to the shared state and returns result.
+        The state file is only rewritten when mutate reports a change.
+        """
+        with self._thread_lock:
+            if fcntl is None:
+                return mutate(self._memory_state)[0]
+            # Opened per call: a descriptor inherited across fork would share its flock with the parent
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                raw = b""
+                while True:
+                    block = os.read(fd, 65536)
+                    if not block:
+                        break
+                    raw += block
+                try:
+                    state = json.loads(raw) if raw else {}
+                except ValueError:
+                    state = {}  # A torn write only loses the current refill level
+                result, changed = mutate(state)
+                if changed:
+                    encoded = json.dumps(state).encode("utf-8")
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.ftruncate(fd, 0)
+                    os.write(fd, encoded)
+                return result
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def try_acquire(self, model, tokens):
+        """
+        Takes one request and `tokens` tokens from the model's buckets.
+        Returns 0.0 when admitted, otherwise the seconds until the call could be admitted (nothing is taken).
+        A back-off window set by block() applies even when both buckets are disabled.
+        """
+        def mutate(state):
+            now = time.time()
+            bucket = self._refill(state.setdefault(model, {}), now)
+            blocked_for = bucket.get("blocked_until", 0) - now
+            if blocked_for > 0:
+                return blocked_for, False
+            if not self.requests_per_minute and not self.tokens_per_minute:
+                return 0.0, False
+            wait = 0.0
+            if self.requests_per_minute and bucket["requests"] < 1:
+                wait = max(wait, (1 - bucket["requests"]) * 60 / self.requests_per_minute)
+            # A single call larger than the whole bucket is admitted once the bucket is full
+            needed = min(tokens, self.tokens_per_minute)
+            if self.tokens_per_minute and bucket["tokens"] < needed:
+                wait = max(wait, (needed - bucket["tokens"]) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return wait, False  # Nothing taken; the refill is recomputed from "updated" next time
+            if self.requests_per_minute:
+                bucket["requests"] -= 1
+            if self.tokens_per_minute:
+                bucket["tokens"] -= tokens
+            return 0.0, True
+
+        return self._with_state(mutate)
+
+    def adjust_tokens(self, model, delta):
+        """Reconciles the token bucket with actual usage (delta > 0 refunds, < 0 charges; may go into debt)."""
+        if not self.tokens_per_minute or not delta:
+            return
+
+        def mutate(state):
+            bucket = self._refill(state.setdefault(model, {}), time.time())
+            bucket["tokens"] = min(self.tokens_per_minute, bucket["tokens"] + delta)
+            return None, True
+
+        self._with_state(mutate)
+
+    def refund(self, model, tokens):
+        """Gives back the request and tokens taken by a try_acquire whose call was never sent."""
+        if not self.requests_per_minute and not self.tokens_per_minute:
+            return
+
+        def mutate(state):
+            bucket = self._refill(state.setdefault(model, {}), time.time())
+            if self.requests_per_minute:
+                bucket["requests"] = min(self.requests_per_minute, bucket["requests"] + 1)
+            if self.tokens_per_minute:
+                bucket["tokens"] = min(self.tokens_per_minute, bucket["tokens"] + tokens)
+            return None, True
+
+        self._with_state(mutate)
+
+    def block(self, model, seconds):
+        """Stops admitting calls for this model on every worker for `seconds` (after an upstream 429)."""
+        def mutate(state):
+            now = time.time()
+            bucket = self._refill(state.setdefault(model, {}), now)
+            bucket["blocked_until"] = max(bucket.get("blocked_until", 0), now + seconds)
+            return None, True
+
+        self._with_state(mutate)
+
+
+# ==================== TOKEN BUDGETS ====================
+
+def estimate_tokens(text):
+    """Cheap token estimate for English text: ~4 characters per token, never fewer tokens than words."""
+    if not text:
+        return 0
+    return max(len(text) // 4, len(text.split()))
+
+
+def estimate_messages_tokens(messages):
+    # ~4 tokens of chat formatting per message
+    return sum(estimate_tokens(str(m.get("content", ""))) for m in messages) + 4 * len(messages)
+
+
+def context_window(model):
+    return MODEL_CONTEXT_TOKENS.get(model, DEFAULT_MODEL_CONTEXT_TOKENS)
+
+
+def input_budget(model, reserve_output_tokens, fixed_text=""):
+    """Tokens left for a prompt's variable inputs once its fixed text and the output reservation are accounted for."""
+    return max(0, context_window(model) - LLM_CONTEXT_SAFETY_TOKENS - reserve_output_tokens - estimate_tokens(fixed_text) - 4)
+
+
+def completion_budget(model, messages, requested_max_tokens):
+    """max_tokens sized to what is left of the context window after the prompt."""
+    remaining = context_window(model) - LLM_CONTEXT_SAFETY_TOKENS - estimate_messages_tokens(messages)
+    return max(0, min(requested_max_tokens, remaining))
+
+
+def fit_text(text, max_tokens):
+    """Trims text to about max_tokens, cutting at a paragraph, line, sentence or word boundary when one is near."""
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    limit = max_tokens * 4
+    cut = text[:limit]
+    for separator in ("\n\n", "\n", ". ", " "):
+        index = cut.rfind(separator)
+        if index >= limit * 0.8:
+            cut = cut[:index + len(separator)]
+            break
+    # Word-dense text can still be over budget by the word count
+    while cut and estimate_tokens(cut) > max_tokens:
+        cut = cut[:int(len(cut) * 0.9)]
+    return cut.rstrip()
+
+
+def fit_texts(texts, max_tokens):
+    """
+    Trims several inputs to share max_tokens fairly: inputs under their fair share are kept whole,
+    and the budget they leave is split between the larger ones.
+    """
+    sizes = [estimate_tokens(text) for text in texts]
+    if sum(sizes) <= max_tokens:
+        return list(texts)
+    allowances = [0] * len(texts)
+    remaining_budget = max(0, max_tokens)
+    pending = sorted(range(len(texts)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining_budget // len(pending)
+        index = pending.pop(0)
+        allowances[index] = min(sizes[index], share)
+        remaining_budget -= allowances[index]
+    return [fit_text(text, allowance) for text, allowance in zip(texts, allowances)]
+
+
+# ==================== CIRCUIT BREAKER ====================
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive upstream failures; open calls fail fast with
+    LLMUnavailableError; after `open_seconds` one probe call is let through (half_open) and its
+    outcome closes or re-opens the circuit. Per process: each worker learns about an outage itself.
+    """
+
+    def __init__(self, name, failure_threshold, open_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    raise LLMUnavailableError(f"Circuit open for {self.name}", retry_after=remaining)
+                self.state = "half_open"
+                self.probe_in_flight = False
+            if self.state == "half_open":
+                if self.probe_in_flight:
+                    raise LLMUnavailableError(f"Circuit half-open for {self.name}; probe in flight", retry_after=1.0)
+                self.probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"Circuit for {self.name} closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                    print(f"Circuit for {self.name} opened after {self.consecutive_failures} consecutive failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_neutral(self):
+        """Outcome that says nothing about upstream health (e.g. 4xx); frees a half-open probe slot."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened
+            }
+            if self.state == "open":
+                snapshot["retry_in_seconds"] = round(max(0.0, self.opened_at + self.open_seconds - time.monotonic()), 1)
+            return snapshot
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _breaker_for(model):
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = _breakers[model] = CircuitBreaker(model, LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_OPEN_SECONDS)
+        return breaker
+
+
+def breaker_states():
+    """Breaker state per model that has been called in this worker (for /health)."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+
+# ==================== ACCOUNTING ====================
+
+def _percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+class CallStats:
+    """Running totals and recent latency samples for one (endpoint, model) pair."""
+
+    def __init__(self, endpoint, model):
+        self.endpoint = endpoint
+        self.model = model
+        self.outcomes = collections.Counter()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.queue_wait_ms = collections.deque(maxlen=LLM_STATS_SAMPLES)
+        self.latency_ms = collections.deque(maxlen=LLM_STATS_SAMPLES)
+        self._lock = threading.Lock()
+
+    def record(self, outcome, prompt_tokens=0, completion_tokens=0, queue_wait_ms=None, latency_ms=None, retries=0):
+        with self._lock:
+            self.outcomes[outcome] += 1
+            self.prompt_tokens += prompt_tokens or 0
+            self.completion_tokens += completion_tokens or 0
+            self.retries += retries
+            if queue_wait_ms is not None:
+                self.queue_wait_ms.append(queue_wait_ms)
+            if latency_ms is not None and outcome == "ok":
+                self.latency_ms.append(latency_ms)
+
+    def record_hedge(self, won=False):
+        with self._lock:
+            if won:
+                self.hedge_wins += 1
+            else:
+                self.hedges += 1
+
+    def latency_p95_seconds(self, min_samples):
+        """Observed p95 upstream latency, or None until min_samples successful calls have been seen."""
+        with self._lock:
+            if len(self.latency_ms) < min_samples:
+                return None
+            samples = list(self.latency_ms)
+        return _percentiles(samples)["p95"] / 1000
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "endpoint": self.endpoint,
+                "model": self.model,
+                "calls": sum(self.outcomes.values()),
+                "outcomes": dict(self.outcomes),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "queue_wait_ms": _percentiles(self.queue_wait_ms),
+                "latency_ms": _percentiles(self.latency_ms)
+            }
+
+
+_call_stats = {}
+_call_stats_lock = threading.Lock()
+_stats_started_at = time.time()
+
+
+def _stats_for(endpoint, model):
+    key = (endpoint or "unlabelled", model)
+    with _call_stats_lock:
+        stats = _call_stats.get(key)
+        if stats is None:
+            stats = _call_stats[key] = CallStats(key[0], model)
+        return stats
+
+
+def _new_trace():
+    now = time.monotonic()
+    return {"started": now, "sent_at": now, "queue_wait_ms": 0.0, "attempts": 0, "upstream_ms": None}
+
+
+def _usage_tokens(usage):
+    if usage is None:
+        return None, None
+    return getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+
+
+def _record_call(endpoint, model, trace, outcome, usage=None):
+    prompt_tokens, completion_tokens = _usage_tokens(usage)
+    latency_ms = trace["upstream_ms"]
+    if latency_ms is None:
+        latency_ms = (time.monotonic() - trace["started"]) * 1000
+    _stats_for(endpoint, model).record(
+        outcome, prompt_tokens, completion_tokens, round(trace["queue_wait_ms"], 1), round(latency_ms, 1),
+        max(0, trace["attempts"] - 1)
+    )
+    print(
+        f"LLM call endpoint={endpoint or 'unlabelled'} model={model} outcome={outcome} "
+        f"prompt_tokens={prompt_tokens} completion_tokens={completion_tokens} "
+        f"queue_wait_ms={trace['queue_wait_ms']:.0f} latency_ms={latency_ms:.0f} attempts={trace['attempts']}"
+    )
+
+
+def _outcome_for(error):
+    if isinstance(error, _HedgeSuperseded):
+        return "superseded"
+    if isinstance(error, LLMUnavailableError):
+        return "unavailable"
+    if isinstance(error, LLMOverloadedError):
+        return "overloaded"
+    if isinstance(error, LLMPromptTooLargeError):
+        return "prompt_too_large"
+    return "error"
+
+
+def record_cache_hit(endpoint, model):
+    """Counts a call answered from an application-level result cache (no upstream request)."""
+    _stats_for(endpoint, model).record("cache_hit")
+
+
+def usage_stats():
+    """Per endpoint/model accounting for this worker process since it started, plus per-model token totals."""
+    with _call_stats_lock:
+        entries = list(_call_stats.values())
+    calls = [stats.snapshot() for stats in entries]
+    models = {}
+    for entry in calls:
+        totals = models.setdefault(entry["model"], {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        totals["calls"] += entry["calls"]
+        totals["prompt_tokens"] += entry["prompt_tokens"]
+        totals["completion_tokens"] += entry["completion_tokens"]
+    return {
+        "pid": os.getpid(),
+        "since": _stats_started_at,
+        "models": models,
+        "calls": sorted(calls, key=lambda entry: (entry["endpoint"], entry["model"]))
+    }
+
+
+def reset_usage_stats():
+    global _stats_started_at
+    with _call_stats_lock:
+        _call_stats.clear()
+        _stats_started_at = time.time()
+
+
+# ==================== CLIENT ====================
+
+_api_key = None
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_in_flight = threading.BoundedSemaphore(LLM_MAX_IN_FLIGHT)
+_limiter = SharedTokenBucketLimiter(LLM_RATE_LIMIT_STATE_PATH, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+
+
+def configure(api_key):
+    """Sets the Groq API key. The client itself is built lazily, once per process."""
+    global _api_key, _client
+    with _client_lock:
+        _api_key = api_key
+        _client = None
+
+
+def set_client(client):
+    """Replaces the Groq client (benchmarks and local fakes). It is kept across forks."""
+    global _client, _client_pid
+    with _client_lock:
+        _client = client
+        _client_pid = None
+
+
+def get_client():
+    global _client, _client_pid
+    with _client_lock:
+        # Connection pools must not be shared across fork, so each worker process builds its own
+        if _client is None or (_client_pid is not None and _client_pid != os.getpid()):
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=LLM_MAX_IN_FLIGHT, max_keepalive_connections=LLM_MAX_IN_FLIGHT),
+                timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+            )
+            # Retries are handled by admission control, not by sleeping inside the SDK
+            _client = Groq(api_key=_api_key, base_url=LLM_BASE_URL, http_client=http_client, max_retries=0)
+            _client_pid = os.getpid()
+        return _client
+
+
+def _retry_after_seconds(error):
+    try:
+        value = error.response.headers.get("retry-after")
+        if value is not None:
+            return float(value)
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return LLM_DEFAULT_RETRY_AFTER_SECONDS
+
+
+def _admit(model, tokens, max_wait):
+    """Waits at most max_wait for a rate-limit slot and an in-flight slot; raises LLMOverloadedError otherwise."""
+    deadline = time.monotonic() + max_wait
+    while True:
+        wait = _limiter.try_acquire(model, tokens)
+        if wait <= 0:
+            break
+        remaining = deadline - time.monotonic()
+        if wait > remaining:
+            raise LLMOverloadedError(f"LLM rate limit reached for {model}", retry_after=wait)
+        time.sleep(wait)  # Bounded by max_wait, and only when the slot is known to open in time
+
+    remaining = max(0.0, deadline - time.monotonic())
+    acquired = _in_flight.acquire(timeout=remaining) if remaining > 0 else _in_flight.acquire(blocking=False)
+    if not acquired:
+        _limiter.refund(model, tokens)  # Give back what was taken from the buckets
+        raise LLMOverloadedError("Too many LLM requests in flight", retry_after=1.0)
+
+
+# ==================== SINGLE-FLIGHT ====================
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.followers = 0
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _flight_key(endpoint, model, messages, params):
+    """Identical endpoint + model + prompt (which embeds the user's context) + sampling params share a flight."""
+    material = json.dumps([endpoint, model, messages, params], sort_keys=True, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def _single_flight(key, call, wait_timeout, on_follow=None):
+    """
+    Runs call() once per key at a time: concurrent callers with the same key wait for the leader
+    and receive its response (or its exception) instead of issuing their own upstream request.
+    on_follow(error) is called in each follower once the leader's outcome is known.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+        else:
+            flight.followers += 1
+
+    if not leader:
+        if not flight.done.wait(wait_timeout):
+            error = LLMOverloadedError("Timed out waiting for an identical in-flight LLM request", retry_after=1.0)
+            if on_follow:
+                on_follow(error)
+            raise error
+        if on_follow:
+            on_follow(flight.error)
+        if flight.error is not None:
+            raise flight.error
+        return flight.response
+
+    try:
+        flight.response = call()
+        return flight.response
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        if flight.followers:
+            print(f"Coalesced {flight.followers} duplicate LLM request(s) onto one upstream call")
+        flight.done.set()
+
+
+def chat_completion(messages, model, max_wait=None, deadline=None, endpoint=None, coalesce=True, hedge=False,
+                    retry_window=None, **params):
+    """
+    Sends one chat completion through admission control and returns the SDK response.
+    params are passed to chat.completions.create (temperature, max_tokens, response_format, ...).
+    deadline (seconds, default LLM_REQUEST_DEADLINE_SECONDS) bounds the whole call including retries;
+    retries also have to finish backing off within retry_window (default LLM_REQUEST_RETRY_WINDOW_SECONDS).
+    Concurrent identical calls (same endpoint label, model, messages and params) are coalesced into one
+    upstream request whose response every caller receives; pass coalesce=False to opt out.
+    hedge=True sends a duplicate once the call outlives the endpoint's observed p95 (see _hedged_completion).
+    Raises LLMOverloadedError when the call is shed, LLMUnavailableError when Groq is failing;
+    other Groq errors (e.g. 4xx) propagate unchanged.
+    """
+    if max_wait is None:
+        max_wait = LLM_ADMISSION_MAX_WAIT_SECONDS
+    if deadline is None:
+        deadline = LLM_REQUEST_DEADLINE_SECONDS
+    if retry_window is None:
+        retry_window = LLM_REQUEST_RETRY_WINDOW_SECONDS
+    if hedge:
+        call = lambda: _hedged_completion(messages, model, max_wait, deadline, params, endpoint, retry_window)
+    else:
+        call = lambda: _chat_completion(messages, model, max_wait, deadline, params, endpoint, retry_window=retry_window)
+    if not coalesce:
+        return call()
+    key = _flight_key(endpoint, model, messages, params)
+    # A follower waits at most as long as the leader can take
+    wait_timeout = deadline + LLM_CONNECT_TIMEOUT_SECONDS
+    trace = _new_trace()
+
+    def on_follow(error):
+        _record_call(endpoint, model, trace, "coalesced" if error is None else _outcome_for(error))
+
+    return _single_flight(key, call, wait_timeout, on_follow)
+
+
+def _fit_completion_params(model, messages, params):
+    """Sizes max_tokens to the context left after the prompt, so oversized requests never reach Groq."""
+    if params.get("max_tokens") is None:
+        return params
+    max_tokens = completion_budget(model, messages, params["max_tokens"])
+    if max_tokens < min(LLM_MIN_COMPLETION_TOKENS, params["max_tokens"]):
+        raise LLMPromptTooLargeError(
+            f"Prompt of ~{estimate_messages_tokens(messages)} tokens does not fit the {context_window(model)}-token context of {model}"
+        )
+    return dict(params, max_tokens=max_tokens)
+
+
+def _is_upstream_failure(error):
+    """Errors that say Groq itself is unhealthy: timeouts, connection failures and 5xx responses."""
+    if isinstance(error, APIConnectionError):  # includes APITimeoutError
+        return True
+    return isinstance(error, APIStatusError) and getattr(error, "status_code", 0) >= 500
+
+
+def _backoff_seconds(error, attempt):
+    """Retry-After when the server sent one, otherwise full-jitter exponential backoff."""
+    try:
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after is not None:
+            return float(retry_after)
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return random.uniform(0, min(LLM_BACKOFF_CAP_SECONDS, LLM_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+def _send(messages, model, max_wait, deadline_seconds, params, trace, stream=False, cancel=None, retry_window=None):
+    """
+    Sends one request with admission control, the model's circuit breaker and deadline-bounded retries.
+    Returns (response, reserved_tokens) with the in-flight slot still held; the caller releases it.
+    trace collects queue wait, attempts and the upstream latency of the successful attempt.
+    Once the cancel event is set (the other half of a hedge won) no further attempt is started.
+      - circuit open: LLMUnavailableError immediately
+      - 429: the model is paused for Retry-After on every worker; retried if that fits the retry window
+      - timeouts / connection errors / 5xx: counted by the breaker; retried with jittered backoff
+        (or Retry-After) while attempts and the retry window allow
+      - json_validate_failed: retried once immediately
+    Retries must finish backing off within retry_window seconds of the start (default: the whole deadline),
+    and the in-flight slot is released before any backoff so a sleeping call does not hold capacity.
+    """
+    params = _fit_completion_params(model, messages, params)
+    client = get_client()
+    breaker = _breaker_for(model)
+    # Only the prompt is reserved up front; the completion is charged once usage is known
+    reserved = estimate_messages_tokens(messages)
+    deadline = time.monotonic() + deadline_seconds
+    retry_deadline = deadline if retry_window is None else min(deadline, time.monotonic() + retry_window)
+    json_retry_used = False
+    attempt = 0
+
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise _HedgeSuperseded("Hedged LLM request superseded", retry_after=0.0)
+        attempt += 1
+        trace["attempts"] = attempt
+        breaker.before_call()
+        queued_at = time.monotonic()
+        try:
+            _admit(model, reserved, min(max_wait, max(0.0, deadline - time.monotonic())))
+        except LLMOverloadedError:
+            breaker.record_neutral()
+            raise
+        finally:
+            trace["queue_wait_ms"] += (time.monotonic() - queued_at) * 1000
+        timeout = max(1.0, min(LLM_TIMEOUT_SECONDS, deadline - time.monotonic()))
+        sent_at = time.monotonic()
+        try:
+            extra = {"stream": True} if stream else {}
+            response = client.chat.completions.create(messages=messages, model=model, timeout=timeout, **extra, **params)
+        except Exception as e:
+            _in_flight.release()  # Not held while backing off or raising
+            if isinstance(e, RateLimitError):
+                breaker.record_neutral()
+                delay = _retry_after_seconds(e)
+                _limiter.block(model, delay)
+                print(f"Groq rate limited {model}; pausing calls for {delay:.1f}s")
+                failure = LLMOverloadedError(f"Groq rate limit reached for {model}", retry_after=delay)
+            elif _is_upstream_failure(e):
+                breaker.record_failure()
+                delay = _backoff_seconds(e, attempt)
+                failure = LLMUnavailableError(f"Groq request failed for {model}: {e}", retry_after=max(delay, 1.0))
+            elif isinstance(e, BadRequestError) and "json_validate_failed" in str(e) and not json_retry_used:
+                breaker.record_neutral()
+                print(f"Groq JSON validation failed for {model}; retrying once")
+                json_retry_used = True
+                attempt -= 1
+                continue
+            else:
+                breaker.record_neutral()
+                raise
+
+            # Retry only when the wait (plus the next attempt's admission) still fits the retry window
+            if attempt < LLM_MAX_ATTEMPTS and time.monotonic() + delay < retry_deadline:
+                print(f"Retrying {model} in {delay:.2f}s (attempt {attempt + 1}/{LLM_MAX_ATTEMPTS})")
+                time.sleep(delay)
+                continue
+            raise failure from e
+
+        breaker.record_success()
+        trace["sent_at"] = sent_at
+        trace["upstream_ms"] = (time.monotonic() - sent_at) * 1000
+        return response, reserved
+
+
+def _chat_completion(messages, model, max_wait, deadline_seconds, params, endpoint=None, cancel=None, retry_window=None):
+    trace = _new_trace()
+    try:
+        response, reserved = _send(messages, model, max_wait, deadline_seconds, params, trace, cancel=cancel,
+                                   retry_window=retry_window)
+    except Exception as e:
+        _record_call(endpoint, model, trace, _outcome_for(e))
+        raise
+    _in_flight.release()
+    usage = getattr(response, "usage", None)
+    if usage is not None and getattr(usage, "total_tokens", None) is not None:
+        _limiter.adjust_tokens(model, reserved - usage.total_tokens)
+    _record_call(endpoint, model, trace, "ok", usage)
+    return response
+
+
+# ==================== HEDGING ====================
+
+# Start times of hedge-eligible calls and of fired hedges within the last LLM_HEDGE_WINDOW_SECONDS
+_hedge_window = {"eligible": collections.deque(), "fired": collections.deque()}
+_hedge_lock = threading.Lock()
+
+
+def _prune_hedge_window(now):
+    horizon = now - LLM_HEDGE_WINDOW_SECONDS
+    for times in _hedge_window.values():
+        while times and times[0] < horizon:
+            times.popleft()
+
+
+def _record_hedge_eligible():
+    with _hedge_lock:
+        now = time.monotonic()
+        _prune_hedge_window(now)
+        _hedge_window["eligible"].append(now)
+
+
+def _take_hedge_budget():
+    """Allows a hedge while recent hedges stay under LLM_HEDGE_MAX_FRACTION of recent hedge-eligible calls."""
+    with _hedge_lock:
+        now = time.monotonic()
+        _prune_hedge_window(now)
+        if len(_hedge_window["fired"]) + 1 > LLM_HEDGE_MAX_FRACTION * len(_hedge_window["eligible"]):
+            return False
+        _hedge_window["fired"].append(now)
+        return True
+
+
+_hedge_pool = ThreadPoolExecutor(max_workers=LLM_HEDGE_THREADS, thread_name_prefix="llm-hedge")
+# Free hedge pool threads; taken before submitting so work never queues behind busy threads
+_hedge_threads = threading.BoundedSemaphore(LLM_HEDGE_THREADS)
+
+
+def _submit_hedge_task(call):
+    """Runs call on the hedge pool. The caller holds a _hedge_threads slot; it is released when call finishes."""
+    try:
+        future = _hedge_pool.submit(call)
+    except BaseException:
+        _hedge_threads.release()
+        raise
+    future.add_done_callback(lambda _future: _hedge_threads.release())
+    return future
+
+
+def _hedged_completion(messages, model, max_wait, deadline_seconds, params, endpoint, retry_window=None):
+    """
+    Runs the call; if it has not returned after the observed p95 latency for this endpoint and model,
+    sends one duplicate (admitted only if capacity is free right now) and returns whichever succeeds
+    first. Both run on the shared hedge pool; without a free pool thread the call runs unhedged.
+    The loser cannot be aborted mid-request by the SDK, so it is superseded instead: it starts no further
+    attempts, its in-flight slot is released as soon as its request finishes (by _chat_completion, as for
+    any call) and its result is discarded (its tokens are still accounted).
+    """
+    stats = _stats_for(endpoint, model)
+    _record_hedge_eligible()
+    delay = stats.latency_p95_seconds(LLM_HEDGE_MIN_SAMPLES) if LLM_HEDGE_MAX_FRACTION > 0 else None
+    if delay is None or delay >= deadline_seconds or not _hedge_threads.acquire(blocking=False):
+        return _chat_completion(messages, model, max_wait, deadline_seconds, params, endpoint, retry_window=retry_window)
+
+    started = time.monotonic()
+    cancel = threading.Event()
+    primary = _submit_hedge_task(
+        lambda: _chat_completion(messages, model, max_wait, deadline_seconds, params, endpoint, cancel, retry_window)
+    )
+    done, _ = wait([primary], timeout=delay)
+    if done or not _hedge_threads.acquire(blocking=False):
+        return primary.result()
+    if not _take_hedge_budget():
+        _hedge_threads.release()
+        return primary.result()
+
+    stats.record_hedge()
+    remaining = max(0.0, deadline_seconds - (time.monotonic() - started))
+    print(f"Hedging {endpoint or 'unlabelled'} on {model} after {delay:.2f}s")
+    secondary_window = None if retry_window is None else max(0.0, retry_window - (time.monotonic() - started))
+    secondary = _submit_hedge_task(
+        lambda: _chat_completion(messages, model, 0.0, remaining, params, endpoint, cancel, secondary_window)
+    )
+
+    pending = {primary, secondary}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                cancel.set()
+                if future is secondary:
+                    stats.record_hedge(won=True)
+                return future.result()
+    # Both failed: the primary's error describes the call better than a shed hedge's
+    return primary.result()
+
+
+# ==================== STREAMING ====================
+
+class CompletionStream:
+    """
+    Iterator of text deltas from a streamed chat completion. Holds its in-flight slot until exhausted
+    or closed; close() is idempotent so it can be called both by the consumer and on disconnect.
+    """
+
+    def __init__(self, stream, model, reserved, endpoint=None, trace=None):
+        self._stream = stream
+        self._model = model
+        self._reserved = reserved
+        self._endpoint = endpoint
+        self._trace = trace or _new_trace()
+        self._completion_chars = 0
+        self._usage = None
+        self._finished = False
+        self._closed = False
+        self._close_lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                # Groq reports usage on the final chunk under x_groq
+                usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+                if usage is not None and getattr(usage, "total_tokens", None) is not None:
+                    self._usage = usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    self._completion_chars += len(delta)
+                    yield delta
+            self._finished = True
+        finally:
+            self.close()
+
+    def close(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            close = getattr(self._stream, "close", None)
+            if close:
+                close()
+        finally:
+            _in_flight.release()
+            usage = self._usage
+            used = usage.total_tokens if usage is not None else self._reserved + self._completion_chars // 4
+            _limiter.adjust_tokens(self._model, self._reserved - used)
+            # Streamed latency runs from sending until the last delta (or the client disconnecting)
+            self._trace["upstream_ms"] = (time.monotonic() - self._trace["sent_at"]) * 1000
+            if usage is None:
+                usage = types.SimpleNamespace(prompt_tokens=self._reserved, completion_tokens=self._completion_chars // 4)
+            _record_call(self._endpoint, self._model, self._trace, "ok" if self._finished else "cancelled", usage)
+
+
+def chat_completion_stream(messages, model, max_wait=None, deadline=None, endpoint=None, retry_window=None, **params):
+    """
+    Like chat_completion, but streams: returns a CompletionStream yielding text deltas as Groq sends them.
+    Admission, the breaker check and the upstream request (with retries within the retry window) happen before
+    this returns, so LLMOverloadedError is raised here (before any response bytes are written) rather than mid-stream.
+    """
+    if max_wait is None:
+        max_wait = LLM_ADMISSION_MAX_WAIT_SECONDS
+    if deadline is None:
+        deadline = LLM_REQUEST_DEADLINE_SECONDS
+    if retry_window is None:
+        retry_window = LLM_REQUEST_RETRY_WINDOW_SECONDS
+    trace = _new_trace()
+    try:
+        stream, reserved = _send(messages, model, max_wait, deadline, params, trace, stream=True, retry_window=retry_window)
+    except Exception as e:
+        _record_call(endpoint, model, trace, _outcome_for(e))
+        raise
+    return CompletionStream(stream, model, reserved, endpoint, trace)
@@ -0,0 +1,54 @@
+-- Split the file_imports payload into independently selectable columns.
+--
+-- Until now every processed file was stored as one JSON string in file_imports.compressed_text
+-- ({"structured_data", "compressed_text", ...} and, for /import-file, the full "extracted_text"), so
+-- every reader downloaded the whole document just to use its study elements or summary.
+--
+--   extracted_text   raw extracted text (only written by /import-file; large)
+--   structured_data  study elements: terms, definitions, examples, questions, answers
+--   summary_text     NLTK compressed text
+--   metadata         remaining processing details (lengths, doc_type, stage metrics, ...)
+--
+-- Apply before deploying the app version that writes these columns. Existing rows are backfilled
+-- and their compressed_text cleared; the app still reads compressed_text for any row whose new
+-- columns are empty. Safe to re-run.
+
+alter table public.file_imports
+    add column if not exists extracted_text text,
+    add column if not exists structured_data jsonb,
+    add column if not exists summary_text text,
+    add column if not exists metadata jsonb;
+
+create or replace function pg_temp.try_jsonb(value text) returns jsonb
+language plpgsql immutable as $$
+begin
+    return value::jsonb;
+exception when others then
+    return null;
+end;
+$$;
+
+with parsed as (
+    select id, pg_temp.try_jsonb(compressed_text) as blob
+    from public.file_imports
+    where compressed_text is not null
+      and structured_data is null
+      and summary_text is null
+)
+update public.file_imports f
+set
+    extracted_text = case when jsonb_typeof(p.blob) = 'object' then p.blob ->> 'extracted_text' end,
+    -- The oldest rows hold the study elements at the top level of the blob
+    structured_data = case when jsonb_typeof(p.blob) = 'object' then coalesce(p.blob -> 'structured_data', p.blob) end,
+    -- A blob that is not JSON is the compressed text itself
+    summary_text = case
+        when p.blob is null then f.compressed_text
+        when jsonb_typeof(p.blob) = 'object' then p.blob ->> 'compressed_text'
+    end,
+    metadata = case
+        when jsonb_typeof(p.blob) = 'object' and p.blob ? 'structured_data'
+        then p.blob - 'extracted_text' - 'structured_data' - 'compressed_text'
+    end,
+    compressed_text = case when p.blob is null or jsonb_typeof(p.blob) = 'object' then null else f.compressed_text end
+from parsed p
+where f.id = p.id;
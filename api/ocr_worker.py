@@ -0,0 +1,30 @@
+"""
+Functions run inside the OCR process pool.
+
+Kept apart from app.py so pool workers started with spawn/forkserver only import PIL and pytesseract,
+not the Flask app, its Supabase client and background threads. Arguments must be picklable.
+"""
+
+import pytesseract
+from PIL import Image
+
+SPARSE_TEXT_PSM = 11
+
+
+def image_has_text(gray_img, scale=1.0):
+    """Cheap sparse-text OCR pass over a copy of the image scaled by `scale`; True if it reads anything."""
+    if scale < 1.0:
+        gray_img = gray_img.resize((max(1, round(gray_img.width * scale)), max(1, round(gray_img.height * scale))))
+    text = pytesseract.image_to_string(gray_img, config=f"--psm {SPARSE_TEXT_PSM}")
+    return any(ch.isalnum() for ch in text)
+
+
+def ocr_page_image(width, height, samples, psm=3, blank_check_scale=None):
+    """
+    OCR a rendered grayscale page. blank_check_scale is set for pages that looked blank from their
+    thumbnail: image_has_text runs first at that scale, and "" is returned if it finds nothing.
+    """
+    img = Image.frombytes("L", [width, height], samples)
+    if blank_check_scale is not None and not image_has_text(img, blank_check_scale):
+        return ""
+    return pytesseract.image_to_string(img, config=f"--psm {psm}")
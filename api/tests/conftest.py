@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(API_DIR, "bench"))
+sys.path.insert(0, API_DIR)
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """app.py imported from a scratch working directory (it creates its folders and reads *.env from the cwd)."""
+    from bench_ingest import _prepare_workdir
+
+    cwd = os.getcwd()
+    _prepare_workdir(str(tmp_path_factory.mktemp("workdir")))
+    try:
+        import app as app_module
+        # Its folders and databases are relative to the cwd; keep them in the scratch directory
+        for name in ("INGEST_CACHE_FOLDER", "CHUNK_CACHE_FOLDER", "INGEST_JOBS_DB_PATH", "STUDY_CONTEXT_DB_PATH"):
+            setattr(app_module, name, os.path.abspath(getattr(app_module, name)))
+    finally:
+        os.chdir(cwd)
+    return app_module
@@ -0,0 +1,56 @@
+import collections
+import time
+
+import pytest
+
+
+@pytest.fixture
+def cache(app, monkeypatch):
+    monkeypatch.setattr(app, "_ai_result_cache", collections.OrderedDict())
+    monkeypatch.setattr(app, "AI_RESULT_CACHE_MAX_ENTRIES", 2)
+    return app._ai_result_cache
+
+
+def test_key_ignores_whitespace_and_file_order(app):
+    key = app._ai_result_cache_key("summarize", "Osmosis moves  water.\n", "Spanish", ["hash-a", "hash-b"])
+
+    assert key == app._ai_result_cache_key("summarize", " Osmosis moves water.", "French", ["hash-b", "hash-a"])
+    assert key != app._ai_result_cache_key("summarize", "Osmosis moves salt.", "Spanish", ["hash-a", "hash-b"])
+    assert key != app._ai_result_cache_key("summarize", "Osmosis moves water.", "Spanish", ["hash-a", "hash-c"])
+    assert key != app._ai_result_cache_key("analyze", "Osmosis moves water.", "Spanish", ["hash-a", "hash-b"])
+
+
+def test_translation_target_is_part_of_the_key(app):
+    spanish = app._ai_result_cache_key("translate", "Osmosis moves water.", "Spanish", [])
+    assert spanish != app._ai_result_cache_key("translate", "Osmosis moves water.", "French", [])
+
+
+def test_least_recently_used_entry_is_evicted(app, cache):
+    app._ai_result_cache_put("a", "output a")
+    app._ai_result_cache_put("b", "output b")
+    assert app._ai_result_cache_get("a") == "output a"
+    app._ai_result_cache_put("c", "output c")
+
+    assert app._ai_result_cache_get("b") is None
+    assert app._ai_result_cache_get("a") == "output a"
+    assert app._ai_result_cache_get("c") == "output c"
+
+
+def test_entries_expire_after_the_ttl(app, cache, monkeypatch):
+    app._ai_result_cache_put("a", "output a")
+    later = time.time() + app.AI_RESULT_CACHE_TTL_SECONDS + 1
+    monkeypatch.setattr(app.time, "time", lambda: later)
+
+    assert app._ai_result_cache_get("a") is None
+    assert "a" not in cache
+
+
+def test_cache_applies_to_low_temperature_tools_unless_opted_out(app, monkeypatch):
+    monkeypatch.setattr(app, "AI_TOOL_SETTINGS", dict(app.AI_TOOL_SETTINGS, creative={"temperature": 0.9}))
+    with app.app.test_request_context("/api/ai-tools/execute", method="POST"):
+        assert app._ai_result_cache_enabled({}, "summarize")
+        assert not app._ai_result_cache_enabled({}, "creative")
+        assert not app._ai_result_cache_enabled({"cache": False}, "summarize")
+        assert not app._ai_result_cache_enabled({"cache": "false"}, "summarize")
+    with app.app.test_request_context("/api/ai-tools/execute", method="POST", headers={"Cache-Control": "no-cache"}):
+        assert not app._ai_result_cache_enabled({}, "summarize")
@@ -0,0 +1,116 @@
+import threading
+import time
+import uuid
+
+import pytest
+
+
+def _elements(term):
+    return {"terms": [term], "definitions": [], "examples": [], "questions": [], "answers": []}
+
+
+@pytest.fixture
+def unbatched(app, monkeypatch):
+    """Every chunk is its own extraction call on the chunk pool."""
+    monkeypatch.setattr(app, "EXTRACTION_BATCHING", False)
+    monkeypatch.setattr(app, "INGEST_CHUNK_CONCURRENCY", 4)
+
+
+def _chunks(count):
+    return [f"Chunk {i} of a document ({uuid.uuid4()})." for i in range(count)]
+
+
+def test_results_keep_chunk_order_when_chunks_finish_out_of_order(app, monkeypatch, unbatched):
+    chunks = _chunks(4)
+    running = []
+    lock = threading.Lock()
+
+    def extract(text_chunk):
+        index = chunks.index(text_chunk)
+        with lock:
+            running.append(index)
+        # Later chunks finish first
+        time.sleep(0.05 * (len(chunks) - index))
+        return _elements(f"term {index}")
+
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", extract)
+    progress = []
+
+    results = app._extract_chunks_concurrently(chunks, lambda done, total: progress.append((done, total)))
+
+    assert [result["terms"] for result in results] == [[f"term {i}"] for i in range(4)]
+    assert sorted(running) == [0, 1, 2, 3]
+    assert progress == [(1, 4), (2, 4), (3, 4), (4, 4)]
+
+
+def test_chunks_are_extracted_in_parallel(app, monkeypatch, unbatched):
+    chunks = _chunks(4)
+    all_started = threading.Barrier(4, timeout=5)
+
+    def extract(text_chunk):
+        # Only returns if all four chunks are in flight at once
+        all_started.wait()
+        return _elements(text_chunk)
+
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", extract)
+
+    results = app._extract_chunks_concurrently(chunks)
+
+    assert [result["terms"] for result in results] == [[chunk] for chunk in chunks]
+
+
+def test_overloaded_chunk_fails_the_extraction(app, monkeypatch, unbatched):
+    chunks = _chunks(3)
+
+    def extract(text_chunk):
+        if text_chunk == chunks[1]:
+            raise app.LLMOverloadedError("busy", retry_after=2)
+        return _elements(text_chunk)
+
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", extract)
+
+    with pytest.raises(app.LLMOverloadedError):
+        app._extract_chunks_concurrently(chunks)
+
+
+def test_chunk_cache_key_ignores_whitespace_but_not_content_or_prompt(app, monkeypatch):
+    key = app._chunk_cache_key("Osmosis moves water.\n\nAcross membranes.")
+
+    assert key == app._chunk_cache_key("Osmosis  moves water. Across\tmembranes. ")
+    assert key != app._chunk_cache_key("Osmosis moves salt. Across membranes.")
+    monkeypatch.setattr(app, "EXTRACTION_PROMPT_VERSION", "next-version")
+    assert key != app._chunk_cache_key("Osmosis moves water.\n\nAcross membranes.")
+
+
+def test_reingestion_only_extracts_changed_chunks(app, monkeypatch, unbatched):
+    chunks = _chunks(3)
+    extracted = []
+
+    def extract(text_chunk):
+        extracted.append(text_chunk)
+        return _elements(text_chunk)
+
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", extract)
+    app._extract_chunks_concurrently(chunks)
+    edited = [chunks[0], f"An edited middle chunk ({uuid.uuid4()}).", chunks[2]]
+    extracted.clear()
+
+    results = app._extract_chunks_concurrently(edited)
+
+    assert extracted == [edited[1]]
+    assert [result["terms"] for result in results] == [[chunk] for chunk in edited]
+
+
+def test_empty_chunk_result_is_not_cached(app, monkeypatch, unbatched):
+    chunk = _chunks(1)
+    extracted = []
+
+    def extract(text_chunk):
+        extracted.append(text_chunk)
+        return {"terms": [], "definitions": [], "examples": [], "questions": [], "answers": []}
+
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", extract)
+    app._extract_chunks_concurrently(chunk)
+    app._extract_chunks_concurrently(chunk)
+
+    assert extracted == chunk * 2
@@ -0,0 +1,68 @@
+import pytest
+
+SENTENCES = [f"Fact {i} about topic {i % 7} is worth remembering." for i in range(300)]
+
+
+@pytest.fixture
+def no_anchors(app, monkeypatch):
+    """Chunks close only when full, so packing can be checked without content-defined boundaries."""
+    monkeypatch.setattr(app, "EXTRACTION_CHUNK_ANCHOR_MODULUS", 2 ** 40)
+
+
+def _texts(chunks):
+    return [chunk for chunk, _ in chunks]
+
+
+def test_sentences_are_packed_whole_up_to_the_budget(app, no_anchors):
+    text = " ".join(SENTENCES[:40])
+
+    chunks = app._chunk_text_by_sentences(text, max_tokens=60, overlap_sentences=0)
+
+    assert len(chunks) > 1
+    assert all(tokens <= 60 for _, tokens in chunks)
+    assert all(chunk.endswith("remembering.") for chunk in _texts(chunks))
+    assert " ".join(_texts(chunks)) == text
+
+
+def test_paragraph_breaks_are_kept(app, no_anchors):
+    text = "Cells divide. They grow first.\n\nMitosis has four phases."
+
+    assert _texts(app._chunk_text_by_sentences(text, max_tokens=200)) == [text]
+
+
+def test_consecutive_chunks_overlap_by_whole_sentences(app, no_anchors):
+    chunks = _texts(app._chunk_text_by_sentences(" ".join(SENTENCES[:40]), max_tokens=60, overlap_sentences=1))
+
+    assert len(chunks) > 2
+    for previous, current in zip(chunks, chunks[1:]):
+        last_sentence = previous.rsplit(". ", 1)[-1]
+        assert current.startswith(last_sentence + " ")
+
+
+def test_over_long_sentence_is_split_on_word_boundaries(app, no_anchors):
+    words = [f"cell{i}" for i in range(300)]
+
+    chunks = app._chunk_text_by_sentences(" ".join(words), max_tokens=50, overlap_sentences=0)
+
+    assert len(chunks) > 1
+    assert all(tokens <= 50 for _, tokens in chunks)
+    assert " ".join(_texts(chunks)).split() == words
+
+
+def test_chunk_boundaries_resync_after_an_early_edit(app):
+    before = _texts(app._chunk_text_by_sentences(" ".join(SENTENCES), max_tokens=80, overlap_sentences=1))
+    edited = " ".join(["An extra opening sentence was added."] + SENTENCES)
+    after = _texts(app._chunk_text_by_sentences(edited, max_tokens=80, overlap_sentences=1))
+
+    assert before[0] != after[0]
+    # Boundaries come from anchor sentences, so the chunker falls back into step and later chunks
+    # (and their chunk cache entries) are unchanged
+    assert after[-20:] == before[-20:]
+
+
+def test_positional_boundaries_do_not_resync(app, no_anchors):
+    before = _texts(app._chunk_text_by_sentences(" ".join(SENTENCES), max_tokens=80, overlap_sentences=1))
+    edited = " ".join(["An extra opening sentence was added."] + SENTENCES)
+    after = _texts(app._chunk_text_by_sentences(edited, max_tokens=80, overlap_sentences=1))
+
+    assert not set(before) & set(after)
@@ -0,0 +1,99 @@
+import json
+import time
+import types
+import uuid
+
+
+def _answer(content):
+    message = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+def _elements(term):
+    return {"terms": [term], "definitions": [], "examples": [], "questions": [], "answers": []}
+
+
+def _single_extraction(calls):
+    def extract(text_chunk):
+        calls.append(text_chunk)
+        return _elements(f"single: {text_chunk}")
+    return extract
+
+
+def test_batch_answer_is_split_per_document(app, monkeypatch):
+    answer = {"doc_0": {"terms": ["osmosis"]}, "doc_1": {"terms": ["diffusion"], "questions": ["Why?"]}}
+    monkeypatch.setattr(app.llm_gateway, "chat_completion", lambda **kwargs: _answer(json.dumps(answer)))
+    single_calls = []
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", _single_extraction(single_calls))
+
+    results = app._extract_study_elements_batch(["Water moves.", "Particles spread."])
+
+    assert [result["terms"] for result in results] == [["osmosis"], ["diffusion"]]
+    assert results[1]["questions"] == ["Why?"]
+    assert results[0]["questions"] == []
+    assert single_calls == []
+
+
+def test_unparseable_batch_answer_falls_back_per_document(app, monkeypatch):
+    monkeypatch.setattr(app.llm_gateway, "chat_completion", lambda **kwargs: _answer("not json {"))
+    single_calls = []
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", _single_extraction(single_calls))
+
+    results = app._extract_study_elements_batch(["first doc", "second doc"])
+
+    assert single_calls == ["first doc", "second doc"]
+    assert [result["terms"] for result in results] == [["single: first doc"], ["single: second doc"]]
+
+
+def test_document_missing_from_batch_answer_falls_back_alone(app, monkeypatch):
+    answer = {"doc_0": {"terms": ["osmosis"]}, "doc_2": "not an object"}
+    monkeypatch.setattr(app.llm_gateway, "chat_completion", lambda **kwargs: _answer(json.dumps(answer)))
+    single_calls = []
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", _single_extraction(single_calls))
+
+    results = app._extract_study_elements_batch(["first doc", "second doc", "third doc"])
+
+    assert single_calls == ["second doc", "third doc"]
+    assert [result["terms"] for result in results] == [["osmosis"], ["single: second doc"], ["single: third doc"]]
+
+
+def test_pack_extraction_batches_respects_limits(app, monkeypatch):
+    monkeypatch.setattr(app, "EXTRACTION_BATCH_MAX_DOCS", 3)
+    monkeypatch.setattr(app, "EXTRACTION_BATCH_MAX_TOKENS", 100)
+
+    batches = app._pack_extraction_batches([10, 10, 10, 10, 60, 50, 200, 5], lambda tokens: tokens)
+
+    assert batches == [[10, 10, 10], [10, 60], [50], [200], [5]]
+
+
+def test_small_chunks_of_one_ingestion_share_a_call(app, monkeypatch):
+    calls = []
+
+    def chat_completion(**kwargs):
+        calls.append(kwargs)
+        return _answer(json.dumps({f"doc_{i}": {"terms": [f"term {i}"]} for i in range(3)}))
+
+    monkeypatch.setattr(app.llm_gateway, "chat_completion", chat_completion)
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", _single_extraction([]))
+    chunks = [f"Short worksheet {i} ({uuid.uuid4()})." for i in range(3)]
+
+    results = app._extract_chunks_concurrently(chunks)
+    assert len(calls) == 1
+    assert [result["terms"] for result in results] == [["term 0"], ["term 1"], ["term 2"]]
+
+    # Each document's answer is cached under its own chunk
+    assert app._extract_chunks_concurrently(chunks) == results
+    assert len(calls) == 1
+
+
+def test_lone_queued_chunk_is_sent_without_waiting_for_the_window(app, monkeypatch):
+    monkeypatch.setattr(app, "EXTRACTION_BATCH_WINDOW_SECONDS", 5)
+    single_calls = []
+    monkeypatch.setattr(app, "_extract_key_study_elements_from_chunk", _single_extraction(single_calls))
+
+    started = time.monotonic()
+    result = app._extract_study_elements_batched("one small page")
+
+    assert time.monotonic() - started < 1
+    assert single_calls == ["one small page"]
+    assert result["terms"] == ["single: one small page"]
@@ -0,0 +1,83 @@
+import json
+
+STUDY_ELEMENTS = {
+    "terms": ["osmosis", "osmosis"],
+    "definitions": ["osmosis: water crossing a membrane"],
+    "examples": [],
+    "questions": [],
+    "answers": []
+}
+DEDUPLICATED = dict(STUDY_ELEMENTS, terms=["osmosis"])
+
+
+def test_structured_data_column_is_used_when_present(app):
+    row = {"structured_data": STUDY_ELEMENTS, "compressed_text": json.dumps({"structured_data": {"terms": ["stale"]}})}
+    assert app._file_import_structured_data(row) == DEDUPLICATED
+
+
+def test_legacy_blob_is_read_when_the_column_is_empty(app):
+    blob = json.dumps({"structured_data": STUDY_ELEMENTS, "compressed_text": "osmosis summary"})
+    assert app._file_import_structured_data({"structured_data": None, "compressed_text": blob}) == DEDUPLICATED
+    # The oldest rows stored the categories at the top level of the blob
+    assert app._file_import_structured_data({"compressed_text": json.dumps(STUDY_ELEMENTS)}) == DEDUPLICATED
+
+
+def test_unreadable_legacy_blob_has_no_structured_data(app):
+    assert app._file_import_structured_data({"structured_data": None, "compressed_text": "plain text"}) is None
+    assert app._file_import_structured_data({"structured_data": None, "compressed_text": None}) is None
+
+
+def test_legacy_summary_text(app):
+    assert app._legacy_summary_text(json.dumps({"compressed_text": "osmosis summary"})) == "osmosis summary"
+    assert app._legacy_summary_text("raw compressed text") == "raw compressed text"
+    assert app._legacy_summary_text(json.dumps({"structured_data": {}})) == ""
+    assert app._legacy_summary_text(None) == ""
+
+
+class FakeQuery:
+    def __init__(self, rows, calls):
+        self.rows = rows
+        self.calls = calls
+        self.columns = None
+
+    def select(self, columns):
+        self.calls.append(columns)
+        self.columns = columns.split(",")
+        return self
+
+    def eq(self, column, value):
+        self.rows = [row for row in self.rows if row[column] == value]
+        return self
+
+    def in_(self, column, values):
+        self.rows = [row for row in self.rows if row[column] in values]
+        return self
+
+    def execute(self):
+        data = [{column: row.get(column) for column in self.columns} for row in self.rows]
+        return type("Result", (), {"data": data})()
+
+
+class FakeSupabase:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def table(self, name):
+        return FakeQuery(self.rows, self.calls)
+
+
+def test_summaries_fetch_the_blob_only_for_legacy_rows(app, monkeypatch):
+    fake = FakeSupabase([
+        {"id": 1, "user_id": "u", "summary_text": "split summary", "compressed_text": None},
+        {"id": 2, "user_id": "u", "summary_text": None, "compressed_text": json.dumps({"compressed_text": "legacy summary"})},
+        {"id": 3, "user_id": "other", "summary_text": "not yours", "compressed_text": None},
+    ])
+    monkeypatch.setattr(app, "supabase", fake)
+
+    assert app._file_import_summaries("u", [1, 2, 3]) == {"1": "split summary", "2": "legacy summary"}
+    assert fake.calls == ["id,summary_text", "id,compressed_text"]
+
+    fake.calls.clear()
+    assert app._file_import_summaries("u", [1]) == {"1": "split summary"}
+    assert fake.calls == ["id,summary_text"]
@@ -0,0 +1,81 @@
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def user():
+    return f"{uuid.uuid4().hex}@example.com"
+
+
+def test_job_runs_to_success_with_progress(app, user):
+    job_id = app._create_ingest_job(user, "import_file", "notes.pdf")
+    assert app._get_ingest_job(job_id, user)["status"] == "queued"
+    seen = []
+
+    def ingest(name, progress_callback=None):
+        progress_callback("extracting_elements", 2, 4)
+        seen.append(dict(app._get_ingest_job(job_id, user)))
+        return {"success": True, "name": name}, 200
+
+    app._run_ingest_job(job_id, ingest, "notes")
+
+    assert (seen[0]["status"], seen[0]["stage"], seen[0]["chunks_done"], seen[0]["chunks_total"]) == (
+        "running", "extracting_elements", 2, 4
+    )
+    job = app._get_ingest_job(job_id, user)
+    assert (job["status"], job["stage"]) == ("succeeded", "done")
+    assert job["result"] == '{"success": true, "name": "notes"}'
+
+
+def test_job_fails_on_error_status_or_exception(app, user):
+    rejected = app._create_ingest_job(user, "import_file", "notes.pdf")
+    app._run_ingest_job(rejected, lambda progress_callback=None: ({"error": "AI service is busy"}, 503))
+    job = app._get_ingest_job(rejected, user)
+    assert (job["status"], job["error"]) == ("failed", "AI service is busy")
+
+    def crash(progress_callback=None):
+        raise RuntimeError("worker crashed")
+
+    crashed = app._create_ingest_job(user, "import_file", "notes.pdf")
+    app._run_ingest_job(crashed, crash)
+    job = app._get_ingest_job(crashed, user)
+    assert (job["status"], job["error"]) == ("failed", "worker crashed")
+
+
+def test_jobs_are_only_visible_to_their_owner(app, user):
+    job_id = app._create_ingest_job(user, "api_file", "notes.pdf")
+    assert app._get_ingest_job(job_id, "someone-else@example.com") is None
+
+
+def test_old_finished_jobs_are_purged_when_a_job_is_created(app, user, monkeypatch):
+    finished = app._create_ingest_job(user, "import_file", "old.pdf")
+    running = app._create_ingest_job(user, "import_file", "slow.pdf")
+    app._update_ingest_job(finished, status="succeeded")
+    app._update_ingest_job(running, status="running")
+
+    later = time.time() + app.INGEST_JOB_RETENTION_SECONDS + 60
+    monkeypatch.setattr(app.time, "time", lambda: later)
+    app._create_ingest_job(user, "import_file", "new.pdf")
+
+    assert app._get_ingest_job(finished, user) is None
+    assert app._get_ingest_job(running, user)["status"] == "running"
+
+
+def test_status_endpoint_reports_stalled_jobs_as_failed(app, user, monkeypatch):
+    monkeypatch.setattr(app, "get_authenticated_user", lambda: user)
+    job_id = app._create_ingest_job(user, "import_file", "notes.pdf")
+    app._update_ingest_job(job_id, status="running", stage="extracting_elements", chunks_done=1, chunks_total=4)
+    client = app.app.test_client()
+
+    job = client.get(f"/api/jobs/{job_id}").get_json()["job"]
+    assert (job["status"], job["progress"]["percent"]) == ("running", 25.0)
+
+    later = time.time() + app.INGEST_JOB_STALE_SECONDS + 60
+    monkeypatch.setattr(app.time, "time", lambda: later)
+    job = client.get(f"/api/jobs/{job_id}").get_json()["job"]
+    assert job["status"] == "failed"
+    assert "stalled" in job["error"]
+
+    assert client.get(f"/api/jobs/{uuid.uuid4()}").status_code == 404
@@ -0,0 +1,39 @@
+import hashlib
+
+STUDY_ELEMENTS = {
+    "terms": ["photosynthesis"],
+    "definitions": ["photosynthesis: how plants turn light into sugar"],
+    "examples": [],
+    "questions": [],
+    "answers": []
+}
+EMPTY_ELEMENTS = {"terms": [], "definitions": [], "examples": [], "questions": [], "answers": []}
+
+
+def _ingest(app, monkeypatch, chunk_results, file_bytes):
+    monkeypatch.setattr(app, "_extract_text_from_bytes", lambda *args, **kwargs: "Plants use light. They make sugar.")
+    # One chunk per extraction result
+    monkeypatch.setattr(app, "_chunk_text_by_sentences", lambda text: [(f"part {i}", 2) for i in range(len(chunk_results))])
+    monkeypatch.setattr(app, "_extract_chunks_concurrently", lambda chunks, progress_callback=None: chunk_results)
+    result = app._run_ingestion_pipeline(file_bytes, "notes.txt", "file-id", ocr_mode="fast")
+    cache_key = app._ingest_cache_key(hashlib.sha256(file_bytes).hexdigest(), "fast")
+    return result, app._ingest_cache_get(cache_key)
+
+
+def test_successful_ingestion_is_cached(app, monkeypatch):
+    result, cached = _ingest(app, monkeypatch, [STUDY_ELEMENTS], b"complete notes")
+    assert result["failed_chunks"] == 0
+    assert cached["structured_data"]["terms"] == ["photosynthesis"]
+
+
+def test_failed_chunk_is_not_cached(app, monkeypatch):
+    result, cached = _ingest(app, monkeypatch, [STUDY_ELEMENTS, EMPTY_ELEMENTS], b"notes with a failed chunk")
+    assert result["failed_chunks"] == 1
+    assert result["structured_data"]["terms"] == ["photosynthesis"]
+    assert cached is None
+
+
+def test_empty_extraction_is_not_cached(app, monkeypatch):
+    result, cached = _ingest(app, monkeypatch, [EMPTY_ELEMENTS], b"notes with nothing extracted")
+    assert not any(result["structured_data"].values())
+    assert cached is None
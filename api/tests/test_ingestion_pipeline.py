@@ -0,0 +1,83 @@
+import uuid
+
+import pytest
+
+TEXT_STAGES = ["normalize", "chunk", "llm_extract", "merge", "compress"]
+
+
+def _elements(term):
+    return {"terms": [term], "definitions": [], "examples": [], "questions": [], "answers": []}
+
+
+def test_ingest_stage_records_and_accumulates(app):
+    metrics = app._new_ingest_metrics()
+    for _ in range(2):
+        with app._ingest_stage(metrics, "extract", 100) as stage:
+            stage["bytes_out"] = 40
+
+    assert metrics["stages"]["extract"]["bytes_in"] == 200
+    assert metrics["stages"]["extract"]["bytes_out"] == 80
+    assert metrics["total_ms"] == metrics["stages"]["extract"]["duration_ms"]
+
+
+def test_stage_is_recorded_when_it_raises(app):
+    metrics = app._new_ingest_metrics()
+    with pytest.raises(RuntimeError):
+        with app._ingest_stage(metrics, "extract", 10):
+            raise RuntimeError("OCR failed")
+
+    assert metrics["stages"]["extract"]["bytes_out"] == 0
+
+
+@pytest.fixture
+def fake_extraction(app, monkeypatch):
+    monkeypatch.setattr(app, "_extract_text_from_bytes", lambda file_bytes, *args, **kwargs: file_bytes.decode())
+    monkeypatch.setattr(app, "_extract_chunks_concurrently",
+                        lambda chunks, progress_callback=None: [_elements(chunk) for chunk in chunks])
+
+
+def test_pipeline_records_every_stage(app, fake_extraction):
+    file_bytes = f"Plants use light ({uuid.uuid4()}). They make sugar.".encode()
+
+    result = app._run_ingestion_pipeline(file_bytes, "notes.txt", "file-id", ocr_mode="fast")
+
+    assert result["error"] is None
+    assert list(result["metrics"]["stages"]) == ["cache_lookup", "extract"] + TEXT_STAGES + ["persist"]
+    assert result["metrics"]["stages"]["extract"]["bytes_in"] == len(file_bytes)
+
+    cached = app._run_ingestion_pipeline(file_bytes, "notes.txt", "file-id", ocr_mode="fast")
+    assert cached["cache_hit"]
+    assert list(cached["metrics"]["stages"]) == ["cache_lookup"]
+    assert cached["structured_data"] == result["structured_data"]
+
+
+def test_file_without_text_reports_an_error(app, fake_extraction):
+    result = app._run_ingestion_pipeline(f" \n {' ' * 10}".encode(), "blank.txt", "file-id", ocr_mode="fast")
+
+    assert result["error"] == "No text could be extracted from the file"
+    assert not any(result["structured_data"].values())
+
+
+def test_files_ingested_together_share_one_extraction_pass(app, monkeypatch, fake_extraction):
+    calls = []
+
+    def extract_chunks(chunks, progress_callback=None):
+        calls.append(list(chunks))
+        return [_elements(chunk) for chunk in chunks]
+
+    monkeypatch.setattr(app, "_extract_chunks_concurrently", extract_chunks)
+    first = f"Osmosis moves water ({uuid.uuid4()}).".encode()
+    second = f"Enzymes speed up reactions ({uuid.uuid4()}).".encode()
+
+    results = app._run_ingestion_pipelines([(first, "a.txt", "a"), (b"   ", "blank.txt", "b"), (second, "c.txt", "c")], "fast")
+
+    assert calls == [[first.decode(), second.decode()]]
+    assert results[0]["structured_data"]["terms"] == [first.decode()]
+    assert results[1]["error"] == "No text could be extracted from the file"
+    assert results[2]["structured_data"]["terms"] == [second.decode()]
+    assert "llm_extract" in results[2]["metrics"]["stages"]
+
+    # Once cached, neither file is extracted again
+    again = app._run_ingestion_pipelines([(first, "a.txt", "a"), (second, "c.txt", "c")], "fast")
+    assert len(calls) == 1
+    assert [result["cache_hit"] for result in again] == [True, True]
@@ -0,0 +1,416 @@
+import collections
+import threading
+import time
+import types
+
+import pytest
+
+import llm_gateway
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(llm_gateway.time, "monotonic", fake)
+    monkeypatch.setattr(llm_gateway, "_hedge_window", {"eligible": collections.deque(), "fired": collections.deque()})
+    monkeypatch.setattr(llm_gateway, "LLM_HEDGE_MAX_FRACTION", 0.05)
+    monkeypatch.setattr(llm_gateway, "LLM_HEDGE_WINDOW_SECONDS", 60.0)
+    return fake
+
+
+def test_hedges_capped_at_fraction_of_eligible_calls(clock):
+    for _ in range(100):
+        llm_gateway._record_hedge_eligible()
+    granted = sum(llm_gateway._take_hedge_budget() for _ in range(100))
+    assert granted == 5
+
+
+def test_quiet_period_does_not_bank_hedge_budget(clock):
+    for _ in range(10000):
+        llm_gateway._record_hedge_eligible()
+    clock.now += 61
+    # A slowdown after the quiet period: every new call is slow and wants a hedge
+    granted = 0
+    for _ in range(40):
+        llm_gateway._record_hedge_eligible()
+        granted += llm_gateway._take_hedge_budget()
+    assert granted == 2
+
+
+def test_hedge_budget_recovers_as_hedges_leave_the_window(clock):
+    for _ in range(20):
+        llm_gateway._record_hedge_eligible()
+    assert llm_gateway._take_hedge_budget()
+    assert not llm_gateway._take_hedge_budget()
+    clock.now += 61
+    for _ in range(20):
+        llm_gateway._record_hedge_eligible()
+    assert llm_gateway._take_hedge_budget()
+
+
+def test_limiter_disabled_still_honours_block(tmp_path):
+    limiter = llm_gateway.SharedTokenBucketLimiter(str(tmp_path / "state.json"), 0, 0)
+    assert limiter.try_acquire("m", 100) == 0.0
+    limiter.block("m", 30)
+    assert limiter.try_acquire("m", 100) > 29
+
+
+def test_limiter_only_writes_state_when_tokens_are_taken(tmp_path):
+    path = tmp_path / "state.json"
+    limiter = llm_gateway.SharedTokenBucketLimiter(str(path), 1, 0)
+    assert limiter.try_acquire("m", 10) == 0.0
+    written = path.read_bytes()
+    assert limiter.try_acquire("m", 10) > 0
+    assert path.read_bytes() == written
+
+
+def test_limiter_refund_returns_request_and_tokens(tmp_path):
+    limiter = llm_gateway.SharedTokenBucketLimiter(str(tmp_path / "state.json"), 1, 100)
+    assert limiter.try_acquire("m", 100) == 0.0
+    assert limiter.try_acquire("m", 100) > 0
+    limiter.refund("m", 100)
+    assert limiter.try_acquire("m", 100) == 0.0
+
+
+class SlowFirstClient:
+    """Fake Groq client: the first request takes first_delay seconds, later ones answer at once."""
+
+    def __init__(self, first_delay):
+        self.first_delay = first_delay
+        self.calls = 0
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _create(self, messages=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        if call == 1:
+            time.sleep(self.first_delay)
+            self.finished.set()
+        message = types.SimpleNamespace(content=f"answer {call}", role="assistant")
+        usage = types.SimpleNamespace(prompt_tokens=1, completion_tokens=1, total_tokens=2)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+
+
+def test_hedge_wins_and_loser_releases_its_slots(monkeypatch, tmp_path):
+    client = SlowFirstClient(first_delay=0.5)
+    monkeypatch.setattr(llm_gateway, "_client", client)
+    monkeypatch.setattr(llm_gateway, "_client_pid", None)
+    monkeypatch.setattr(llm_gateway, "_limiter", llm_gateway.SharedTokenBucketLimiter(str(tmp_path / "state.json"), 0, 0))
+    monkeypatch.setattr(llm_gateway, "_hedge_window", {"eligible": collections.deque(), "fired": collections.deque()})
+    monkeypatch.setattr(llm_gateway, "LLM_HEDGE_MAX_FRACTION", 1.0)
+    monkeypatch.setattr(llm_gateway.CallStats, "latency_p95_seconds", lambda self, min_samples: 0.05)
+
+    response = llm_gateway.chat_completion([{"role": "user", "content": "hi"}], "test-model", endpoint="hedge_test",
+                                           hedge=True, coalesce=False)
+
+    assert response.choices[0].message.content == "answer 2"
+    assert client.finished.wait(2)
+    deadline = time.monotonic() + 2
+    while time.monotonic() < deadline and (
+        llm_gateway._in_flight._value < llm_gateway.LLM_MAX_IN_FLIGHT
+        or llm_gateway._hedge_threads._value < llm_gateway.LLM_HEDGE_THREADS
+    ):
+        time.sleep(0.01)
+    assert llm_gateway._in_flight._value == llm_gateway.LLM_MAX_IN_FLIGHT
+    assert llm_gateway._hedge_threads._value == llm_gateway.LLM_HEDGE_THREADS
+
+
+def _wait_for_followers(key, count):
+    while True:
+        with llm_gateway._flights_lock:
+            flight = llm_gateway._flights.get(key)
+            if flight is not None and flight.followers >= count:
+                return
+        time.sleep(0.01)
+
+
+def _run_flight(key, call, results, on_follow=None):
+    try:
+        results.append(llm_gateway._single_flight(key, call, wait_timeout=5, on_follow=on_follow))
+    except Exception as e:
+        results.append(e)
+
+
+def test_single_flight_coalesces_identical_calls():
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "answer"
+
+    results, followed = [], []
+    threads = [threading.Thread(target=_run_flight, args=("same-key", call, results, followed.append)) for _ in range(3)]
+    threads[0].start()
+    while not calls:
+        time.sleep(0.01)
+    for thread in threads[1:]:
+        thread.start()
+    _wait_for_followers("same-key", 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ["answer"] * 3
+    assert followed == [None, None]
+    assert "same-key" not in llm_gateway._flights
+
+
+def test_single_flight_shares_the_leaders_error_then_runs_again():
+    release = threading.Event()
+    error = llm_gateway.LLMOverloadedError("busy", retry_after=2)
+
+    def failing_call():
+        release.wait(5)
+        raise error
+
+    results = []
+    leader = threading.Thread(target=_run_flight, args=("failing-key", failing_call, results))
+    follower = threading.Thread(target=_run_flight, args=("failing-key", failing_call, results))
+    leader.start()
+    while "failing-key" not in llm_gateway._flights:
+        time.sleep(0.01)
+    follower.start()
+    _wait_for_followers("failing-key", 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert results == [error, error]
+    # A finished flight is not reused: the next caller makes its own call
+    assert llm_gateway._single_flight("failing-key", lambda: "fresh", wait_timeout=5) == "fresh"
+
+
+def test_flight_key_depends_on_prompt_and_params():
+    messages = [{"role": "user", "content": "Explain osmosis"}]
+    key = llm_gateway._flight_key("generate", "model", messages, {"temperature": 0.2})
+
+    assert key == llm_gateway._flight_key("generate", "model", [dict(messages[0])], {"temperature": 0.2})
+    assert key != llm_gateway._flight_key("generate", "model", messages, {"temperature": 0.7})
+    assert key != llm_gateway._flight_key("generate", "model", [{"role": "user", "content": "Explain diffusion"}], {"temperature": 0.2})
+
+
+def test_fit_texts_keeps_small_inputs_and_splits_the_rest():
+    small = "Short note."
+    large_a = "Alpha sentence here. " * 200
+    large_b = "Beta sentence here. " * 200
+
+    fitted = llm_gateway.fit_texts([large_a, small, large_b], 300)
+
+    assert fitted[1] == small
+    assert sum(llm_gateway.estimate_tokens(text) for text in fitted) <= 300
+    # The budget the small input leaves is shared evenly by the large ones
+    share = (300 - llm_gateway.estimate_tokens(small)) // 2
+    assert share - 10 <= llm_gateway.estimate_tokens(fitted[0]) <= share
+    assert share - 10 <= llm_gateway.estimate_tokens(fitted[2]) <= share
+    assert large_a.startswith(fitted[0]) and fitted[0].endswith(".")
+
+
+def test_fit_texts_returns_inputs_unchanged_when_they_fit():
+    texts = ["one", "two three"]
+    assert llm_gateway.fit_texts(texts, 100) == texts
+
+
+def test_fit_text_handles_word_dense_text():
+    text = " ".join(["a"] * 500)
+    fitted = llm_gateway.fit_text(text, 100)
+    assert 0 < llm_gateway.estimate_tokens(fitted) <= 100
+
+
+def test_completion_budget_shrinks_max_tokens_to_the_context_left(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "MODEL_CONTEXT_TOKENS", {"small-model": 2000})
+    messages = [{"role": "user", "content": "word " * 1000}]
+    left = 2000 - llm_gateway.LLM_CONTEXT_SAFETY_TOKENS - llm_gateway.estimate_messages_tokens(messages)
+
+    assert llm_gateway.completion_budget("small-model", messages, 4000) == left
+    assert llm_gateway.completion_budget("small-model", messages, 100) == 100
+    assert llm_gateway._fit_completion_params("small-model", messages, {"max_tokens": 4000})["max_tokens"] == left
+
+
+def test_prompt_too_large_for_the_context_is_rejected(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "MODEL_CONTEXT_TOKENS", {"small-model": 2000})
+    messages = [{"role": "user", "content": "word " * 1800}]
+
+    with pytest.raises(llm_gateway.LLMPromptTooLargeError):
+        llm_gateway._fit_completion_params("small-model", messages, {"max_tokens": 1000})
+
+
+def test_breaker_opens_after_consecutive_failures_and_fails_fast(clock):
+    breaker = llm_gateway.CircuitBreaker("m", failure_threshold=3, open_seconds=30)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    breaker.before_call()
+    breaker.record_success()
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_failure()
+
+    assert breaker.state == "open"
+    clock.now += 10
+    with pytest.raises(llm_gateway.LLMUnavailableError) as raised:
+        breaker.before_call()
+    assert raised.value.retry_after == pytest.approx(20)
+
+
+def test_breaker_lets_one_probe_through_after_the_open_period(clock):
+    breaker = llm_gateway.CircuitBreaker("m", failure_threshold=1, open_seconds=30)
+    breaker.before_call()
+    breaker.record_failure()
+    clock.now += 31
+
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    with pytest.raises(llm_gateway.LLMUnavailableError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_and_neutral_outcome_frees_the_probe(clock):
+    breaker = llm_gateway.CircuitBreaker("m", failure_threshold=1, open_seconds=30)
+    breaker.before_call()
+    breaker.record_failure()
+    clock.now += 31
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+
+    clock.now += 31
+    breaker.before_call()
+    breaker.record_neutral()
+    breaker.before_call()
+    assert breaker.state == "half_open"
+
+
+class UpstreamDown(Exception):
+    pass
+
+
+@pytest.fixture
+def failing_upstream(monkeypatch, tmp_path):
+    """Every request fails as an upstream outage; backoff is a fixed 0.5s and sleeping is recorded, not done."""
+    attempts = []
+
+    def create(**kwargs):
+        attempts.append(kwargs)
+        raise UpstreamDown("502 Bad Gateway")
+
+    sleeps = []
+    monkeypatch.setattr(llm_gateway, "_client", types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create))))
+    monkeypatch.setattr(llm_gateway, "_client_pid", None)
+    monkeypatch.setattr(llm_gateway, "_limiter", llm_gateway.SharedTokenBucketLimiter(str(tmp_path / "state.json"), 0, 0))
+    monkeypatch.setattr(llm_gateway, "_breakers", {})
+    monkeypatch.setattr(llm_gateway, "_is_upstream_failure", lambda error: isinstance(error, UpstreamDown))
+    monkeypatch.setattr(llm_gateway, "_backoff_seconds", lambda error, attempt: 0.5)
+    monkeypatch.setattr(llm_gateway.time, "sleep", sleeps.append)
+    monkeypatch.setattr(llm_gateway, "LLM_MAX_ATTEMPTS", 3)
+    return attempts, sleeps
+
+
+def _call_failing_upstream(retry_window):
+    with pytest.raises(llm_gateway.LLMUnavailableError):
+        llm_gateway.chat_completion([{"role": "user", "content": "hi"}], "test-model", endpoint="retry_test",
+                                    coalesce=False, retry_window=retry_window)
+
+
+def test_upstream_failures_are_retried_within_the_retry_window(failing_upstream):
+    attempts, sleeps = failing_upstream
+
+    _call_failing_upstream(retry_window=10)
+
+    assert len(attempts) == 3
+    assert sleeps == [0.5, 0.5]
+    assert llm_gateway._in_flight._value == llm_gateway.LLM_MAX_IN_FLIGHT
+
+
+def test_backoff_longer_than_the_retry_window_is_not_waited_out(failing_upstream):
+    attempts, sleeps = failing_upstream
+
+    _call_failing_upstream(retry_window=0.2)
+
+    assert len(attempts) == 1
+    assert sleeps == []
+    assert llm_gateway._breaker_for("test-model").consecutive_failures == 1
+
+
+def _stream_chunk(content=None, usage=None):
+    choices = [] if content is None else [types.SimpleNamespace(delta=types.SimpleNamespace(content=content))]
+    return types.SimpleNamespace(choices=choices, x_groq=types.SimpleNamespace(usage=usage) if usage else None)
+
+
+class StreamingClient:
+    """Fake Groq client whose streamed completion yields the given chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _create(self, stream=False, **kwargs):
+        assert stream
+        client = self
+
+        class Stream:
+            def __iter__(self):
+                return iter(client.chunks)
+
+            def close(self):
+                client.closed = True
+
+        return Stream()
+
+
+@pytest.fixture
+def streaming(monkeypatch, tmp_path):
+    def install(chunks):
+        client = StreamingClient(chunks)
+        monkeypatch.setattr(llm_gateway, "_client", client)
+        monkeypatch.setattr(llm_gateway, "_client_pid", None)
+        monkeypatch.setattr(llm_gateway, "_limiter", llm_gateway.SharedTokenBucketLimiter(str(tmp_path / "state.json"), 0, 0))
+        return client
+    return install
+
+
+def test_stream_yields_deltas_and_releases_its_slot_once(streaming):
+    usage = types.SimpleNamespace(prompt_tokens=3, completion_tokens=2, total_tokens=5)
+    client = streaming([_stream_chunk("Osmo"), _stream_chunk(""), _stream_chunk("sis"), _stream_chunk(usage=usage)])
+
+    stream = llm_gateway.chat_completion_stream([{"role": "user", "content": "hi"}], "test-model", endpoint="stream_test")
+    assert llm_gateway._in_flight._value == llm_gateway.LLM_MAX_IN_FLIGHT - 1
+    assert list(stream) == ["Osmo", "sis"]
+    stream.close()
+
+    assert client.closed
+    assert llm_gateway._in_flight._value == llm_gateway.LLM_MAX_IN_FLIGHT
+    stats = llm_gateway._stats_for("stream_test", "test-model").snapshot()
+    assert stats["outcomes"] == {"ok": 1}
+    assert (stats["prompt_tokens"], stats["completion_tokens"]) == (3, 2)
+
+
+def test_stream_closed_early_is_recorded_as_cancelled(streaming):
+    client = streaming([_stream_chunk("one"), _stream_chunk("two"), _stream_chunk("three")])
+
+    stream = llm_gateway.chat_completion_stream([{"role": "user", "content": "hi"}], "test-model", endpoint="cancel_test")
+    deltas = iter(stream)
+    assert next(deltas) == "one"
+    stream.close()
+
+    assert client.closed
+    assert llm_gateway._in_flight._value == llm_gateway.LLM_MAX_IN_FLIGHT
+    assert llm_gateway._stats_for("cancel_test", "test-model").snapshot()["outcomes"] == {"cancelled": 1}
@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import Future
+
+import fitz
+import pytest
+
+import ocr_worker
+
+
+def _page_with_ink(doc, ink_fraction):
+    """A page without a text layer whose top ink_fraction of the height is filled black."""
+    page = doc.new_page(width=600, height=800)
+    if ink_fraction:
+        page.draw_rect(fitz.Rect(0, 0, 600, 800 * ink_fraction), color=(0, 0, 0), fill=(0, 0, 0))
+    return page
+
+
+def test_plan_page_ocr_by_ink_density(app):
+    doc = fitz.open()
+    blank = app._plan_page_ocr(_page_with_ink(doc, 0), "fast")
+    sparse = app._plan_page_ocr(_page_with_ink(doc, 0.01), "fast")
+    dense = app._plan_page_ocr(_page_with_ink(doc, 0.5), "accurate")
+
+    assert blank == (app.OCR_TIER_DPI["fast"]["sparse"], ocr_worker.SPARSE_TEXT_PSM,
+                     app.OCR_BLANK_CHECK_DPI / app.OCR_TIER_DPI["fast"]["sparse"])
+    assert sparse == (app.OCR_TIER_DPI["fast"]["sparse"], ocr_worker.SPARSE_TEXT_PSM, None)
+    assert dense == (app.OCR_TIER_DPI["accurate"]["dense"], 3, None)
+
+
+def test_fast_mode_reads_sparse_pages_at_150_dpi_or_more(app):
+    assert app.OCR_TIER_DPI["fast"]["sparse"] >= 150
+
+
+def test_blank_candidate_skipped_when_check_finds_nothing(monkeypatch):
+    calls = []
+
+    def image_to_string(img, config=""):
+        calls.append((img.size, config))
+        return " \n"
+
+    monkeypatch.setattr(ocr_worker.pytesseract, "image_to_string", image_to_string)
+    assert ocr_worker.ocr_page_image(300, 400, bytes(300 * 400), psm=11, blank_check_scale=0.5) == ""
+    assert calls == [((150, 200), "--psm 11")]
+
+
+def test_blank_candidate_with_faint_text_is_ocrd_in_full(monkeypatch):
+    calls = []
+
+    def image_to_string(img, config=""):
+        calls.append(img.size)
+        return "faint pencil notes"
+
+    monkeypatch.setattr(ocr_worker.pytesseract, "image_to_string", image_to_string)
+    assert ocr_worker.ocr_page_image(300, 400, bytes(300 * 400), psm=11, blank_check_scale=0.5) == "faint pencil notes"
+    assert calls == [(150, 200), (300, 400)]
+
+
+class FakeOcrPool:
+    """Runs submitted OCR jobs at once; the first failing_jobs submissions raise as a crashed worker would."""
+
+    def __init__(self, failing_jobs=0):
+        self.failing_jobs = failing_jobs
+        self.submitted = []
+
+    def submit(self, fn, width, height, *args):
+        self.submitted.append(height)
+        future = Future()
+        if len(self.submitted) <= self.failing_jobs:
+            future.set_exception(RuntimeError("worker died"))
+        else:
+            future.set_result(fn(width, height, *args))
+        return future
+
+
+def _mixed_pdf():
+    """Pages 1 and 3 have a text layer; pages 2 and 4 are scans told apart by their height."""
+    doc = fitz.open()
+    doc.new_page(width=600, height=800).insert_text((72, 72), "Typed page one.")
+    _page_with_ink(doc, 0.5).set_mediabox(fitz.Rect(0, 0, 600, 700))
+    doc.new_page(width=600, height=800).insert_text((72, 72), "Typed page three.")
+    _page_with_ink(doc, 0.5).set_mediabox(fitz.Rect(0, 0, 600, 600))
+    return doc
+
+
+def _scan_text(width, height, samples, psm=3, blank_check_scale=None):
+    return f"scanned {height}px"
+
+
+def test_scanned_pages_are_ocrd_on_the_pool_in_page_order(app, monkeypatch):
+    pool = FakeOcrPool()
+    monkeypatch.setattr(app, "PDF_PARALLEL_OCR", True)
+    monkeypatch.setattr(app, "PDF_OCR_WORKERS", 2)
+    monkeypatch.setattr(app, "_get_ocr_process_pool", lambda: pool)
+    monkeypatch.setattr(ocr_worker, "ocr_page_image", _scan_text)
+
+    texts = app._extract_pdf_pages_text(_mixed_pdf(), ocr_mode="accurate")
+
+    assert len(pool.submitted) == 2
+    assert pool.submitted[0] > pool.submitted[1]
+    assert [text.strip() for text in texts] == [
+        "Typed page one.", f"scanned {pool.submitted[0]}px", "Typed page three.", f"scanned {pool.submitted[1]}px"
+    ]
+
+
+def test_page_is_retried_inline_when_its_worker_fails(app, monkeypatch):
+    pool = FakeOcrPool(failing_jobs=1)
+    monkeypatch.setattr(app, "PDF_PARALLEL_OCR", True)
+    monkeypatch.setattr(app, "PDF_OCR_WORKERS", 2)
+    monkeypatch.setattr(app, "_get_ocr_process_pool", lambda: pool)
+    monkeypatch.setattr(ocr_worker, "ocr_page_image", _scan_text)
+
+    texts = app._extract_pdf_pages_text(_mixed_pdf(), ocr_mode="accurate")
+
+    assert texts[1] == f"scanned {pool.submitted[0]}px"
+    assert texts[3] == f"scanned {pool.submitted[1]}px"
+
+
+def test_pool_is_not_used_when_parallel_ocr_is_off(app, monkeypatch):
+    monkeypatch.setattr(app, "_get_ocr_process_pool", lambda: pytest.fail("OCR pool used"))
+    monkeypatch.setattr(ocr_worker, "ocr_page_image", _scan_text)
+
+    texts = app._extract_pdf_pages_text(_mixed_pdf(), parallel_ocr=False, ocr_mode="accurate")
+
+    assert texts[1].startswith("scanned") and texts[3].startswith("scanned")
+
+
+def test_ocr_pool_is_sized_per_web_worker(app):
+    assert app.PDF_OCR_WORKERS >= 1
+    if "PDF_OCR_WORKERS" not in os.environ:
+        assert app.PDF_OCR_WORKERS <= max(1, min(4, (os.cpu_count() or 1) // app.WEB_CONCURRENCY))
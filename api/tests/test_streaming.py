@@ -0,0 +1,70 @@
+import json
+
+
+class FakeCompletionStream:
+    def __init__(self, deltas, error=None):
+        self.deltas = deltas
+        self.error = error
+        self.closed = 0
+
+    def __iter__(self):
+        yield from self.deltas
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed += 1
+
+
+def _events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines.get("event"), json.loads(lines["data"])))
+    return events
+
+
+def _stream(app, completion_stream, cache_status=None):
+    completed = []
+    with app.app.test_request_context("/api/generate-notes", method="POST"):
+        response = app._stream_llm_response(completion_stream, "notes", completed.append, cache_status)
+        body = response.get_data(as_text=True)
+    response.close()
+    return response, _events(body), completed
+
+
+def test_deltas_are_forwarded_then_done_with_the_full_text(app):
+    completion_stream = FakeCompletionStream(["Osmosis ", "moves ", "water."])
+
+    response, events, completed = _stream(app, completion_stream, cache_status="MISS")
+
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["X-Cache"] == "MISS"
+    assert events == [
+        (None, {"delta": "Osmosis "}),
+        (None, {"delta": "moves "}),
+        (None, {"delta": "water."}),
+        ("done", {"notes": "Osmosis moves water.", "cache": "MISS"}),
+    ]
+    assert completed == ["Osmosis moves water."]
+    assert completion_stream.closed
+
+
+def test_broken_upstream_stream_ends_with_an_error_event(app):
+    completion_stream = FakeCompletionStream(["Osmosis "], error=ConnectionError("reset"))
+
+    _, events, completed = _stream(app, completion_stream)
+
+    assert events == [(None, {"delta": "Osmosis "}), ("error", {"error": "AI response was interrupted"})]
+    assert completed == []
+    assert completion_stream.closed
+
+
+def test_streaming_is_opt_in(app):
+    with app.app.test_request_context("/api/generate-notes", method="POST"):
+        assert not app._wants_streaming({})
+        assert app._wants_streaming({"stream": True})
+        assert app._wants_streaming({"stream": "true"})
+        assert not app._wants_streaming({"stream": "no"})
+    with app.app.test_request_context("/api/generate-notes", method="POST", headers={"Accept": "text/event-stream"}):
+        assert app._wants_streaming({})
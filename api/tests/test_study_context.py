@@ -0,0 +1,184 @@
+import json
+import uuid
+
+import pytest
+
+
+def _elements(**categories):
+    elements = {"terms": [], "definitions": [], "examples": [], "questions": [], "answers": []}
+    elements.update(categories)
+    return elements
+
+
+def _aggregate(app, user, scope):
+    with app._study_context_db() as conn:
+        row = conn.execute(
+            "SELECT item_counts, file_count FROM study_context_aggregates WHERE user_id = ? AND scope = ?", (user, scope)
+        ).fetchone()
+    return json.loads(row["item_counts"]), row["file_count"]
+
+
+@pytest.fixture
+def user():
+    return f"{uuid.uuid4().hex}@example.com"
+
+
+def test_item_shared_by_two_files_is_counted_twice(app, user):
+    app._update_study_context(user, added=[
+        (1, "p1", _elements(terms=["osmosis", "diffusion"])),
+        (2, "p1", _elements(terms=["osmosis"])),
+    ])
+    counts, file_count = _aggregate(app, user, app.STUDY_SCOPE_ALL)
+    assert counts["terms"] == {"osmosis": 2, "diffusion": 1}
+    assert file_count == 2
+
+
+def test_removing_a_file_subtracts_its_items(app, user):
+    app._update_study_context(user, added=[
+        (1, "p1", _elements(terms=["osmosis", "diffusion"])),
+        (2, "p2", _elements(terms=["osmosis"])),
+    ])
+    app._update_study_context(user, removed_ids=[1])
+
+    counts, file_count = _aggregate(app, user, app.STUDY_SCOPE_ALL)
+    assert counts["terms"] == {"osmosis": 1}
+    assert file_count == 1
+    project_counts, project_file_count = _aggregate(app, user, app._study_project_scope("p1"))
+    assert project_counts["terms"] == {}
+    assert project_file_count == 0
+
+
+def test_merge_with_negative_delta_drops_items_at_zero(app):
+    aggregate = app._new_study_aggregate()
+    app._merge_study_elements(aggregate, _elements(terms=["osmosis", "diffusion"]))
+    app._merge_study_elements(aggregate, _elements(terms=["osmosis"]))
+    app._merge_study_elements(aggregate, _elements(terms=["osmosis", "diffusion"]), -1)
+    assert app._study_aggregate_lists(aggregate)["terms"] == ["osmosis"]
+
+
+def test_merge_keeps_first_seen_order_without_repeats(app):
+    aggregate = app._new_study_aggregate()
+    app._merge_study_elements(aggregate, _elements(terms=["osmosis", "enzyme", "osmosis"], examples=["", None]))
+    app._merge_study_elements(aggregate, _elements(terms=["diffusion", "enzyme"], definitions=["enzyme: a catalyst"]))
+
+    merged = app._study_aggregate_lists(aggregate)
+    assert merged["terms"] == ["osmosis", "enzyme", "diffusion"]
+    assert merged["definitions"] == ["enzyme: a catalyst"]
+    assert merged["examples"] == []
+
+
+def test_merge_treats_equal_structured_items_as_one(app):
+    aggregate = app._new_study_aggregate()
+    app._merge_study_elements(aggregate, _elements(examples=[{"input": 2, "output": 4}]))
+    app._merge_study_elements(aggregate, _elements(examples=[{"output": 4, "input": 2}]))
+    app._merge_study_elements(aggregate, {"terms": "not a list", "examples": ["doubling"]})
+
+    assert app._study_aggregate_lists(aggregate)["examples"] == ['{"input": 2, "output": 4}', "doubling"]
+    assert app._study_aggregate_lists(aggregate)["terms"] == []
+
+
+def test_project_scope_is_rebuilt_from_stored_files(app, user):
+    app._update_study_context(user, added=[
+        (1, "p1", _elements(terms=["osmosis"])),
+        (2, "p1", _elements(terms=["osmosis", "enzyme"])),
+        (3, "p2", _elements(terms=["mitochondria"])),
+    ])
+    with app._study_context_db() as conn:
+        conn.execute("DELETE FROM study_context_aggregates WHERE user_id = ? AND scope = ?",
+                     (user, app._study_project_scope("p1")))
+
+    app._update_study_context(user, scopes=[app._study_project_scope("p1")])
+    counts, file_count = _aggregate(app, user, app._study_project_scope("p1"))
+    assert counts["terms"] == {"osmosis": 2, "enzyme": 1}
+    assert file_count == 2
+
+
+class FakeQuery:
+    def __init__(self, calls, rows):
+        self.calls = calls
+        self.rows = rows
+        self.columns = None
+
+    def select(self, columns):
+        self.calls.append(columns)
+        self.columns = columns.split(",")
+        return self
+
+    def eq(self, column, value):
+        self.rows = [row for row in self.rows if row.get(column) == value]
+        return self
+
+    def in_(self, column, values):
+        self.rows = [row for row in self.rows if row.get(column) in values]
+        return self
+
+    def execute(self):
+        data = [{column: row.get(column) for column in self.columns} for row in self.rows]
+        return type("Result", (), {"data": data})()
+
+
+class FakeSupabase:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def table(self, name):
+        return FakeQuery(self.calls, self.rows)
+
+
+def test_recently_reconciled_scope_skips_listing_file_ids(app, user, monkeypatch):
+    app._update_study_context(user, added=[(1, "p1", _elements(definitions=["osmosis: water crossing a membrane"]))])
+    fake = FakeSupabase([{"id": 1, "user_id": user, "project_id": "p1"}])
+    monkeypatch.setattr(app, "supabase", fake)
+
+    first = app._get_study_context(user)
+    assert fake.calls == ["id,project_id"]
+    second = app._get_study_context(user)
+    assert fake.calls == ["id,project_id"]
+    assert first == second
+    assert second["file_count"] == 1
+    assert "structured_data" not in second
+    assert app._get_study_context(user, include_lists=True)["structured_data"]["definitions"] == [
+        "osmosis: water crossing a membrane"
+    ]
+
+
+def test_scope_from_request(app):
+    assert app._study_scope_from_request({}) == (None, None)
+    assert app._study_scope_from_request({"project_id": "p1", "file_ids": ["3", 4]}) == ("p1", [3, 4])
+    for file_ids in ("3", ["three"], [None]):
+        with pytest.raises(ValueError):
+            app._study_scope_from_request({"file_ids": file_ids})
+
+
+@pytest.fixture
+def scoped_files(app, user, monkeypatch):
+    """Files 1 (p1) and 2 (p2) are materialized; file 3 (p1) exists only in file_imports."""
+    app._update_study_context(user, added=[
+        (1, "p1", _elements(terms=["osmosis"])),
+        (2, "p2", _elements(terms=["mitochondria"])),
+    ])
+    fake = FakeSupabase([
+        {"id": 1, "user_id": user, "project_id": "p1"},
+        {"id": 2, "user_id": user, "project_id": "p2"},
+        {"id": 3, "user_id": user, "project_id": "p1", "structured_data": _elements(terms=["enzyme"])},
+        {"id": 4, "user_id": "someone-else", "project_id": "p1", "structured_data": _elements(terms=["secret"])},
+    ])
+    monkeypatch.setattr(app, "supabase", fake)
+    return fake
+
+
+def test_project_scope_only_includes_and_fetches_its_files(app, user, scoped_files):
+    context = app._get_study_context(user, project_id="p1", include_lists=True)
+
+    assert context["structured_data"]["terms"] == ["osmosis", "enzyme"]
+    assert context["file_count"] == 2
+    assert scoped_files.calls == ["id,project_id", "id,structured_data"]
+
+
+def test_file_scope_merges_only_the_selected_files(app, user, scoped_files):
+    context = app._get_study_context(user, file_ids=[2, 3, 4], include_lists=True)
+    assert context["structured_data"]["terms"] == ["mitochondria", "enzyme"]
+    assert context["file_count"] == 2
+
+    assert app._get_study_context(user, file_ids=[], include_lists=True)["file_count"] == 0
@@ -0,0 +1,70 @@
+import uuid
+
+import pytest
+
+
+def _elements(**categories):
+    elements = {"terms": [], "definitions": [], "examples": [], "questions": [], "answers": []}
+    elements.update(categories)
+    return elements
+
+
+@pytest.fixture
+def user(app):
+    user = f"{uuid.uuid4().hex}@example.com"
+    app._update_study_context(user, added=[
+        (1, "p1", _elements(
+            terms=["osmosis"],
+            definitions=["osmosis: water crossing a membrane"],
+            examples=["membrane proteins pump ions"],
+        )),
+        (2, "p2", _elements(
+            terms=["mitochondria", "osmosis"],
+            questions=["What does osmosis move?"],
+            answers=["Water"],
+        )),
+    ])
+    return user
+
+
+def test_elements_are_ranked_by_bm25(app, user):
+    results = app._search_study_elements(user, "osmosis membrane", top_k=10)
+
+    assert results[0] == ("definition", "osmosis: water crossing a membrane")
+    assert set(results) == {
+        ("definition", "osmosis: water crossing a membrane"),
+        ("term", "osmosis"),
+        ("example", "membrane proteins pump ions"),
+        ("question", "What does osmosis move?"),
+    }
+    # "osmosis" is a term of both files but is returned once
+    assert len(results) == 4
+    assert app._search_study_elements(user, "osmosis membrane", top_k=2) == results[:2]
+
+
+def test_questions_and_answers_are_indexed_separately(app, user):
+    assert app._search_study_elements(user, "water", top_k=10)[0] == ("answer", "Water")
+    assert ("question", "What does osmosis move?") not in app._search_study_elements(user, "water", top_k=10)
+
+
+def test_search_is_limited_to_the_project_or_files(app, user):
+    assert app._search_study_elements(user, "osmosis", top_k=10, project_id="p2") == [
+        ("term", "osmosis"),
+        ("question", "What does osmosis move?"),
+    ]
+    assert app._search_study_elements(user, "mitochondria", top_k=10, file_ids=[1]) == []
+    assert app._search_study_elements(user, "osmosis", top_k=10, file_ids=[]) == []
+
+
+def test_removed_file_leaves_the_index(app, user):
+    app._update_study_context(user, removed_ids=[2])
+
+    assert app._search_study_elements(user, "mitochondria", top_k=10) == []
+    assert ("term", "osmosis") in app._search_study_elements(user, "osmosis", top_k=10)
+
+
+def test_topic_without_matches_falls_back_to_the_overview(app, user):
+    study_context = {"compressed_context": "overview of the notes"}
+
+    assert app._topic_study_context(user, "photosynthesis", 10, study_context) == "overview of the notes"
+    assert app._topic_study_context(user, "mitochondria", 10, study_context) == "Term: mitochondria"
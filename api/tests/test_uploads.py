@@ -0,0 +1,72 @@
+import io
+
+import fitz
+from PIL import Image
+
+
+def test_text_upload_is_decoded_from_memory(app):
+    assert app._extract_text_from_bytes("Osmosis moves water.\n".encode("utf-8"), "notes.md") == "Osmosis moves water."
+
+
+def test_pdf_text_layer_is_read_from_memory(app):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "Enzymes speed up reactions.")
+    doc.new_page().insert_text((72, 72), "Mitochondria make ATP.")
+    pdf_bytes = doc.tobytes()
+
+    text = app._extract_text_from_bytes(pdf_bytes, "notes.pdf", parallel_ocr=False)
+
+    assert text.index("Enzymes speed up reactions.") < text.index("Mitochondria make ATP.")
+
+
+def test_image_upload_is_ocrd_from_memory(app, monkeypatch):
+    seen = []
+    monkeypatch.setattr(app, "_ocr_image", lambda img, ocr_mode=None: seen.append((img.size, ocr_mode)) or "Whiteboard text")
+    png = io.BytesIO()
+    Image.new("RGB", (40, 30), "white").save(png, format="PNG")
+
+    assert app._extract_text_from_bytes(png.getvalue(), "board.PNG", ocr_mode="accurate") == "Whiteboard text"
+    assert seen == [((40, 30), "accurate")]
+
+
+def test_api_upload_is_processed_without_writing_files(app, monkeypatch):
+    uploaded = b"Photosynthesis turns light into sugar."
+    seen = {}
+
+    def run_pipeline(file_bytes, filename, file_id, ocr_mode=None, progress_callback=None):
+        seen["pipeline"] = (file_bytes, filename, ocr_mode)
+        return {
+            "extracted_text": file_bytes.decode(),
+            "structured_data": {"terms": ["photosynthesis"], "definitions": [], "examples": [], "questions": [], "answers": []},
+            "compressed_text": "photosynthesis",
+            "chunk_token_estimates": [8],
+            "failed_chunks": 0,
+            "cache_hit": False,
+            "metrics": app._new_ingest_metrics(),
+            "error": None
+        }
+
+    def insert_record(user_email, project_id, filename, columns, text_length):
+        seen["insert"] = columns
+        return {"id": 7, "user_id": user_email, "project_id": project_id, "filename": filename, "text_length": text_length}
+
+    monkeypatch.setattr(app, "get_authenticated_user", lambda: "student@example.com")
+    monkeypatch.setattr(app, "_run_ingestion_pipeline", run_pipeline)
+    monkeypatch.setattr(app, "_insert_file_import_record", insert_record)
+    monkeypatch.setattr(app, "_study_context_file_added", lambda user_email, row: None)
+    monkeypatch.setattr(app, "PERSIST_INGEST_ARTIFACTS", False)
+    monkeypatch.setattr(app, "_persist_ingest_artifacts", lambda *args: seen.setdefault("persisted", args))
+
+    response = app.app.test_client().post("/api/files", data={
+        "file": (io.BytesIO(uploaded), "notes.txt"),
+        "project_id": "p1",
+        "ocr_mode": "accurate",
+    }, content_type="multipart/form-data")
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["file"]["id"] == 7
+    assert body["extracted_text_path"] is None and body["compressed_file_path"] is None
+    assert seen["pipeline"] == (uploaded, "notes.txt", "accurate")
+    assert seen["insert"]["summary_text"] == "photosynthesis"
+    assert "persisted" not in seen
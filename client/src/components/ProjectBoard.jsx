@@ -562,68 +562,78 @@ export default function ProjectBoard({ project, onBack }) {
     const files = Array.from(e.target.files)
     const newFiles = []
     setError('') // Clear any previous errors
-    
-    for (const f of files) {
-      const meta = { file: f, type: 'test', id: `${Date.now()}-${f.name}` }
-      const form = new FormData()
-      form.append('file', f)
-      form.append('type', 'test')
-      form.append('project_id', project.id)
-      
-      try {
-        setLoading(true) // Show loading state
-        const token = localStorage.getItem('jwt_token')
-        const res = await api.post('/import-file', form, { 
-          headers: {
-            'Authorization': `Bearer ${token}`
-          }
-        })
-        console.log('File uploaded and text extracted:', res.data)
-        
-        // Check if the response has the expected structure
-        if (res.data && res.data.success) {
+    if (files.length === 0) return
+
+    // All selected files go up in one request so the server can batch extraction of small files
+    const form = new FormData()
+    files.forEach((f) => form.append('file', f))
+    form.append('type', 'test')
+    form.append('project_id', project.id)
+
+    try {
+      setLoading(true) // Show loading state
+      const token = localStorage.getItem('jwt_token')
+      const res = await api.post('/import-files', form, { 
+        headers: {
+          'Authorization': `Bearer ${token}`
+        }
+      })
+      console.log('Files uploaded and text extracted:', res.data)
+
+      const results = res.data?.files || []
+      files.forEach((f, index) => {
+        const meta = { file: f, type: 'test', id: `${Date.now()}-${f.name}` }
+        const result = results[index]
+
+        // Check if the result has the expected structure
+        if (result && result.success) {
           newFiles.push({ 
             ...meta, 
-            database_record_id: res.data.database_record_id,
-            file_id: res.data.file_id,
-            storage_type: res.data.storage_type || 'database',
-            extracted_text_length: res.data.extracted_text_length,
-            compressed_text_length: res.data.compressed_text_length,
-            structured_items: res.data.structured_items
+            database_record_id: result.database_record_id,
+            file_id: result.file_id,
+            storage_type: result.storage_type || 'database',
+            extracted_text_length: result.extracted_text_length,
+            compressed_text_length: result.compressed_text_length,
+            structured_items: result.structured_items
           })
-          
+
           // Log successful file import with processing details
-          const processingInfo = res.data.structured_items ? 
-            `(${res.data.structured_items.terms} terms, ${res.data.structured_items.definitions} definitions, ${res.data.structured_items.examples} examples)` : 
+          const processingInfo = result.structured_items ? 
+            `(${result.structured_items.terms} terms, ${result.structured_items.definitions} definitions, ${result.structured_items.examples} examples)` : 
             ''
           logChange(project.id, 'file_imported', `Imported and processed file: ${f.name} (${(f.size / 1024).toFixed(1)} KB) ${processingInfo}`)
         } else {
           // Handle case where success is false or missing
-          const errorMsg = res.data?.error || `Upload failed for ${f.name}: Invalid response format`
+          const errorMsg = result?.error || `Upload failed for ${f.name}: Invalid response format`
           console.error('Upload error:', errorMsg)
           setError(errorMsg)
-          
+
           // Log failed file import
           logChange(project.id, 'file_import_failed', `Failed to import file: ${f.name} - ${errorMsg}`)
         }
-      } catch (err) {
-        console.error('Upload failed for ' + f.name + ':', err)
-        
-        // Extract error message from response if available
+      })
+    } catch (err) {
+      console.error('Upload failed:', err)
+
+      // The whole request failed (or every file did): report each file, using the per-file error if there is one
+      const results = err.response?.data?.files || []
+      files.forEach((f, index) => {
         let errorMessage = `Upload failed for ${f.name}`
-        if (err.response?.data?.error) {
+        if (results[index]?.error) {
+          errorMessage = results[index].error
+        } else if (err.response?.data?.error) {
           errorMessage = err.response.data.error
         } else if (err.message) {
           errorMessage = `Upload failed for ${f.name}: ${err.message}`
         }
-        
+
         setError(errorMessage)
-        
+
         // Log failed file import
         logChange(project.id, 'file_import_failed', `Failed to import file: ${f.name} - ${errorMessage}`)
-      } finally {
-        setLoading(false) // Hide loading state
-      }
+      })
+    } finally {
+      setLoading(false) // Hide loading state
     }
     
     if (newFiles.length > 0) {